@@ -102,3 +102,62 @@ def random_rotation_90(channels, gt_lbls, probs_rot_90=None):
     return channels, gt_lbls
 
 
+
+
+# Test-time augmentation (TTA). Deterministic versions of the above, for whole batches of tiles.
+# Each variant is a tuple (axes_to_flip, rot_90_xtimes, plane_axes). Flip is applied first, then rotation.
+# Axes are the spatial (x,y,z) axes 0,1,2. Arrays are [batch, channels, x, y, z].
+
+def get_variants_for_tta(prms):
+    # prms: None or {'reflect': [bool x3], per axis, 'rotate90': {'xy': bool, 'yz': bool, 'xz': bool}}
+    # Returns: list of variants. The first is always the identity. One more per flipped axis and ...
+    #          ... 3 more (90/180/270 degrees) per rotated plane.
+    variants = [((), 0, (0, 1))]
+    if prms is None:
+        return variants
+    if prms.get('reflect') is not None:
+        for axis_idx in range(3):
+            if prms['reflect'][axis_idx]:
+                variants.append(((axis_idx,), 0, (0, 1)))
+    if prms.get('rotate90') is not None:
+        for key, plane_axes in zip( ['xy', 'yz', 'xz'], [(0,1), (1,2), (0,2)] ) :
+            if prms['rotate90'].get(key):
+                for rot_90_xtimes in [1, 2, 3]:
+                    variants.append(((), rot_90_xtimes, plane_axes))
+    return variants
+
+
+def get_axes_and_planes_of_tta(prms):
+    # Returns: axes (list) that are flipped or rotated by the variants, and planes (list of pairs of axes) of rotations.
+    axes = set()
+    planes = []
+    for (axes_to_flip, rot_90_xtimes, plane_axes) in get_variants_for_tta(prms):
+        axes.update(axes_to_flip)
+        if rot_90_xtimes != 0 and plane_axes not in planes:
+            axes.update(plane_axes)
+            planes.append(plane_axes)
+    return sorted(axes), planes
+
+
+def apply_variant_for_tta(arr, variant):
+    # arr: np array [batch, channels, x, y, z]. Returns a view.
+    # Tiles of all pathways are transformed. Same as transforming the volume, only if the size of tiles allows it...
+    # ... (isotropic in rotated planes, symmetric subsampled tiles). Checked when parsing the config. See...
+    # ... ModelParameters.check_segm_dim_infer_for_tta()
+    (axes_to_flip, rot_90_xtimes, plane_axes) = variant
+    for axis_idx in axes_to_flip:
+        arr = np.flip(arr, axis=axis_idx+2) # + 2 because dims [0,1] are batch and channels.
+    if rot_90_xtimes != 0:
+        arr = np.rot90(arr, k=rot_90_xtimes, axes=[axis+2 for axis in plane_axes])
+    return arr
+
+
+def invert_variant_for_tta(arr, variant):
+    # arr: np array [batch, classes, x, y, z]. Predictions for tiles transformed by apply_variant_for_tta().
+    # Returns a view, in the orientation of the original tiles.
+    (axes_to_flip, rot_90_xtimes, plane_axes) = variant
+    if rot_90_xtimes != 0:
+        arr = np.rot90(arr, k=-rot_90_xtimes, axes=[axis+2 for axis in plane_axes])
+    for axis_idx in axes_to_flip:
+        arr = np.flip(arr, axis=axis_idx+2)
+    return arr
@@ -0,0 +1,174 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+# On-disk cache of the loaded and pre-processed (padded, normalized) images of a subject.
+# Loading from .nii.gz and normalizing is the most time consuming part of the sampling jobs,...
+# ... but its output is the same every subepoch. Each subject is stored as raw .npy files in its own folder:
+# folder_cache/<key>/{channels, gt_lbl_img, roi_mask, wmaps, pad_left_right_per_axis}.npy
+# The key is a hash of the input filepaths, their modification times and the pre-processing parameters,...
+# ... so that if any of those changes, the subject is pre-processed anew.
+# The arrays are stored uncompressed, so that they can be memory-mapped when loaded. Then only the parts...
+# ... of the volumes that are actually read (eg the sampled segments) are loaded in RAM.
+# Channels are stored as float32, as is the input of the cnn.
+# The index of voxels to sample from, used by training, is cached in the same folder. See further below.
+
+NAMES_OF_ARRS_IN_CACHE = ["channels", "gt_lbl_img", "roi_mask", "wmaps", "pad_left_right_per_axis"]
+# Normalization parameters that do not change the pre-processed images (eg only logging). Not part of the key.
+NORM_PRMS_NOT_IN_KEY = ['verbose_lvl']
+
+
+def _get_paths_of_subj(subj_i,
+                       paths_per_chan_per_subj,
+                       paths_to_lbls_per_subj,
+                       paths_to_masks_per_subj,
+                       paths_to_wmaps_per_sampl_cat_per_subj):
+    paths = list(paths_per_chan_per_subj[subj_i])
+    paths += [paths_to_lbls_per_subj[subj_i]] if paths_to_lbls_per_subj is not None else ["-"]
+    paths += [paths_to_masks_per_subj[subj_i]] if paths_to_masks_per_subj is not None else ["-"]
+    if paths_to_wmaps_per_sampl_cat_per_subj is not None:
+        paths += [paths_for_cat[subj_i] for paths_for_cat in paths_to_wmaps_per_sampl_cat_per_subj]
+    return paths
+
+
+def get_cache_key_of_subj(subj_i,
+                          paths_per_chan_per_subj,
+                          paths_to_lbls_per_subj,
+                          paths_to_masks_per_subj,
+                          paths_to_wmaps_per_sampl_cat_per_subj,
+                          pad_input_imgs,
+                          dims_rec_field,
+                          dims_hres_segment,
+                          norm_prms):
+    # Returns: string, hex digest that identifies the pre-processed images of the subject.
+    paths = _get_paths_of_subj(subj_i,
+                               paths_per_chan_per_subj,
+                               paths_to_lbls_per_subj,
+                               paths_to_masks_per_subj,
+                               paths_to_wmaps_per_sampl_cat_per_subj)
+    # "-" is given for missing channels. No file to stat.
+    mtimes_and_sizes = [[os.path.getmtime(p), os.path.getsize(p)] if p != "-" else None for p in paths]
+
+    descr = {'paths': paths,
+             'mtimes_and_sizes': mtimes_and_sizes,
+             'pad_input_imgs': pad_input_imgs,
+             'dims_rec_field': [int(d) for d in dims_rec_field],
+             'dims_hres_segment': [int(d) for d in dims_hres_segment],
+             'norm_prms': {k: v for (k, v) in norm_prms.items() if k not in NORM_PRMS_NOT_IN_KEY}
+                           if norm_prms is not None else None}
+    descr_str = json.dumps(descr, sort_keys=True, default=str)
+    return hashlib.sha1(descr_str.encode('utf-8')).hexdigest()
+
+
+def load_preproc_subj_from_cache(folder_cache, key, mmap=False):
+    # mmap: If True, arrays are returned as copy-on-write np.memmaps. Writing to them does not change the cache.
+    # Returns: None if subject is not in the cache. Otherwise the tuple:
+    #          (channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis) ...
+    #          ... as returned by sampling.preproc_imgs_of_subj(). Arrays not given by user are None.
+    folder_subj = os.path.join(folder_cache, key)
+    if not os.path.isdir(folder_subj):
+        return None
+
+    arrs = []
+    for name in NAMES_OF_ARRS_IN_CACHE:
+        filepath = os.path.join(folder_subj, name + ".npy")
+        arrs.append(np.load(filepath, mmap_mode='c' if mmap else None) if os.path.exists(filepath) else None)
+
+    (channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis) = arrs
+    pad_left_right_per_axis = tuple(tuple(int(p) for p in pad_axis) for pad_axis in pad_left_right_per_axis)
+    return channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis
+
+
+def save_preproc_subj_to_cache(folder_cache,
+                               key,
+                               channels,
+                               gt_lbl_img,
+                               roi_mask,
+                               wmaps_to_sample_per_cat,
+                               pad_left_right_per_axis):
+    # Many sampling processes may be writing the same subject at the same time (eg train and val share cases).
+    # Write to a folder unique to this process, then rename. Rename of a folder is atomic, and fails if exists.
+    folder_subj = os.path.join(folder_cache, key)
+    if os.path.isdir(folder_subj):
+        return
+
+    folder_tmp = folder_subj + ".tmp" + str(os.getpid())
+    if not os.path.exists(folder_tmp):
+        os.makedirs(folder_tmp)
+
+    arrs = [np.asarray(channels, dtype="float32"),
+            gt_lbl_img,
+            roi_mask,
+            wmaps_to_sample_per_cat,
+            np.asarray(pad_left_right_per_axis)]
+    for name, arr in zip(NAMES_OF_ARRS_IN_CACHE, arrs):
+        if arr is not None:
+            np.save(os.path.join(folder_tmp, name + ".npy"), arr)
+
+    try:
+        os.rename(folder_tmp, folder_subj)
+    except OSError:  # Another process finished caching this subject first. Keep theirs.
+        shutil.rmtree(folder_tmp, ignore_errors=True)
+
+
+# Sampling index of a cached subject. Built once, from the sampling maps of each category (see samplingType.py),...
+# ... so that later subepochs sample directly from it, without deriving the maps from the labels/ROI again.
+# It depends on the sampling type and the number of categories, so it is stored per type in the subject's folder:
+# folder_cache/<key>/sampling_idx_type<t>_cats<n>/{vox_cat<i>, cum_weights_cat<i>}.npy
+# vox_cat<i>: flat indices (in the pre-processed volume) of the voxels where a segment can be centered.
+# cum_weights_cat<i>: cumulative sum of their weights. Not stored if all are equal (binary maps, eg from labels).
+# The dimensions of the segment, that define which voxels are too close to the edges, are part of the key.
+
+def _get_folder_of_sampling_idx(folder_cache, key, sampling_type_int, n_sampling_cats):
+    return os.path.join(folder_cache, key, "sampling_idx_type" + str(sampling_type_int) + "_cats" + str(n_sampling_cats))
+
+
+def load_sampling_idx_from_cache(folder_cache, key, sampling_type_int, n_sampling_cats):
+    # Returns: None if not in the cache. Otherwise list with (vox_idxs, cum_weights or None) per sampling category.
+    #          Arrays are memory-mapped (read-only), so only the sampled entries are loaded in RAM.
+    folder_idx = _get_folder_of_sampling_idx(folder_cache, key, sampling_type_int, n_sampling_cats)
+    if not os.path.isdir(folder_idx):
+        return None
+
+    sampling_idx_per_cat = []
+    for cat_i in range(n_sampling_cats):
+        vox_idxs = np.load(os.path.join(folder_idx, "vox_cat" + str(cat_i) + ".npy"), mmap_mode='r')
+        filepath_cum_weights = os.path.join(folder_idx, "cum_weights_cat" + str(cat_i) + ".npy")
+        cum_weights = np.load(filepath_cum_weights, mmap_mode='r') if os.path.exists(filepath_cum_weights) else None
+        sampling_idx_per_cat.append((vox_idxs, cum_weights))
+    return sampling_idx_per_cat
+
+
+def save_sampling_idx_to_cache(folder_cache, key, sampling_type_int, sampling_idx_per_cat):
+    # sampling_idx_per_cat: as returned by load_sampling_idx_from_cache()
+    # Same as save_preproc_subj_to_cache(): write in a folder unique to this process, then rename (atomic).
+    if not os.path.isdir(os.path.join(folder_cache, key)): # Subject not cached. Nothing to attach the index to.
+        return
+    folder_idx = _get_folder_of_sampling_idx(folder_cache, key, sampling_type_int, len(sampling_idx_per_cat))
+    if os.path.isdir(folder_idx):
+        return
+
+    folder_tmp = folder_idx + ".tmp" + str(os.getpid())
+    if not os.path.exists(folder_tmp):
+        os.makedirs(folder_tmp)
+
+    for cat_i, (vox_idxs, cum_weights) in enumerate(sampling_idx_per_cat):
+        np.save(os.path.join(folder_tmp, "vox_cat" + str(cat_i) + ".npy"), vox_idxs)
+        if cum_weights is not None:
+            np.save(os.path.join(folder_tmp, "cum_weights_cat" + str(cat_i) + ".npy"), cum_weights)
+
+    try:
+        os.rename(folder_tmp, folder_idx)
+    except OSError:  # Another process finished first. Keep theirs.
+        shutil.rmtree(folder_tmp, ignore_errors=True)
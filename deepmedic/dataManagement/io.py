@@ -8,7 +8,10 @@
 from __future__ import absolute_import, division
 
 import os
+import gzip
+from multiprocessing.pool import ThreadPool
 import nibabel as nib
+from nibabel.fileholders import FileHolder
 import numpy as np
 
 
@@ -33,30 +36,114 @@ def load_volume(filepath):
     return img
 
 
+def load_dims_of_volume(filepath):
+    # Reads only the header of the image. Returns its 3D dimensions [x, y, z], as load_volume() would.
+    dims = nib.load(filepath).shape
+    if len(dims) == 2:
+        return [dims[0], dims[1], 1]
+    return [dims[0], dims[1], dims[2]]
+
+
+def load_zooms_and_affine_of_volume(filepath):
+    # Reads only the header of the image. What is copied from an original image to the saved outputs.
+    proxy_origin = nib.load(filepath)
+    zooms_origin = proxy_origin.header.get_zooms()
+    affine_origin = proxy_origin.affine
+    proxy_origin.uncache()
+    return zooms_origin, affine_origin
+
+
+def make_nii_with_original_hdr(imgToSave, zooms_origin, affine_origin, npDtype):
+    newLabelImg = nib.Nifti1Image(imgToSave, affine_origin)
+    newLabelImg.set_data_dtype(npDtype)
+    
+    dimsImgToSave = len(imgToSave.shape)
+    newZooms = list(zooms_origin[:dimsImgToSave])
+    if len(newZooms) < dimsImgToSave : #Eg if original image was 3D, but I need to save a multi-channel image.
+        newZooms = newZooms + [1.0]*(dimsImgToSave - len(newZooms))
+    newLabelImg.header.set_zooms(newZooms)
+    return newLabelImg
+
+
+class NiiWriter(object):
+    # Writes output images in background threads, several in parallel. Compression (zlib) releases the GIL.
+    # Headers of the original images are loaded once and cached, for all the outputs of a subject.
+    # Images passed to save() must not be changed until wait() returns.
+    def __init__(self, log, n_threads=4, compress=True, compress_lvl=1):
+        # compress: True to save .nii.gz, False to save .nii (faster, larger).
+        # compress_lvl: Level of gzip, 1 (fastest) to 9 (smallest). 1 is the default of nibabel.
+        self._log = log
+        self._compress = compress
+        self._compress_lvl = compress_lvl
+        self._zooms_and_affine_per_origin = {}
+        self._pool = ThreadPool(processes=n_threads)
+        self._jobs = []
+        
+    def _get_zooms_and_affine(self, filepathOrigin):
+        if filepathOrigin not in self._zooms_and_affine_per_origin:
+            self._zooms_and_affine_per_origin[filepathOrigin] = load_zooms_and_affine_of_volume(filepathOrigin)
+        return self._zooms_and_affine_per_origin[filepathOrigin]
+    
+    def _write(self, img_nii, filepathTarget):
+        if not os.path.exists(os.path.dirname(filepathTarget)):
+            try:
+                os.makedirs(os.path.dirname(filepathTarget))
+            except OSError: # Made by another thread.
+                if not os.path.isdir(os.path.dirname(filepathTarget)):
+                    raise
+        if self._compress:
+            with gzip.GzipFile(filepathTarget, 'wb', compresslevel=self._compress_lvl) as f:
+                img_nii.to_file_map({'image': FileHolder(filename=filepathTarget, fileobj=f)})
+        else:
+            nib.save(img_nii, filepathTarget)
+        self._log.print3("Image saved at: " + str(filepathTarget))
+        
+    def save(self, imgToSave, filepathTarget, filepathOriginToCopyHeader, npDtype):
+        # Queues the image for writing. Returns immediately.
+        zooms_origin, affine_origin = self._get_zooms_and_affine(filepathOriginToCopyHeader)
+        img_nii = make_nii_with_original_hdr(imgToSave, zooms_origin, affine_origin, npDtype)
+        filepathTarget = os.path.abspath(filepathTarget)
+        if filepathTarget.endswith(".nii.gz"):
+            filepathTarget = filepathTarget[:-7]
+        elif filepathTarget.endswith(".nii"):
+            filepathTarget = filepathTarget[:-4]
+        filepathTarget = filepathTarget + (".nii.gz" if self._compress else ".nii")
+        self._jobs.append(self._pool.apply_async(self._write, (img_nii, filepathTarget)))
+        
+    def wait(self):
+        # Blocks until all queued images are written. Re-raises exceptions of the writes.
+        jobs = self._jobs
+        self._jobs = []
+        for job in jobs:
+            job.get()
+            
+    def forget_hdr(self, filepathOriginToCopyHeader):
+        # Call when done with a subject, to not keep the headers of all subjects.
+        self._zooms_and_affine_per_origin.pop(filepathOriginToCopyHeader, None)
+        
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        
+        
 #This is the generic function.
 def saveImgToNiiWithOriginalHdr(imgToSave,
                                     filepathTarget,
                                     filepathOriginToCopyHeader,
                                     npDtype = np.dtype(np.float32),
-                                    log=None):
+                                    log=None,
+                                    writer=None):
     # imgToSave: 3d np array.
     # filepathTarget: filepath where to save.
     # filepathOriginToCopyHeader: original image, where to copy the header over to the target image.
+    # writer: None, or a NiiWriter, to queue the image for writing in background instead. See NiiWriter.
+    if writer is not None:
+        writer.save(imgToSave, filepathTarget, filepathOriginToCopyHeader, npDtype)
+        return
     
     # Load original image.
-    proxy_origin = nib.load(filepathOriginToCopyHeader)
-    hdr_origin = proxy_origin.header
-    affine_origin = proxy_origin.affine
-    proxy_origin.uncache()
-    
-    newLabelImg = nib.Nifti1Image(imgToSave, affine_origin)
-    newLabelImg.set_data_dtype(npDtype)
-    
-    dimsImgToSave = len(imgToSave.shape)
-    newZooms = list(hdr_origin.get_zooms()[:dimsImgToSave])
-    if len(newZooms) < dimsImgToSave : #Eg if original image was 3D, but I need to save a multi-channel image.
-        newZooms = newZooms + [1.0]*(dimsImgToSave - len(newZooms))
-    newLabelImg.header.set_zooms(newZooms)
+    zooms_origin, affine_origin = load_zooms_and_affine_of_volume(filepathOriginToCopyHeader)
+    newLabelImg = make_nii_with_original_hdr(imgToSave, zooms_origin, affine_origin, npDtype)
     
     filepathTarget = os.path.abspath(filepathTarget)
     if not filepathTarget.endswith(".nii.gz") :
@@ -78,7 +165,8 @@ def savePredImgToNiiWithOriginalHdr(labelImageCreatedByPredictions,
                                     case_i,
                                     suffixToAdd = "",
                                     npDtype = np.dtype(np.float32),
-                                    log=None):
+                                    log=None,
+                                    writer=None):
     # case_i: # the index (in the list of filepathnames) of the current image segmented.
     # Needs as argument the cases' filepaths and index of the currently segmented case, so that ...
     # ... I can get the header, affine RAS trans etc from it and copy it for the new image.
@@ -104,7 +192,8 @@ def savePredImgToNiiWithOriginalHdr(labelImageCreatedByPredictions,
                                 filepathTarget,
                                 filepathOriginToCopyHeader,
                                 npDtype,
-                                log)
+                                log,
+                                writer)
 
 
 
@@ -115,7 +204,8 @@ def saveFmImgToNiiWithOriginalHdr(  fmImageCreatedByVisualisation,
                                     index_of_typeOfPathway_to_visualize,
                                     index_of_layer_in_pathway_to_visualize,
                                     index_of_FM_in_pathway_to_visualize,
-                                    log=None):
+                                    log=None,
+                                    writer=None):
     # case_i: # the index (in the list of filepathnames) of the current image segmented.
     # Needs as argument the cases' filepaths and index of the currently segmented case, so that ...
     # ... I can get the header, affine RAS trans etc from it and copy it for the new image.
@@ -143,7 +233,8 @@ def saveFmImgToNiiWithOriginalHdr(  fmImageCreatedByVisualisation,
                                 filepathTarget,
                                 filepathOriginToCopyHeader,
                                 np.dtype(np.float32),
-                                log)
+                                log,
+                                writer)
 
 
 
@@ -151,7 +242,8 @@ def save4DImgWithAllFmsToNiiWithOriginalHdr(multidimImageWithAllVisualisedFms,
                                             namesForSavingFms,
                                             listOfFilepathsToEachChannelOfEachPatient,
                                             image_i,
-                                            log=None):
+                                            log=None,
+                                            writer=None):
     stringToPrint = "Saving multi-dimensional image, with all FMs as 4th dimension, " +\
                     "for subject #"+str(image_i)
     if log!=None :
@@ -172,6 +264,7 @@ def save4DImgWithAllFmsToNiiWithOriginalHdr(multidimImageWithAllVisualisedFms,
                                 filepathTarget,
                                 filepathOriginToCopyHeader,
                                 np.dtype(np.float32),
-                                log)
+                                log,
+                                writer)
     
     
@@ -0,0 +1,144 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import time
+import threading
+import traceback
+from six.moves import queue
+
+from deepmedic.dataManagement.sampling import get_samples_for_subepoch
+
+
+# Bounded queue of batches, ready to be fed to the cnn. Filled by a producer thread, drained by training.do_training().
+# The producer samples subepoch after subepoch (via get_samples_for_subepoch(), with the pool of sampling...
+# ... processes if given), splits the samples in batches and puts them in the queue, in the order they are processed:
+# For each subepoch, the batches for validation (if validating on samples) and then the batches for training.
+# It does not wait for the training loop to request the next subepoch, it only blocks when the queue is full.
+# So sampling continues while the model is trained, validated on whole volumes or saved.
+# Each item in the queue: (train_or_val, n_batches in this subepoch, channs_of_batch_per_path, lbls_of_batch)
+# A subepoch with no samples is represented by a single item with n_batches = 0 and None for the arrays.
+# Batches in the queue are copies, so they do not keep the whole array of their subepoch in memory.
+# Peak RAM for samples is about 2 subepochs (train + val): The queue holds at most 1 subepoch of batches, while the...
+# ... producer holds the array of the next subepoch (train or val) that it is splitting into batches. Plus the...
+# ... shared buffers of the pool of sampling processes, if used (see sampling.PoolForSampling).
+class PrefetchQueueOfBatches(object):
+    def __init__(self,
+                 log,
+                 n_subepochs_to_produce,
+                 max_n_batches_in_queue,
+                 use_thread, # False: The consumer samples each subepoch itself, when it needs it. No prefetching.
+                 val_on_samples,
+                 args_for_sampling_tr,
+                 args_for_sampling_val,
+                 batchsize_train,
+                 batchsize_val_samples):
+        self._log = log
+        self._id_str = "[PREFETCH|PID:" + str(os.getpid()) + "]"
+        self._n_subepochs_to_produce = n_subepochs_to_produce
+        self._val_on_samples = val_on_samples
+        self._args_for_sampling = {'train': args_for_sampling_tr, 'val': args_for_sampling_val}
+        self._batchsize = {'train': batchsize_train, 'val': batchsize_val_samples}
+
+        self._n_subepochs_produced = 0
+        self._max_n_batches_in_queue = max_n_batches_in_queue if use_thread else 0 # 0: unbounded.
+        self._queue = queue.Queue(maxsize=self._max_n_batches_in_queue)
+        self._time_waited = 0. # Time the consumer waited for batches (starved). Reset by get_and_reset_time_waited()
+        self._exception = None # Set if the producer failed. Re-raised to the consumer.
+        self._stop_event = threading.Event()
+        self._thread = None
+        if use_thread:
+            self._log.print3(self._id_str + " Starting thread that samples and prefetches batches. " +
+                             "Max batches in queue: [" + str(max_n_batches_in_queue) + "]")
+            self._thread = threading.Thread(target=self._produce, name="prefetch_batches")
+            self._thread.daemon = True # Do not keep the process alive if the main thread exits.
+            self._thread.start()
+
+    def _put(self, item):
+        # Blocks while the queue is full. Returns False if stopped while waiting.
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=1.)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce_subepoch(self):
+        modes = ['val', 'train'] if self._val_on_samples else ['train']
+        for train_or_val in modes:
+            (channs_of_samples_per_path,
+             lbls_of_samples) = get_samples_for_subepoch(*self._args_for_sampling[train_or_val])
+            batchsize = self._batchsize[train_or_val]
+            # Calc num of batches from extracted samples, in case not extracted as much as requested.
+            n_batches = len(channs_of_samples_per_path[0]) // batchsize
+            if n_batches == 0:
+                self._log.print3(self._id_str + " WARN: Not enough samples for a single batch of [" + train_or_val +
+                                 "]! Subepoch will be skipped.")
+                if not self._put((train_or_val, 0, None, None)):
+                    return False
+            # A view would keep the whole array of the subepoch alive, for as long as any of its batches is queued.
+            # When sequential, the subepoch is consumed before the next is sampled. Views suffice, no copy.
+            copy_batches = self._thread is not None
+            for batch_i in range(n_batches):
+                channs_of_batch_per_path = [channs_of_samples_for_path[batch_i * batchsize: (batch_i + 1) * batchsize]
+                                            for channs_of_samples_for_path in channs_of_samples_per_path]
+                lbls_of_batch = lbls_of_samples[batch_i * batchsize: (batch_i + 1) * batchsize]
+                if copy_batches:
+                    channs_of_batch_per_path = [channs_of_batch.copy() for channs_of_batch in channs_of_batch_per_path]
+                    lbls_of_batch = lbls_of_batch.copy()
+                if not self._put((train_or_val, n_batches, channs_of_batch_per_path, lbls_of_batch)):
+                    return False
+            # Release the array of this subepoch before sampling the next.
+            del channs_of_samples_per_path, lbls_of_samples
+        self._n_subepochs_produced += 1
+        return True
+
+    def _produce(self):
+        # Main loop of the producer thread.
+        try:
+            while self._n_subepochs_produced < self._n_subepochs_to_produce and not self._stop_event.is_set():
+                if not self._produce_subepoch():
+                    break
+        except (Exception, KeyboardInterrupt) as e:
+            self._log.print3(self._id_str + "\n\n ERROR: Caught exception in prefetching thread: " + str(e) + "\n")
+            self._log.print3(traceback.format_exc())
+            self._exception = e
+            self._put(None) # Wake up the consumer.
+
+    def get_batch(self, train_or_val):
+        # Returns: (n_batches in this subepoch, channs_of_batch_per_path, lbls_of_batch)
+        if self._thread is None and self._queue.empty():
+            self._produce_subepoch() # Sequential. Puts the whole subepoch in the (unbounded) queue.
+
+        time_0 = time.time()
+        item = self._queue.get()
+        self._time_waited += time.time() - time_0
+
+        if item is None:
+            raise Exception("Prefetching of batches failed. Exception in producer thread: " + str(self._exception))
+        (mode_of_item, n_batches, channs_of_batch_per_path, lbls_of_batch) = item
+        assert mode_of_item == train_or_val # Consumer and producer should process subepochs in the same order.
+        return n_batches, channs_of_batch_per_path, lbls_of_batch
+
+    def get_n_batches_in_queue(self):
+        return self._queue.qsize()
+
+    def get_max_n_batches_in_queue(self):
+        return self._max_n_batches_in_queue
+
+    def get_and_reset_time_waited(self):
+        time_waited = self._time_waited
+        self._time_waited = 0.
+        return time_waited
+
+    def stop(self):
+        # Stops the producer thread. It may still be waiting for the current subepoch to be sampled. Not joined.
+        self._stop_event.set()
+
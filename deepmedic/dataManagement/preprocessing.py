@@ -68,7 +68,7 @@ def pad_imgs_of_case(channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat,
     pad_left_right_per_axis = calc_pad_per_axis(pad_input_imgs,
                                                 channels[0].shape, dims_rec_field, dims_highres_segment)
     if not pad_input_imgs:
-        return channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_axes
+        return channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis
     
     channels = pad_4d_arr(channels, pad_left_right_per_axis)
 
@@ -8,41 +8,56 @@
 from __future__ import absolute_import, print_function, division
 
 import os
-import sys
 import time
 import numpy as np
 import math
 import random
-import traceback
 import multiprocessing
 import signal
-import collections
 
 from deepmedic.dataManagement.io import load_volume
 from deepmedic.neuralnet.pathwayTypes import PathwayTypes as pt
 from deepmedic.dataManagement.preprocessing import pad_imgs_of_case, normalize_int_of_subj, calc_border_int_of_3d_img
 from deepmedic.dataManagement.augmentSample import augment_sample
 from deepmedic.dataManagement.augmentImage import augment_imgs_of_case
+from deepmedic.dataManagement.cache import get_cache_key_of_subj, load_preproc_subj_from_cache, save_preproc_subj_to_cache
+from deepmedic.dataManagement.cache import load_sampling_idx_from_cache, save_sampling_idx_to_cache
 
 
 # Order of calls:
+# PoolForSampling (once per training session, if sampling in parallel)
+#    init_sampling_proc (in each worker)
 # get_samples_for_subepoch
 #    choose_random_subjects
 #    get_n_samples_per_subj
-#    load_subj_and_sample
-#        load_imgs_of_subject
-#        sample_idxs_of_segments
-#        extractSegmentGivenSliceCoords
-#            getImagePartFromSubsampledImageForTraining
-#    shuffle_samples
+#    load_subj_and_sample (in worker of pool via sample_subj_in_worker, or sequentially)
+#        load_and_preproc_imgs_of_subj
+#            load_preproc_subj_from_cache (if cache is used)
+#            load_imgs_of_subject
+#            preproc_imgs_of_subj
+#        load_sampling_idx_from_cache (if cache is used)
+#        get_sampling_idx_of_map (if cache is used, and not cached before)
+#        sample_idxs_of_segments or sample_idxs_of_segments_from_idx
+#        extract_segments_to_bufs
+#            extract_segments_of_pathways
+#                get_slices_of_segms_along_axis
+#                gather_segments
+#    gather_shuffled_samples
+
+
+# Waiting for the results of sampling jobs, in the pool of sampling processes. Every that many secs without a...
+# ... result, check whether a worker died. If so, the pool is recreated and the unfinished jobs are resubmitted.
+SECS_BETWEEN_CHECKS_OF_WORKERS = 10
+SECS_BETWEEN_LOGS_OF_WAITING = 60
+MAX_RECREATIONS_OF_POOL_PER_SUBEP = 3
 
 
 # Main sampling process during training. Executed in parallel while training on a batch on GPU.
 # Called from training.do_training()
 # TODO: I think this should be a "sampler" class and moved to training.py. To keep this file generic-sampling.
-def get_samples_for_subepoch(log,
+def get_samples_for_subepoch(mp_pool_sampling,
+                             log,
                              train_val_or_test,
-                             num_parallel_proc,
                              run_input_checks,
                              cnn3d,
                              max_n_cases_per_subep,
@@ -57,8 +72,14 @@ def get_samples_for_subepoch(log,
                              pad_input_imgs,
                              norm_prms,
                              augm_img_prms,
-                             augm_sample_prms):
+                             augm_sample_prms,
+                             folder_cache,
+                             precision_samples):
+    # mp_pool_sampling: None for sequential sampling. Else a PoolForSampling. The pool's workers...
+    #                   ... must have been given the same args (all following mp_pool_sampling) for train_val_or_test.
     # train_val_or_test: 'train', 'val' or 'test'
+    # folder_cache: None, or folder where pre-processed subjects are cached. See dataManagement/cache.py
+    # precision_samples: 32 or 16. Precision in which samples are stored. See get_shapes_of_bufs_of_samples()
     # Returns: channs_of_samples_arr_per_path - List of arrays [N_samples, Channs, R,C,Z], one per pathway.
     #          lbls_predicted_part_of_samples_arr - Array of shape: [N_samples, R_out, C_out, Z_out)
     
@@ -78,128 +99,317 @@ def get_samples_for_subepoch(log,
                "] per subepoch.")
     log.print3(sampler_id + " Shuffled indices of subjects that were randomly chosen: " + str(idxs_of_subjs_for_subep))
 
-    # List, with [numberOfPathwaysThatTakeInput] sublists.
-    # Each sublist is list of [partImagesLoadedPerSubepoch] arrays [channels, R,C,Z].
-    channs_of_samples_per_path = [[] for i in range(cnn3d.getNumPathwaysThatRequireInput())]
-    lbls_predicted_part_of_samples = []  # Labels only for the central/predicted part of segments.
     # Can be different than max_n_cases_per_subep, because of available images number.
     n_subjs_for_subep = len(idxs_of_subjs_for_subep)
 
     # Get how many samples I should get from each subject.
     n_samples_per_subj = get_n_samples_per_subj(n_samples_per_subep, n_subjs_for_subep)
-
-    args_sampling_job = [log,
-                         train_val_or_test,
-                         run_input_checks,
-                         cnn3d,
-                         sampling_type,
-                         paths_per_chan_per_subj,
-                         paths_to_lbls_per_subj,
-                         paths_to_masks_per_subj,
-                         paths_to_wmaps_per_sampl_cat_per_subj,
-                         # Pre-processing:
-                         pad_input_imgs,
-                         norm_prms,
-                         augm_img_prms,
-                         augm_sample_prms,
-
-                         n_subjs_for_subep,
-                         idxs_of_subjs_for_subep,
-                         n_samples_per_subj
-                         ]
+    # Each job writes the samples of its subject in the buffers, starting from this index.
+    idx_first_sample_per_subj = np.cumsum(n_samples_per_subj) - n_samples_per_subj
 
     log.print3(sampler_id + " Will sample from [" + str(n_subjs_for_subep) +
                "] subjects for next " + tr_or_val_str_log + "...")
 
     jobs_idxs_to_do = list(range(n_subjs_for_subep))  # One job per subject.
-
-    if num_parallel_proc <= 0:  # Sequentially
+    # Jobs may extract less samples than requested. Number actually extracted by each job:
+    n_samples_extracted_per_subj = np.zeros([n_subjs_for_subep], dtype="int32")
+
+    if mp_pool_sampling is None:  # Sequentially
+        # List of arrays. One [N_samples, channels, R,C,Z] per pathway that takes input. Last [N_samples, R,C,Z] labels.
+        bufs_of_samples = [np.empty(shape, dtype=dtype) for (shape, dtype) in
+                           get_shapes_of_bufs_of_samples(cnn3d, train_val_or_test, n_samples_per_subep,
+                                                         precision_samples)]
+        args_sampling_job = [log,
+                             train_val_or_test,
+                             run_input_checks,
+                             cnn3d,
+                             sampling_type,
+                             paths_per_chan_per_subj,
+                             paths_to_lbls_per_subj,
+                             paths_to_masks_per_subj,
+                             paths_to_wmaps_per_sampl_cat_per_subj,
+                             # Pre-processing:
+                             pad_input_imgs,
+                             norm_prms,
+                             augm_img_prms,
+                             augm_sample_prms,
+                             folder_cache,
+
+                             n_subjs_for_subep,
+                             idxs_of_subjs_for_subep,
+                             n_samples_per_subj,
+                             idx_first_sample_per_subj,
+                             bufs_of_samples
+                             ]
         for job_idx in jobs_idxs_to_do:
-            (channs_samples_from_job_per_path,
-             lbls_predicted_part_samples_from_job) = load_subj_and_sample(*([job_idx] + args_sampling_job))
-            for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()):
-                # concat does not copy.
-                channs_of_samples_per_path[pathway_i] += channs_samples_from_job_per_path[pathway_i]
-            lbls_predicted_part_of_samples += lbls_predicted_part_samples_from_job  # concat does not copy.
-
-    else:  # Parallelize sampling from each subject
+            n_samples_extracted_per_subj[job_idx] = load_subj_and_sample(*([job_idx] + args_sampling_job))
+
+    else:  # Parallelize sampling from each subject, in the workers of the pool.
+        # Workers write samples directly in these buffers, in shared memory. They only return how many they wrote.
+        bufs_of_samples = mp_pool_sampling.get_bufs_of_samples(train_val_or_test)
+        log.print3(sampler_id + " MULTIPR: Submitting [" + str(len(jobs_idxs_to_do)) + "] sampling jobs " +
+                   "(one per subject) to the pool of sampling processes.")
+        # Only the args that change every subepoch are sent with each job. Rest were given to workers at start.
+        args_per_job = [(train_val_or_test, job_idx, n_subjs_for_subep, idxs_of_subjs_for_subep, n_samples_per_subj,
+                         idx_first_sample_per_subj) for job_idx in jobs_idxs_to_do]
+        # Results are streamed back in the order that jobs finish. Order does not matter, samples are shuffled after.
+        results_of_jobs = mp_pool_sampling.imap_unordered(sample_subj_in_worker, args_per_job, chunksize=1)
+        n_jobs_submitted = len(jobs_idxs_to_do)
+        # Jobs may be slow but alive (eg first build of the cache of a large subject). Only give up if no job...
+        # ... finishes for this long. None: wait as long as the workers are alive.
+        timeout_secs_stalled = mp_pool_sampling.get_timeout_secs_stalled()
+        secs_without_progress = 0
+        n_pool_recreations = 0
         while len(jobs_idxs_to_do) > 0:  # While jobs remain.
-            jobs = collections.OrderedDict()
-
-            log.print3(sampler_id + " ******* Spawning children processes to sample from [" +
-                       str(len(jobs_idxs_to_do)) + "] subjects*******")
-            log.print3(sampler_id + " MULTIPR: Number of CPUs detected: " + str(multiprocessing.cpu_count()) +
-                       ". Requested to use max: [" + str(num_parallel_proc) + "]")
-            n_workers = min(num_parallel_proc, multiprocessing.cpu_count())
-            log.print3(sampler_id + " MULTIPR: Spawning [" + str(n_workers) + "] processes to load and sample.")
-            mp_pool = multiprocessing.Pool(processes=n_workers, initializer=init_sampling_proc)
-
-            try:  # Stacktrace in MULTIPR: https://jichu4n.com/posts/python-multiprocessing-and-exceptions/
-                for job_idx in jobs_idxs_to_do:  # submit jobs
-                    jobs[job_idx] = mp_pool.apply_async(load_subj_and_sample, ([job_idx] + args_sampling_job))
-
-                # copy with list(...), so that this loops normally even if something is removed from list.
-                for job_idx in list(jobs_idxs_to_do):
-                    try:
-                        # timeout in case process for some reason never started (happens in py3)
-                        (channs_samples_from_job_per_path,
-                         lbls_predicted_part_samples_from_job) = jobs[job_idx].get(timeout=30)
-                        for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()):
-                            # concat does not copy.
-                            channs_of_samples_per_path[pathway_i] += channs_samples_from_job_per_path[pathway_i]
-                        # concat does not copy.
-                        lbls_predicted_part_of_samples += lbls_predicted_part_samples_from_job
-                        jobs_idxs_to_do.remove(job_idx)
-                    except multiprocessing.TimeoutError:
-                        log.print3(sampler_id +\
-                              "\n\n WARN: MULTIPR: Caught TimeoutError when getting results of job [" +
-                              str(job_idx) + "].\n WARN: MULTIPR: Will resubmit job [" + str(job_idx) + "].\n")
-                        if n_workers == 1:
-                            break  # If this worker got stuck, every job will wait timeout. Slow. Recreate pool.
-                    except Exception as e:
-                        log.print3(sampler_id + "\n\n ERROR: Caught exception from job [" + str(job_idx) + "].")
-                        raise e
-
-            except (Exception, KeyboardInterrupt) as e:
-                log.print3(
-                    sampler_id + "\n\n ERROR: Caught exception in get_samples_for_subepoch(): " + str(e) + "\n")
-                log.print3(traceback.format_exc())
-                mp_pool.terminate()
-                mp_pool.join()  # Will wait. A KeybInt will kill this (py3)
+            try:
+                (job_idx, n_samples_extracted) = results_of_jobs.next(timeout=SECS_BETWEEN_CHECKS_OF_WORKERS)
+            except multiprocessing.TimeoutError:
+                secs_without_progress += SECS_BETWEEN_CHECKS_OF_WORKERS
+                # A worker that died (eg killed by OOM) is replaced by the pool, but the result of its job never comes.
+                if not mp_pool_sampling.any_worker_died():
+                    if timeout_secs_stalled is not None and secs_without_progress >= timeout_secs_stalled:
+                        raise Exception("No sampling job finished in the last [" + str(secs_without_progress) +
+                                        "] secs, although the sampling processes are alive. Jobs not done: " +
+                                        str(jobs_idxs_to_do))
+                    if secs_without_progress % SECS_BETWEEN_LOGS_OF_WAITING == 0:
+                        log.print3(sampler_id + " WARN: MULTIPR: No sampling job finished in the last [" +
+                                   str(secs_without_progress) + "] secs. Jobs done: [" +
+                                   str(n_jobs_submitted - len(jobs_idxs_to_do)) + "/" + str(n_jobs_submitted) +
+                                   "]. Still waiting...")
+                    continue
+                if n_pool_recreations >= MAX_RECREATIONS_OF_POOL_PER_SUBEP:
+                    raise Exception("Sampling processes kept dying, even after recreating their pool [" +
+                                    str(n_pool_recreations) + "] times. Jobs not done: " + str(jobs_idxs_to_do))
+                log.print3(sampler_id + " WARN: MULTIPR: A sampling process died. Recreating the pool of sampling " +
+                           "processes and resubmitting the [" + str(len(jobs_idxs_to_do)) + "] jobs not done: " +
+                           str(jobs_idxs_to_do))
+                mp_pool_sampling.recreate(log)
+                n_pool_recreations += 1
+                secs_without_progress = 0
+                args_per_job = [(train_val_or_test, job_idx, n_subjs_for_subep, idxs_of_subjs_for_subep,
+                                 n_samples_per_subj, idx_first_sample_per_subj) for job_idx in jobs_idxs_to_do]
+                results_of_jobs = mp_pool_sampling.imap_unordered(sample_subj_in_worker, args_per_job, chunksize=1)
+                continue
+            except Exception as e:  # Exceptions from the workers are re-raised here.
+                log.print3(sampler_id + "\n\n ERROR: Caught exception from a sampling job: " + str(e) + "\n")
                 raise e
-            except:  # Catches everything, even a sys.exit(1) exception.
-                log.print3(sampler_id + "\n\n ERROR: Unexpected error in get_samples_for_subepoch(). " +\
-                           "System info: ", sys.exc_info()[0])
-                mp_pool.terminate()
-                mp_pool.join()
-                raise Exception("Unexpected error.")
-            else:  # Nothing went wrong
-                # Needed in case any processes are hanging. mp_pool.close() does not solve this.
-                mp_pool.terminate()
-                mp_pool.join()
+            n_samples_extracted_per_subj[job_idx] = n_samples_extracted
+            jobs_idxs_to_do.remove(job_idx)
+            secs_without_progress = 0
 
     # Got all samples for subepoch. Now shuffle them, together segments and their labels.
-    (channs_of_samples_per_path,
-     lbls_predicted_part_of_samples) = shuffle_samples(channs_of_samples_per_path,
-                                                                 lbls_predicted_part_of_samples)
+    # Gathering copies them out of the buffers, which are then free to be used for the next subepoch.
+    (channs_of_samples_arr_per_path,
+     lbls_predicted_part_of_samples_arr) = gather_shuffled_samples(bufs_of_samples,
+                                                                   idx_first_sample_per_subj,
+                                                                   n_samples_extracted_per_subj)
     log.print3(sampler_id + " TIMING: Sampling for next [" + tr_or_val_str_log +
                "] lasted: {0:.1f}".format(time.time() - start_time_sampling) + " secs.")
 
     log.print3(sampler_id + " :=:=:=:=:=:= Finished sampling for next [" + tr_or_val_str_log + "] =:=:=:=:=:=:")
 
-    channs_of_samples_arr_per_path = [np.asarray(channs_of_samples_for_path, dtype="float32") for
-                                      channs_of_samples_for_path in channs_of_samples_per_path]
+    return channs_of_samples_arr_per_path, lbls_predicted_part_of_samples_arr
 
-    lbls_predicted_part_of_samples_arr = np.asarray(lbls_predicted_part_of_samples,
-                                                    dtype="int32")  # Could be int16 to save RAM?
 
+def get_shapes_of_bufs_of_samples(cnn3d, train_val_or_test, n_samples, precision_samples=32):
+    # precision_samples: 32: float32 segments and int32 labels, as fed to the cnn.
+    #                    16: float16 segments and uint8 labels (int16 if more classes than uint8 holds). Half or...
+    #                    ... less the RAM and bytes moved per sample. Cast to the cnn's types when fed to it.
+    # Returns: List of (shape, dtype). One [N_samples, channels, R,C,Z] per pathway that takes input,...
+    #          ... in the order of cnn3d.pathways (normal first). Last, [N_samples, R,C,Z] of labels.
+    assert precision_samples in [16, 32]
+    if precision_samples == 16:
+        dtype_segms = "float16"
+        dtype_lbls = "uint8" if cnn3d.num_classes <= np.iinfo("uint8").max + 1 else "int16"
+    else:
+        dtype_segms = "float32"
+        dtype_lbls = "int32"
+    shapes_and_dtypes = []
+    for pathway in cnn3d.pathways:
+        if pathway.pType() != pt.FC:
+            shapes_and_dtypes.append(([n_samples] + list(pathway.getShapeOfInput(train_val_or_test)[1:]), dtype_segms))
+    shapes_and_dtypes.append(([n_samples] + list(cnn3d.finalTargetLayer_outputShape[train_val_or_test][2:]), dtype_lbls))
+    return shapes_and_dtypes
+
+
+def gather_shuffled_samples(bufs_of_samples, idx_first_sample_per_subj, n_samples_extracted_per_subj):
+    # Copies the extracted samples out of the buffers, in random order. Shuffles segments together with their labels.
+    # Returns: channs_of_samples_arr_per_path, lbls_predicted_part_of_samples_arr (see get_samples_for_subepoch)
+    idxs_of_samples = np.concatenate([np.arange(idx_first, idx_first + n_extracted, dtype="int64") for
+                                      (idx_first, n_extracted) in zip(idx_first_sample_per_subj,
+                                                                      n_samples_extracted_per_subj)] +
+                                     [np.zeros([0], dtype="int64")])
+    np.random.shuffle(idxs_of_samples)
+    # Indexing with an array makes a (contiguous) copy.
+    channs_of_samples_arr_per_path = [buf[idxs_of_samples] for buf in bufs_of_samples[:-1]]
+    lbls_predicted_part_of_samples_arr = bufs_of_samples[-1][idxs_of_samples]
     return channs_of_samples_arr_per_path, lbls_predicted_part_of_samples_arr
 
 
-def init_sampling_proc():
+# Pool of sampling processes that lives for the whole training session. Avoids forking processes and pickling...
+# ... the (large) args of the jobs, such as the cnn wrapper, every subepoch.
+# Workers write the extracted samples directly in buffers in shared memory, one per pathway plus one for the labels,...
+# ... per train/val. Only the number of samples written is sent back, not the samples. Sampling of train and val...
+# ... is never done concurrently and the samples are copied out of the buffers when gathered, so one buffer...
+# ... per train/val is enough.
+# Shared memory is allocated with multiprocessing.RawArray, inherited by the workers when they start.
+class PoolForSampling(object):
+    def __init__(self, log, num_parallel_proc, args_for_sampling_per_mode, timeout_secs_stalled=None):
+        # args_for_sampling_per_mode: {'train': args, 'val': args}, where args are those given to...
+        #     ... get_samples_for_subepoch() after mp_pool_sampling. Given once to each worker, when it starts.
+        # timeout_secs_stalled: Sampling fails if no job finishes for that long, while workers are alive. None: Never.
+        id_str = "[MAIN|PID:" + str(os.getpid()) + "]"
+        
+        self._shapes_of_bufs_per_mode = {}
+        raw_bufs_per_mode = {}
+        for (train_val_or_test, args_for_sampling) in args_for_sampling_per_mode.items():
+            (_, _, _,  # log, train_val_or_test, run_input_checks
+             cnn3d,
+             _,  # max_n_cases_per_subep
+             n_samples_per_subep,
+             _, _, _, _, _,  # sampling_type, paths to input files
+             _, _, _, _, _,  # pad_input_imgs, norm_prms, augm_img_prms, augm_sample_prms, folder_cache
+             precision_samples) = args_for_sampling
+            shapes_and_dtypes = get_shapes_of_bufs_of_samples(cnn3d, train_val_or_test, n_samples_per_subep,
+                                                              precision_samples)
+            self._shapes_of_bufs_per_mode[train_val_or_test] = shapes_and_dtypes
+            raw_bufs_per_mode[train_val_or_test] = [multiprocessing.RawArray('b', max(int(np.prod(shape)), 1) *
+                                                                             np.dtype(dtype).itemsize)
+                                                    for (shape, dtype) in shapes_and_dtypes]
+        self._bufs_per_mode = get_arrs_from_raw_bufs(raw_bufs_per_mode, self._shapes_of_bufs_per_mode)
+        n_bytes_bufs = sum([buf.nbytes for bufs in self._bufs_per_mode.values() for buf in bufs])
+        
+        n_workers = min(num_parallel_proc, multiprocessing.cpu_count())
+        log.print3(id_str + " MULTIPR: Number of CPUs detected: " + str(multiprocessing.cpu_count()) +
+                   ". Requested to use max: [" + str(num_parallel_proc) + "]")
+        log.print3(id_str + " MULTIPR: Spawning pool of [" + str(n_workers) + "] processes to load and sample. " +
+                   "They will be used throughout the session. Shared memory for samples: " +
+                   "{0:.1f}".format(n_bytes_bufs / (1024.**2)) + " MB.")
+        self._n_workers = n_workers
+        self._timeout_secs_stalled = timeout_secs_stalled
+        self._raw_bufs_per_mode = raw_bufs_per_mode
+        self._args_for_sampling_per_mode = args_for_sampling_per_mode
+        self._pool = None
+        self._n_workers_started = None
+        self._start_pool()
+    
+    def _start_pool(self):
+        # Each worker increments the counter when it starts. Pool replaces workers that die with new ones,...
+        # ... so more starts than workers means a worker died.
+        self._n_workers_started = multiprocessing.Value('i', 0)
+        self._pool = multiprocessing.Pool(processes=self._n_workers,
+                                          initializer=init_sampling_proc,
+                                          initargs=(self._args_for_sampling_per_mode,
+                                                    self._raw_bufs_per_mode,
+                                                    self._shapes_of_bufs_per_mode,
+                                                    self._n_workers_started))
+    
+    def any_worker_died(self):
+        return self._n_workers_started.value > self._n_workers
+    
+    def get_timeout_secs_stalled(self):
+        return self._timeout_secs_stalled
+    
+    def recreate(self, log):
+        # Kills the workers and starts new. Shared buffers are kept.
+        log.print3("[MAIN|PID:" + str(os.getpid()) + "] MULTIPR: Recreating pool of [" + str(self._n_workers) +
+                   "] sampling processes.")
+        self._pool.terminate()
+        self._pool.join()
+        self._start_pool()
+    
+    def get_bufs_of_samples(self, train_val_or_test):
+        return self._bufs_per_mode[train_val_or_test]
+    
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return self._pool.imap_unordered(func, iterable, chunksize)
+    
+    def terminate(self):
+        self._pool.terminate()
+    
+    def join(self):
+        self._pool.join()
+
+
+def get_arrs_from_raw_bufs(raw_bufs_per_mode, shapes_of_bufs_per_mode):
+    # Returns: {'train': [np arrays], 'val': [...]}. Arrays use the memory of the raw buffers, no copy.
+    arrs_per_mode = {}
+    for train_val_or_test in raw_bufs_per_mode:
+        arrs_per_mode[train_val_or_test] = [np.frombuffer(raw_buf, dtype=dtype)[:int(np.prod(shape))].reshape(shape)
+                                            for (raw_buf, (shape, dtype)) in
+                                            zip(raw_bufs_per_mode[train_val_or_test],
+                                                shapes_of_bufs_per_mode[train_val_or_test])]
+    return arrs_per_mode
+
+
+# Set in each worker of the pool by init_sampling_proc().
+_args_for_sampling_per_mode = None
+_bufs_of_samples_per_mode = None
+
+
+def init_sampling_proc(args_for_sampling_per_mode=None, raw_bufs_per_mode=None, shapes_of_bufs_per_mode=None,
+                       n_workers_started=None):
     # This will make child-processes ignore the KeyboardInterupt (sigInt). Parent will handle it.
     # See: http://stackoverflow.com/questions/11312525/catch-ctrlc-sigint-and-exit-multiprocesses-gracefully-in-python/35134329#35134329
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Forked workers inherit the random state of the parent. Re-seed, otherwise all workers sample the same.
+    random.seed()
+    np.random.seed()
+    global _args_for_sampling_per_mode, _bufs_of_samples_per_mode
+    _args_for_sampling_per_mode = args_for_sampling_per_mode
+    if raw_bufs_per_mode is not None:
+        _bufs_of_samples_per_mode = get_arrs_from_raw_bufs(raw_bufs_per_mode, shapes_of_bufs_per_mode)
+    if n_workers_started is not None:  # Counts starts of workers of PoolForSampling. See any_worker_died()
+        with n_workers_started.get_lock():
+            n_workers_started.value += 1
+
+
+def sample_subj_in_worker(args_of_job):
+    # Called in a worker of the pool. Combines the args of the job with those the worker was given at start.
+    # Returns: (job_idx, number of samples extracted and written in the shared buffers)
+    (train_val_or_test,
+     job_idx,
+     n_subjs_for_subep,
+     idxs_of_subjs_for_subep,
+     n_samples_per_subj,
+     idx_first_sample_per_subj) = args_of_job
+    (log,
+     _,
+     run_input_checks,
+     cnn3d,
+     _, _,  # max_n_cases_per_subep, n_samples_per_subep. Not needed per job.
+     sampling_type,
+     paths_per_chan_per_subj,
+     paths_to_lbls_per_subj,
+     paths_to_masks_per_subj,
+     paths_to_wmaps_per_sampl_cat_per_subj,
+     pad_input_imgs,
+     norm_prms,
+     augm_img_prms,
+     augm_sample_prms,
+     folder_cache,
+     _) = _args_for_sampling_per_mode[train_val_or_test]  # precision_samples. Buffers already have the dtypes.
+    n_samples_extracted = load_subj_and_sample(job_idx,
+                                               log,
+                                               train_val_or_test,
+                                               run_input_checks,
+                                               cnn3d,
+                                               sampling_type,
+                                               paths_per_chan_per_subj,
+                                               paths_to_lbls_per_subj,
+                                               paths_to_masks_per_subj,
+                                               paths_to_wmaps_per_sampl_cat_per_subj,
+                                               pad_input_imgs,
+                                               norm_prms,
+                                               augm_img_prms,
+                                               augm_sample_prms,
+                                               folder_cache,
+                                               n_subjs_for_subep,
+                                               idxs_of_subjs_for_subep,
+                                               n_samples_per_subj,
+                                               idx_first_sample_per_subj,
+                                               _bufs_of_samples_per_mode[train_val_or_test])
+    return (job_idx, n_samples_extracted)
 
 
 def choose_random_subjects(n_total_subjects,
@@ -253,51 +463,45 @@ def load_subj_and_sample(job_idx,
                          norm_prms,
                          augm_img_prms,
                          augm_sample_prms,
+                         folder_cache,
                          n_subjs_for_subep,
                          idxs_of_subjs_for_subep,
-                         n_samples_per_subj):
+                         n_samples_per_subj,
+                         idx_first_sample_per_subj,
+                         bufs_of_samples):
     # train_val_or_test: 'train', 'val' or 'test'
     # paths_per_chan_per_subj: [[ for chan-0 [ one path per subj ]], ..., [for chan-n  [ one path per subj ] ]]
-    # n_samples_per_cat_per_subj: np arr, shape [num sampling categories, num subjects in subepoch]
-    # returns: ( channs_of_samples_per_path, lbls_predicted_part_of_samples )
+    # n_samples_per_subj: np arr, shape [num subjects in subepoch]
+    # idx_first_sample_per_subj: np arr, shape [num subjects in subepoch]. Where to write the samples in the buffers.
+    # bufs_of_samples: List of arrays, from get_shapes_of_bufs_of_samples(). Samples are written in them.
+    # returns: Number of samples extracted. Written in bufs_of_samples[:][idx_first_sample : idx_first_sample + n]
     job_id = "[TRA|JOB:" + str(job_idx) + "|PID:" + str(os.getpid()) + "]" if train_val_or_test == 'train' \
         else "[VAL|JOB:" + str(job_idx) + "|PID:" + str(os.getpid()) + "]"
     
     log.print3(job_id + " Started. (#" + str(job_idx) + "/" + str(n_subjs_for_subep) + ") sampling job. " +
                "Load & sample from subject of index (in user's list): " + str(idxs_of_subjs_for_subep[job_idx]) )
 
-    # List, with [numberOfPathwaysThatTakeInput] sublists.
-    # Each sublist is list of [partImagesLoadedPerSubepoch] arrays [channels, R,C,Z].
-    channs_of_samples_per_path = [[] for i in range(cnn3d.getNumPathwaysThatRequireInput())]
-    lbls_predicted_part_of_samples = []  # Labels only for the central/predicted part of segments.
+    idx_next_sample = idx_first_sample_per_subj[job_idx]  # Where to write next sample in the buffers.
 
     dims_hres_segment = cnn3d.pathways[0].getShapeOfInput(train_val_or_test)[2:]
     
-    # Load images of subject
-    time_load_0 = time.time()
+    # Load and pre-process images of subject. Or load them (memory-mapped) from the cache, if cached before.
     (channels,  # nparray [channels,dim0,dim1,dim2]
      gt_lbl_img,
      roi_mask,
-     wmaps_to_sample_per_cat) = load_imgs_of_subject(log, job_id,
-                                                     idxs_of_subjs_for_subep[job_idx],
-                                                     paths_per_chan_per_subj,
-                                                     paths_to_lbls_per_subj,
-                                                     paths_to_wmaps_per_sampl_cat_per_subj,
-                                                     paths_to_masks_per_subj)
-     
-    # Pre-process images of subject
-    time_load = time.time() - time_load_0
-    time_prep_0 = time.time()
-    (channels,
-    gt_lbl_img,
-    roi_mask,
-    wmaps_to_sample_per_cat,
-    pad_left_right_per_axis) = preproc_imgs_of_subj(log, job_id,
-                                                    channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat,
-                                                    run_input_checks, cnn3d.num_classes, # checks
-                                                    pad_input_imgs, cnn3d.recFieldCnn, dims_hres_segment, # pad
-                                                    norm_prms)
-    time_prep = time.time() - time_prep_0
+     wmaps_to_sample_per_cat,
+     pad_left_right_per_axis,
+     time_load,
+     time_prep) = load_and_preproc_imgs_of_subj(log, job_id,
+                                                idxs_of_subjs_for_subep[job_idx],
+                                                paths_per_chan_per_subj,
+                                                paths_to_lbls_per_subj,
+                                                paths_to_wmaps_per_sampl_cat_per_subj,
+                                                paths_to_masks_per_subj,
+                                                run_input_checks, cnn3d.num_classes, # checks
+                                                pad_input_imgs, cnn3d.recFieldCnn, dims_hres_segment, # pad
+                                                norm_prms,
+                                                folder_cache)
     
     # Augment at image level:
     time_augm_0 = time.time()
@@ -313,20 +517,47 @@ def load_subj_and_sample(job_idx,
 
     # Sampling of segments (sub-volumes) from an image.
     dims_of_scan = channels[0].shape
-    sampling_maps_per_cat = sampling_type.derive_sampling_maps_per_cat(wmaps_to_sample_per_cat,
-                                                                       gt_lbl_img,
-                                                                       roi_mask,
-                                                                       dims_of_scan)
+    # If the subject is cached and not deformed by augmentation, the voxels to sample from each category are...
+    # ... indexed once and cached with it. Then the sampling maps do not need to be derived every subepoch.
+    use_sampling_idx = folder_cache is not None and (augm_img_prms is None or augm_img_prms['affine'] is None)
+    sampling_idx_per_cat = None
+    if use_sampling_idx:
+        cache_key = get_cache_key_of_subj(idxs_of_subjs_for_subep[job_idx],
+                                          paths_per_chan_per_subj,
+                                          paths_to_lbls_per_subj,
+                                          paths_to_masks_per_subj,
+                                          paths_to_wmaps_per_sampl_cat_per_subj,
+                                          pad_input_imgs, cnn3d.recFieldCnn, dims_hres_segment,
+                                          norm_prms)
+        sampling_idx_per_cat = load_sampling_idx_from_cache(folder_cache, cache_key,
+                                                            sampling_type.get_type_as_int(),
+                                                            sampling_type.get_n_sampling_cats())
+    if sampling_idx_per_cat is None:
+        sampling_maps_per_cat = sampling_type.derive_sampling_maps_per_cat(wmaps_to_sample_per_cat,
+                                                                           gt_lbl_img,
+                                                                           roi_mask,
+                                                                           dims_of_scan)
+        if use_sampling_idx:
+            sampling_idx_per_cat = [get_sampling_idx_of_map(dims_hres_segment, dims_of_scan, sampling_map)
+                                    for sampling_map in sampling_maps_per_cat]
+            save_sampling_idx_to_cache(folder_cache, cache_key, sampling_type.get_type_as_int(), sampling_idx_per_cat)
+            
+    # The below is a list of booleans, where False if a category has nothing to sample from.
+    if sampling_idx_per_cat is not None:
+        valid_cats = [len(vox_idxs) > 0 and (cum_weights is None or cum_weights[-1] > 0)
+                      for (vox_idxs, cum_weights) in sampling_idx_per_cat]
+    else:
+        valid_cats = [np.sum(sampling_map) > 0 for sampling_map in sampling_maps_per_cat]
 
     # Get number of samples per sampling-category for the specific subject (class, foregr/backgr, etc)
-    (n_samples_per_cat, valid_cats) = sampling_type.distribute_n_samples_to_categs(n_samples_per_subj[job_idx],
-                                                                                   sampling_maps_per_cat)
+    n_samples_per_cat = sampling_type.distribute_n_samples_to_categs(n_samples_per_subj[job_idx], valid_cats)
 
     str_samples_per_cat = " Done. Samples per category: "
+    time_extr_samples = 0
+    time_augm_samples = 0
     for cat_i in range(sampling_type.get_n_sampling_cats()):
         cat_str = sampling_type.get_sampling_cats_as_str()[cat_i]
         n_samples_for_cat = n_samples_per_cat[cat_i]
-        sampling_map = sampling_maps_per_cat[cat_i]
         # Check if the class is valid for sampling.
         # Invalid if eg there is no such class in the subject's manual segmentation.
         if not valid_cats[cat_i]:
@@ -335,46 +566,62 @@ def load_subj_and_sample(job_idx,
             assert n_samples_for_cat == 0
             continue # This should not be needed, the next func should also handle it. But whatever.
             
-        (idxs_sampl_centers,
-         slice_idxs_sampl_segms) = sample_idxs_of_segments(log,
-                                                           job_id,
-                                                           n_samples_for_cat,
-                                                           dims_hres_segment,
-                                                           dims_of_scan,
-                                                           sampling_map)
-        str_samples_per_cat += "[" + cat_str + ": " + str(len(idxs_sampl_centers[0])) + "/" + str(n_samples_for_cat) + "] "
+        if sampling_idx_per_cat is not None:
+            (idxs_sampl_centers,
+             slice_idxs_sampl_segms) = sample_idxs_of_segments_from_idx(log,
+                                                                        job_id,
+                                                                        n_samples_for_cat,
+                                                                        dims_hres_segment,
+                                                                        dims_of_scan,
+                                                                        *sampling_idx_per_cat[cat_i])
+        else:
+            (idxs_sampl_centers,
+             slice_idxs_sampl_segms) = sample_idxs_of_segments(log,
+                                                               job_id,
+                                                               n_samples_for_cat,
+                                                               dims_hres_segment,
+                                                               dims_of_scan,
+                                                               sampling_maps_per_cat[cat_i])
+        n_samples_extracted_for_cat = len(idxs_sampl_centers[0])
+        str_samples_per_cat += "[" + cat_str + ": " + str(n_samples_extracted_for_cat) + "/" + str(n_samples_for_cat) + "] "
+        if n_samples_extracted_for_cat == 0:
+            continue
 
         # Use the just sampled coordinates of slices to actually extract the segments (data) from the subject's images.
-        time_augm_samples = 0
-        for image_part_i in range(len(idxs_sampl_centers[0])):
-            coord_center = idxs_sampl_centers[:, image_part_i]
-            
-            (channs_of_sample_per_path,
-             lbls_predicted_part_of_sample) = extractSegmentGivenSliceCoords(train_val_or_test,
-                                                                             cnn3d,
-                                                                             coord_center,
-                                                                             channels,
-                                                                             gt_lbl_img)
-
-            # Augmentation of segments
-            time_augm_sample_0 = time.time()
-            (channs_of_sample_per_path,
-             lbls_predicted_part_of_sample) = augment_sample(channs_of_sample_per_path,
-                                                             lbls_predicted_part_of_sample,
-                                                             augm_sample_prms)
-            time_augm_samples += time.time() - time_augm_sample_0
-            
-            for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()):
-                channs_of_samples_per_path[pathway_i].append(channs_of_sample_per_path[pathway_i])
-            lbls_predicted_part_of_samples.append(lbls_predicted_part_of_sample)
+        # All segments of the category are extracted at once, directly in the buffers.
+        time_extr_samples_0 = time.time()
+        extract_segments_to_bufs(train_val_or_test,
+                                 cnn3d,
+                                 idxs_sampl_centers,
+                                 channels,
+                                 gt_lbl_img,
+                                 bufs_of_samples,
+                                 idx_next_sample)
+        time_extr_samples += time.time() - time_extr_samples_0
+
+        # Augmentation of segments. Different random augmentation per segment. Done in place in the buffers.
+        time_augm_sample_0 = time.time()
+        if augm_sample_prms is not None:
+            for idx_sample in range(idx_next_sample, idx_next_sample + n_samples_extracted_for_cat):
+                (channs_of_sample_per_path,
+                 lbls_predicted_part_of_sample) = augment_sample([buf[idx_sample] for buf in bufs_of_samples[:-1]],
+                                                                 bufs_of_samples[-1][idx_sample],
+                                                                 augm_sample_prms)
+                for pathway_i in range(cnn3d.getNumPathwaysThatRequireInput()):
+                    bufs_of_samples[pathway_i][idx_sample] = channs_of_sample_per_path[pathway_i]
+                bufs_of_samples[-1][idx_sample] = lbls_predicted_part_of_sample  # Labels of predicted part.
+        time_augm_samples += time.time() - time_augm_sample_0
+        
+        idx_next_sample += n_samples_extracted_for_cat
         
     log.print3(job_id + str_samples_per_cat)
     log.print3(job_id + " TIMING: " +
                "[Load: {0:.1f}".format(time_load) + "] "
                "[Preproc: {0:.1f}".format(time_prep) + "] " +
                "[Augm-Img: {0:.1f}".format(time_augm_img) + "] " +
+               "[Extract-Samples: {0:.1f}".format(time_extr_samples) + "] " +
                "[Augm-Samples: {0:.1f}".format(time_augm_samples) + "] secs")
-    return (channs_of_samples_per_path, lbls_predicted_part_of_samples)
+    return idx_next_sample - idx_first_sample_per_subj[job_idx]
 
 
 # roi_mask_filename and roiMinusLesion_mask_filename can be passed "no".
@@ -407,7 +654,9 @@ def load_imgs_of_subject(log,
             if channels is None:
                 # Initialize the array in which all the channels for the patient will be placed.
                 inp_chan_dims = list(channelData.shape)
-                channels = np.zeros((numberOfNormalScaleChannels, inp_chan_dims[0], inp_chan_dims[1], inp_chan_dims[2]))
+                # float32, as the input of the cnn. Half the RAM of float64 for the whole volumes.
+                channels = np.zeros((numberOfNormalScaleChannels, inp_chan_dims[0], inp_chan_dims[1], inp_chan_dims[2]),
+                                    dtype="float32")
 
             channels[channel_i] = channelData
         else:  # "-" was given in the config-listing file. Do Min-fill!
@@ -478,37 +727,76 @@ def preproc_imgs_of_subj(log, job_id, channels, gt_lbl_img, roi_mask, wmaps_to_s
     return channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis
 
 
-# made for 3d
-def sample_idxs_of_segments(log,
-                            job_id,
-                            n_samples,
-                            dims_of_segment,
-                            dims_of_scan,
-                            sampling_map):
-    """
-    Returns: [ idxs_of_sampled_centers, slice_idxs_of_sampled_segms ]
-             Coordinates (xyz indices) of the "central" voxel of sampled segments (1 voxel to the left if dimension is even).
-             Also returns the indices of the image parts, left and right indices, INCLUSIVE BOTH SIDES.
-    
-    > idxs_of_sampled_centers: array with shape: 3(xyz) x n_samples.
-        Example: [ xCoordsForCentralVoxelOfEachPart, yCoordsForCentralVoxelOfEachPart, zCoordsForCentralVoxelOfEachPart ]
-        >> x/y/z-CoordsForCentralVoxelOfEachPart: 1-dim array with n_samples, holding the x-indices of samples in image.
-    > slice_idxs_of_sampled_segms: 3(xyz) x NumberOfImagePartSamples x 2.
-        The last dimension has [0] for the lower boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
-        Example: [ x-sliceCoordsOfImagePart, y-sliceCoordsOfImagePart, z-sliceCoordsOfImagePart ]
-    """
-    # Check if the weight map is fully-zeros. In this case, return no element.
-    # Note: Currently, the caller function is checking this case already and does not let this being called.
-    # Which is still fine.
-    if np.isclose(np.sum(sampling_map), 0.):
-        log.print3(job_id + " WARN: Sampling map for category is just zeros! " +\
-                   " No samples for category from subject!")
-        return [[[], [], []], [[], [], []]]
+def load_and_preproc_imgs_of_subj(log, job_id, subj_i,
+                                  paths_per_chan_per_subj,
+                                  paths_to_lbls_per_subj,
+                                  paths_to_wmaps_per_sampl_cat_per_subj,
+                                  paths_to_masks_per_subj,
+                                  run_input_checks, n_classes,
+                                  pad_input_imgs, dims_rec_field, dims_hres_segment,
+                                  norm_prms,
+                                  folder_cache):
+    # Used by both the sampling (training/validation) and the inference on whole volumes.
+    # folder_cache: None, or folder where pre-processed subjects are cached. See dataManagement/cache.py
+    #     If the subject has been cached before, its arrays are returned memory-mapped (copy-on-write) from the cache.
+    #     This way only the parts of the volumes that are read (eg sampled segments) get loaded in RAM.
+    # Returns: channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis, as in...
+    #          ... preproc_imgs_of_subj(), and the time it took to load and to pre-process.
+    time_load_0 = time.time()
+    preproc_subj = None
+    if folder_cache is not None:
+        cache_key = get_cache_key_of_subj(subj_i,
+                                          paths_per_chan_per_subj,
+                                          paths_to_lbls_per_subj,
+                                          paths_to_masks_per_subj,
+                                          paths_to_wmaps_per_sampl_cat_per_subj,
+                                          pad_input_imgs, dims_rec_field, dims_hres_segment,
+                                          norm_prms)
+        preproc_subj = load_preproc_subj_from_cache(folder_cache, cache_key, mmap=True)
+
+    if preproc_subj is not None:
+        log.print3(job_id + " Loaded pre-processed subject from cache: " + str(folder_cache) + "/" + cache_key)
+        (channels,
+         gt_lbl_img,
+         roi_mask,
+         wmaps_to_sample_per_cat,
+         pad_left_right_per_axis) = preproc_subj
+        if run_input_checks:
+            check_gt_vs_num_classes(log, job_id, gt_lbl_img, n_classes)
+        return (channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis,
+                time.time() - time_load_0, 0)
 
-    # Now out of these, I need to randomly select one, which will be an ImagePart's central voxel.
-    # But I need to be CAREFUL and get one that IS NOT closer to the image boundaries than the dimensions of the
-    # ImagePart permit.
+    (channels,  # nparray [channels,dim0,dim1,dim2]
+     gt_lbl_img,
+     roi_mask,
+     wmaps_to_sample_per_cat) = load_imgs_of_subject(log, job_id,
+                                                     subj_i,
+                                                     paths_per_chan_per_subj,
+                                                     paths_to_lbls_per_subj,
+                                                     paths_to_wmaps_per_sampl_cat_per_subj,
+                                                     paths_to_masks_per_subj)
+    time_load = time.time() - time_load_0
+
+    time_prep_0 = time.time()
+    (channels,
+     gt_lbl_img,
+     roi_mask,
+     wmaps_to_sample_per_cat,
+     pad_left_right_per_axis) = preproc_imgs_of_subj(log, job_id,
+                                                     channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat,
+                                                     run_input_checks, n_classes, # checks
+                                                     pad_input_imgs, dims_rec_field, dims_hres_segment, # pad
+                                                     norm_prms)
+    if folder_cache is not None:
+        save_preproc_subj_to_cache(folder_cache, cache_key,
+                                   channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat,
+                                   pad_left_right_per_axis)
+    time_prep = time.time() - time_prep_0
 
+    return channels, gt_lbl_img, roi_mask, wmaps_to_sample_per_cat, pad_left_right_per_axis, time_load, time_prep
+
+
+def get_n_vox_excl_left_right(dims_of_segment):
     # I look for lesions that are not closer to the image boundaries than the ImagePart dimensions allow.
     # KernelDim is always odd. BUT ImagePart dimensions can be odd or even.
     # If odd, ok, floor(dim/2) from central.
@@ -521,15 +809,6 @@ def sample_idxs_of_segments(log,
     # ...the center of a segment. So that the segment will be fully contained in the image. (half segm left & right)
     # dim1: 1 row per r,c,z. Dim2: left/right width not to sample from (=half segment).
     n_vox_excl_left_right = np.zeros((len(dims_of_segment), 2), dtype='int32')
-
-    # The below starts all zero. Will be Multiplied by other true-false arrays expressing if the relevant
-    # voxels are within boundaries.
-    # In the end, the final vector will be true only for the indices of lesions that are within all boundaries.
-    mask_excl_near_edges = np.zeros(sampling_map.shape, dtype="int32")
-
-    # This loop leads to mask_excl_near_edges to be true for the indices ...
-    # ...that allow getting an imagePart CENTERED on them, and be safely within image boundaries. Note that ...
-    # ... if the imagePart is of even dimension, the "central" voxel is one voxel to the left.
     for rcz_i in range(len(dims_of_segment)):
         if dims_of_segment[rcz_i] % 2 == 0:  # even
             dims_div_2 = dims_of_segment[rcz_i] // 2
@@ -541,35 +820,75 @@ def sample_idxs_of_segments(log,
             n_vox_excl_left_right[rcz_i] = [dims_div_2_floor, dims_div_2_floor]
             # used to be [n_vox_excl_left_right[0][0]: -n_vox_excl_left_right[0][1]],
             # but in 2D case n_vox_excl_left_right might be ==0, causes problem and you get a null slice.
-    mask_excl_near_edges[
+    return n_vox_excl_left_right
+
+
+# made for 3d
+def sample_idxs_of_segments(log,
+                            job_id,
+                            n_samples,
+                            dims_of_segment,
+                            dims_of_scan,
+                            sampling_map):
+    """
+    Returns: [ idxs_of_sampled_centers, slice_idxs_of_sampled_segms ]
+             Coordinates (xyz indices) of the "central" voxel of sampled segments (1 voxel to the left if dimension is even).
+             Also returns the indices of the image parts, left and right indices, INCLUSIVE BOTH SIDES.
+    
+    > idxs_of_sampled_centers: array with shape: 3(xyz) x n_samples.
+        Example: [ xCoordsForCentralVoxelOfEachPart, yCoordsForCentralVoxelOfEachPart, zCoordsForCentralVoxelOfEachPart ]
+        >> x/y/z-CoordsForCentralVoxelOfEachPart: 1-dim array with n_samples, holding the x-indices of samples in image.
+    > slice_idxs_of_sampled_segms: 3(xyz) x NumberOfImagePartSamples x 2.
+        The last dimension has [0] for the lower boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
+        Example: [ x-sliceCoordsOfImagePart, y-sliceCoordsOfImagePart, z-sliceCoordsOfImagePart ]
+    """
+    # Now out of these, I need to randomly select one, which will be an ImagePart's central voxel.
+    # But I need to be CAREFUL and get one that IS NOT closer to the image boundaries than the dimensions of the
+    # ImagePart permit.
+
+    n_vox_excl_left_right = get_n_vox_excl_left_right(dims_of_segment)
+
+    # The part of the map that allows getting an imagePart CENTERED on its voxels, safely within image boundaries.
+    # Note that if the imagePart is of even dimension, the "central" voxel is one voxel to the left.
+    # Slicing gives a view. The voxels near the edges are excluded without building a mask of the whole volume.
+    sampling_map_excl_near_edges = sampling_map[
         n_vox_excl_left_right[0][0]: dims_of_scan[0] - n_vox_excl_left_right[0][1],
         n_vox_excl_left_right[1][0]: dims_of_scan[1] - n_vox_excl_left_right[1][1],
-        n_vox_excl_left_right[2][0]: dims_of_scan[2] - n_vox_excl_left_right[2][1]] = 1
-
-    sampling_map_excl_near_edges = sampling_map * mask_excl_near_edges
-    # normalize the probabilities to sum to 1, cause the function needs it as so.
-    sum_sampl_map = np.sum(sampling_map_excl_near_edges)
-    if np.isclose(sum_sampl_map, 0.) : # is zero
+        n_vox_excl_left_right[2][0]: dims_of_scan[2] - n_vox_excl_left_right[2][1]]
+
+    # A voxel is sampled with probability proportional to its weight: Draw uniformly in [0, sum of weights) and...
+    # ... find where it falls in the cumulative sum of the weights (binary search). This is what...
+    # ... np.random.choice(p=...) does internally, but without a normalized and flattened copy of the volume.
+    # If the map is sparse (eg lesion classes), only its non-zero voxels are considered. Otherwise (eg background),...
+    # ... finding the non-zero voxels costs more than the cumulative sum over the whole map.
+    n_nonzero_vox = np.count_nonzero(sampling_map_excl_near_edges)
+    if n_nonzero_vox < sampling_map_excl_near_edges.size // 4:
+        idxs_of_candidate_vox = np.nonzero(sampling_map_excl_near_edges) # tuple of 3(rcz) arrays.
+        cum_weights = np.cumsum(sampling_map_excl_near_edges[idxs_of_candidate_vox], dtype="float64")
+    else:
+        idxs_of_candidate_vox = None
+        cum_weights = np.cumsum(sampling_map_excl_near_edges, dtype="float64") # Flattened, C order.
+    if n_nonzero_vox == 0 or np.isclose(cum_weights[-1], 0.):
         log.print3(job_id + " WARN: AFTER EXCLUDING NEAR EDGES, sampling map for category is just zeros! " +\
                    " No samples for category from subject!")
         return [ [[],[],[]], [[],[],[]] ]
-    
-    sampling_map_excl_near_edges = sampling_map_excl_near_edges / (1.0 * sum_sampl_map)
-    sampling_map_excl_near_edges_flat = sampling_map_excl_near_edges.flatten()
-
-    # This is going to be a 3xNumberOfImagePartSamples array.
-    idxs_of_flat_map_sampled_as_centers = np.random.choice(
-        sampling_map_excl_near_edges.size,
-        size=n_samples,
-        replace=True,
-        p=sampling_map_excl_near_edges_flat)
-    # np.unravel_index([listOfIndicesInFlattened], dims) returns a tuple of arrays (eg 3 of them if 3 dimImage), 
-    # where each of the array in the tuple has the same shape as the listOfIndices. 
-    # They have the r/c/z coords that correspond to the index of the flattened version.
-    # So, idxs_of_sampled_centers will be array of shape: 3(rcz) x n_samples.
-    idxs_of_sampled_centers = np.asarray(np.unravel_index(idxs_of_flat_map_sampled_as_centers,
-                                                            sampling_map_excl_near_edges.shape)
-                                          )
+
+    idxs_of_candidates_sampled = np.searchsorted(cum_weights,
+                                                 np.random.uniform(0., cum_weights[-1], size=n_samples),
+                                                 side='right')
+    # Guard against floating point rounding at the right end.
+    idxs_of_candidates_sampled = np.minimum(idxs_of_candidates_sampled, len(cum_weights) - 1)
+    if idxs_of_candidate_vox is None:
+        # np.unravel_index([listOfIndicesInFlattened], dims) returns a tuple of arrays (eg 3 of them if 3 dimImage),
+        # where each of the array in the tuple has the same shape as the listOfIndices.
+        # They have the r/c/z coords that correspond to the index of the flattened version.
+        idxs_of_candidate_vox = np.unravel_index(idxs_of_candidates_sampled, sampling_map_excl_near_edges.shape)
+    else:
+        idxs_of_candidate_vox = [idxs_of_candidate_vox[rcz_i][idxs_of_candidates_sampled] for rcz_i in range(3)]
+    # Add back the excluded voxels at the beginning of each axis, to get coords in the whole image.
+    # idxs_of_sampled_centers will be array of shape: 3(rcz) x n_samples.
+    idxs_of_sampled_centers = np.asarray([idxs_of_candidate_vox[rcz_i] + n_vox_excl_left_right[rcz_i][0]
+                                          for rcz_i in range(len(dims_of_segment))])
     # Array with shape: 3(rcz) x NumberOfImagePartSamples x 2.
     # Last dimension has [0] for lowest boundary of slice, and [1] for highest boundary. INCLUSIVE BOTH SIDES.
     slice_idxs_of_sampled_segms = np.zeros(list(idxs_of_sampled_centers.shape) + [2], dtype="int32")
@@ -584,218 +903,204 @@ def sample_idxs_of_segments(log,
     return (idxs_of_sampled_centers, slice_idxs_of_sampled_segms)
 
 
-def getImagePartFromSubsampledImageForTraining(dimsOfPrimarySegment,
-                                               recFieldCnn,
-                                               subsampledImageChannels,
-                                               image_part_slices_coords,
-                                               subSamplingFactor,
-                                               subsampledImagePartDimensions
-                                               ):
-    """
-    This returns an image part from the sampled data, given the image_part_slices_coords,
-    which has the coordinates where the normal-scale image part starts and ends (inclusive).
-    (Actually, in this case, the right (end) part of image_part_slices_coords is not used.)
-    
-    The way it works is NOT optimal. From the beginning of the normal-resolution part,
-    it goes further to the left 1 receptive-field and then forward xSubsamplingFactor receptive-fields.
-    This stops it from being used with arbitrary size of subsampled segment (decoupled by the high-res segment).
-    Now, the subsampled patch has to be of the same size as the normal-scale.
-    To change this, I should find where THE FIRST TOP LEFT CENTRAL (predicted) VOXEL is, 
-    and do the back-one-(sub)patch + front-3-(sub)patches from there, not from the begining of the patch.
-    
-    Current way it works (correct):
-    If I have eg subsample factor=3 and 9 central-pred-voxels, I get 3 "central" voxels/patches for the
-    subsampled-part. Straightforward. If I have a number of central voxels that is not an exact multiple of
-    the subfactor, eg 10 central-voxels, I get 3+1 central voxels in the subsampled-part. 
-    When the cnn is convolving them, they will get repeated to 4(last-layer-neurons)*3(factor) = 12, 
-    and will get sliced down to 10, in order to have same dimension with the 1st pathway.
-    """
-    subsampledImageDimensions = subsampledImageChannels[0].shape
-
-    subsampledChannelsForThisImagePart = np.ones((len(subsampledImageChannels),
-                                                  subsampledImagePartDimensions[0],
-                                                  subsampledImagePartDimensions[1],
-                                                  subsampledImagePartDimensions[2]),
-                                                 dtype='float32')
-
-    numberOfCentralVoxelsClassifiedForEachImagePart_rDim = dimsOfPrimarySegment[0] - recFieldCnn[0] + 1
-    numberOfCentralVoxelsClassifiedForEachImagePart_cDim = dimsOfPrimarySegment[1] - recFieldCnn[1] + 1
-    numberOfCentralVoxelsClassifiedForEachImagePart_zDim = dimsOfPrimarySegment[2] - recFieldCnn[2] + 1
-
-    # Calculate the slice that I should get, and where I should put it in the imagePart
-    # (eg if near the borders, and I cant grab a whole slice-imagePart).
-    rSlotsPreviously = ((subSamplingFactor[0] - 1) // 2) * recFieldCnn[0] if subSamplingFactor[0] % 2 == 1 \
-        else (subSamplingFactor[0] - 2) // 2 * recFieldCnn[0] + recFieldCnn[0] // 2
-    cSlotsPreviously = ((subSamplingFactor[1] - 1) // 2) * recFieldCnn[1] if subSamplingFactor[1] % 2 == 1 \
-        else (subSamplingFactor[1] - 2) // 2 * recFieldCnn[1] + recFieldCnn[1] // 2
-    zSlotsPreviously = ((subSamplingFactor[2] - 1) // 2) * recFieldCnn[2] if subSamplingFactor[2] % 2 == 1 \
-        else (subSamplingFactor[2] - 2) // 2 * recFieldCnn[2] + recFieldCnn[2] // 2
-    # 1*17
-    rToCentralVoxelOfAnAveragedArea = subSamplingFactor[0] // 2 if subSamplingFactor[0] % 2 == 1 else (
-                subSamplingFactor[
-                    0] // 2 - 1)  # one closer to the beginning of dim. Same happens when I get parts of image.
-    cToCentralVoxelOfAnAveragedArea = subSamplingFactor[1] // 2 if subSamplingFactor[1] % 2 == 1 else (
-                subSamplingFactor[1] // 2 - 1)
-    zToCentralVoxelOfAnAveragedArea = subSamplingFactor[2] // 2 if subSamplingFactor[2] % 2 == 1 else (
-                subSamplingFactor[2] // 2 - 1)
-    # This is where to start taking voxels from the subsampled image. From the beginning of the imagePart(1 st patch)...
-    # ... go forward a few steps to the voxel that is like the "central" in this subsampled (eg 3x3) area.
-    # ...Then go backwards -Patchsize to find the first voxel of the subsampled.
-
-    # These indices can run out of image boundaries. I ll correct them afterwards.
-    rlow = image_part_slices_coords[0][0] + rToCentralVoxelOfAnAveragedArea - rSlotsPreviously
-    # If the patch is 17x17, I want a 17x17 subsampled Patch. BUT if the imgPART is 25x25 (9voxClass),
-    # I want 3 subsampledPatches in my subsampPart to cover this area!
-    # That is what the last term below is taking care of.
-    # CAST TO INT because ceil returns a float, and later on when computing
-    # rHighNonInclToPutTheNotPaddedInSubsampledImPart I need to do INTEGER DIVISION.
-    rhighNonIncl = int(rlow + subSamplingFactor[0] * recFieldCnn[0] + (
-                math.ceil((numberOfCentralVoxelsClassifiedForEachImagePart_rDim * 1.0) / subSamplingFactor[0]) - 1) *
-                       subSamplingFactor[0])  # excluding index in segment
-    clow = image_part_slices_coords[1][0] + cToCentralVoxelOfAnAveragedArea - cSlotsPreviously
-    chighNonIncl = int(clow + subSamplingFactor[1] * recFieldCnn[1] + (
-                math.ceil((numberOfCentralVoxelsClassifiedForEachImagePart_cDim * 1.0) / subSamplingFactor[1]) - 1) *
-                       subSamplingFactor[1])
-    zlow = image_part_slices_coords[2][0] + zToCentralVoxelOfAnAveragedArea - zSlotsPreviously
-    zhighNonIncl = int(zlow + subSamplingFactor[2] * recFieldCnn[2] + (
-                math.ceil((numberOfCentralVoxelsClassifiedForEachImagePart_zDim * 1.0) / subSamplingFactor[2]) - 1) *
-                       subSamplingFactor[2])
-
-    rlowCorrected = max(rlow, 0)
-    clowCorrected = max(clow, 0)
-    zlowCorrected = max(zlow, 0)
-    rhighNonInclCorrected = min(rhighNonIncl, subsampledImageDimensions[0])
-    chighNonInclCorrected = min(chighNonIncl, subsampledImageDimensions[1])
-    zhighNonInclCorrected = min(zhighNonIncl, subsampledImageDimensions[2])  # This gave 7
-
-    rLowToPutTheNotPaddedInSubsampledImPart = 0 if rlow >= 0 else abs(rlow) // subSamplingFactor[0]
-    cLowToPutTheNotPaddedInSubsampledImPart = 0 if clow >= 0 else abs(clow) // subSamplingFactor[1]
-    zLowToPutTheNotPaddedInSubsampledImPart = 0 if zlow >= 0 else abs(zlow) // subSamplingFactor[2]
-
-    dimensionsOfTheSliceOfSubsampledImageNotPadded = [
-        int(math.ceil((rhighNonInclCorrected - rlowCorrected) * 1.0 / subSamplingFactor[0])),
-        int(math.ceil((chighNonInclCorrected - clowCorrected) * 1.0 / subSamplingFactor[1])),
-        int(math.ceil((zhighNonInclCorrected - zlowCorrected) * 1.0 / subSamplingFactor[2]))
-        ]
-
-    # I now have exactly where to get the slice from and where to put it in the new array.
-    for channel_i in range(len(subsampledImageChannels)):
-        intensityZeroOfChannel = calc_border_int_of_3d_img(subsampledImageChannels[channel_i])
-        subsampledChannelsForThisImagePart[channel_i] *= intensityZeroOfChannel
-
-        sliceOfSubsampledImageNotPadded = subsampledImageChannels[channel_i][
-                                          rlowCorrected: rhighNonInclCorrected: subSamplingFactor[0],
-                                          clowCorrected: chighNonInclCorrected: subSamplingFactor[1],
-                                          zlowCorrected: zhighNonInclCorrected: subSamplingFactor[2]
-                                          ]
-        subsampledChannelsForThisImagePart[
-            channel_i,
-            rLowToPutTheNotPaddedInSubsampledImPart: rLowToPutTheNotPaddedInSubsampledImPart +
-                                                     dimensionsOfTheSliceOfSubsampledImageNotPadded[0],
-            cLowToPutTheNotPaddedInSubsampledImPart: cLowToPutTheNotPaddedInSubsampledImPart +
-                                                     dimensionsOfTheSliceOfSubsampledImageNotPadded[1],
-            zLowToPutTheNotPaddedInSubsampledImPart: zLowToPutTheNotPaddedInSubsampledImPart +
-                                                     dimensionsOfTheSliceOfSubsampledImageNotPadded[2]
-            ] = sliceOfSubsampledImageNotPadded
-
-    # placeholderReturn = np.ones([3,19,19,19], dtype="float32") #channel, dims
-    return subsampledChannelsForThisImagePart
-
-
-def shuffle_samples(channs_of_samples_per_path, lbls_predicted_part_of_samples):
-    n_paths_taking_inp = len(channs_of_samples_per_path)
-    inp_to_zip = [sublist_for_path for sublist_for_path in channs_of_samples_per_path]
-    inp_to_zip += [lbls_predicted_part_of_samples]
-
-    combined = list(zip(*inp_to_zip))  # list() for python3 compatibility, as range cannot get assignment in shuffle()
-    random.shuffle(combined)
-    sublists_with_shuffled_samples = list(zip(*combined))
-
-    shuffled_channs_of_samples_per_path = [sublist_for_path for sublist_for_path in
-                                           sublists_with_shuffled_samples[:n_paths_taking_inp]]
-    shuffled_lbls_predicted_part_of_samples = sublists_with_shuffled_samples[n_paths_taking_inp]
-
-    return (shuffled_channs_of_samples_per_path, shuffled_lbls_predicted_part_of_samples)
-
-
-# I must merge this with function: extractSegmentsGivenSliceCoords() that is used for Testing! Should be easy!
-# This is used in training/val only.
-def extractSegmentGivenSliceCoords(train_val_or_test,
-                                   cnn3d,
-                                   coord_center,
-                                   channels,
-                                   gt_lbl_img):
-    # channels: numpy array [ n_channels, x, y, z ]
-    # coord_center: indeces of the central voxel for the patch to be extracted.
+def get_sampling_idx_of_map(dims_of_segment, dims_of_scan, sampling_map):
+    # Sampling index of a category, to be cached (see cache.py) and sampled with sample_idxs_of_segments_from_idx().
+    # Returns: vox_idxs: np array [n_vox]. Flat indices (in the scan) of voxels with non-zero weight in the map,...
+    #              ... that are not closer to the edges than the segment permits (see sample_idxs_of_segments()).
+    #          cum_weights: None if all the weights are equal (binary maps). Otherwise np array [n_vox],...
+    #              ... the cumulative sum of the weights of the voxels.
+    n_vox_excl_left_right = get_n_vox_excl_left_right(dims_of_segment)
+    sampling_map_excl_near_edges = sampling_map[
+        n_vox_excl_left_right[0][0]: dims_of_scan[0] - n_vox_excl_left_right[0][1],
+        n_vox_excl_left_right[1][0]: dims_of_scan[1] - n_vox_excl_left_right[1][1],
+        n_vox_excl_left_right[2][0]: dims_of_scan[2] - n_vox_excl_left_right[2][1]]
+    idxs_of_nonzero_vox = np.nonzero(sampling_map_excl_near_edges)
+    weights = sampling_map_excl_near_edges[idxs_of_nonzero_vox]
+    vox_idxs = np.ravel_multi_index([idxs_of_nonzero_vox[rcz_i] + n_vox_excl_left_right[rcz_i][0]
+                                     for rcz_i in range(len(dims_of_segment))],
+                                    dims_of_scan)
+    vox_idxs = vox_idxs.astype("int32") if np.prod(dims_of_scan) <= np.iinfo("int32").max else vox_idxs
+    cum_weights = None if np.all(weights == weights[:1]) else np.cumsum(weights, dtype="float64")
+    return vox_idxs, cum_weights
+
+
+def sample_idxs_of_segments_from_idx(log,
+                                     job_id,
+                                     n_samples,
+                                     dims_of_segment,
+                                     dims_of_scan,
+                                     vox_idxs,
+                                     cum_weights):
+    # Same as sample_idxs_of_segments(), but samples from the index of a category, from get_sampling_idx_of_map().
+    # Only the sampled entries of the index are read. Cost does not depend on the size of the volume.
+    if len(vox_idxs) == 0 or (cum_weights is not None and np.isclose(cum_weights[-1], 0.)):
+        log.print3(job_id + " WARN: AFTER EXCLUDING NEAR EDGES, sampling map for category is just zeros! " +\
+                   " No samples for category from subject!")
+        return [ [[],[],[]], [[],[],[]] ]
+
+    if cum_weights is None: # Uniform over the voxels of the index.
+        idxs_in_idx_sampled = np.random.randint(0, len(vox_idxs), size=n_samples)
+    else: # See sample_idxs_of_segments()
+        idxs_in_idx_sampled = np.searchsorted(cum_weights,
+                                              np.random.uniform(0., cum_weights[-1], size=n_samples),
+                                              side='right')
+        idxs_in_idx_sampled = np.minimum(idxs_in_idx_sampled, len(cum_weights) - 1)
+    idxs_of_sampled_centers = np.asarray(np.unravel_index(vox_idxs[idxs_in_idx_sampled], dims_of_scan))
+
+    n_vox_excl_left_right = get_n_vox_excl_left_right(dims_of_segment)
+    slice_idxs_of_sampled_segms = np.zeros(list(idxs_of_sampled_centers.shape) + [2], dtype="int32")
+    slice_idxs_of_sampled_segms[:, :, 0] = idxs_of_sampled_centers - n_vox_excl_left_right[:, np.newaxis, 0]
+    slice_idxs_of_sampled_segms[:, :, 1] = idxs_of_sampled_centers + n_vox_excl_left_right[:, np.newaxis, 1]
+    return (idxs_of_sampled_centers, slice_idxs_of_sampled_segms)
 
-    channs_of_sample_per_path = []
-    # Sampling
-    for pathway in cnn3d.pathways[:1]:  # Hack. The rest of this loop can work for the whole .pathways...
-        # ... BUT the loop does not check what happens if boundaries are out of limits, to fill with zeros.
-        # This is done in getImagePartFromSubsampledImageForTraining().
-        # ... Update it in a nice way to be done here, and then take getImagePartFromSubsampledImageForTraining()
-        # out and make loop go for every pathway.
 
+def get_slices_of_segms_along_axis(idxs_low, idxs_high_non_incl, step, n_vox_segm, dim_img):
+    # Where each of many segments lies in the image along one axis, computed for all segments at once.
+    # idxs_low, idxs_high_non_incl: np arrays [n_segms]. First and last (excluded) voxel of each segment in the image.
+    #     Can be out of the image. The voxels within the image are put in the segment starting from position...
+    #     ... abs(idx_low) // step, if idx_low < 0. The rest of the segment is filled (see gather_segments()).
+    # step: subsampling factor along the axis (1 for normal resolution).
+    # Returns: idxs_low_in_img: np array [n_segms]. First voxel of each segment that is within the image.
+    #          idxs_put: np array [n_segms]. Position in the segment where idxs_low_in_img goes.
+    #          n_vox_in_img: np array [n_segms]. How many voxels (every step) to take from the image, from idxs_low_in_img.
+    idxs_low_in_img = np.maximum(idxs_low, 0)
+    idxs_high_in_img = np.minimum(idxs_high_non_incl, dim_img)
+    idxs_put = np.where(idxs_low >= 0, 0, np.abs(idxs_low) // step)
+    n_vox_in_img = -((idxs_low_in_img - idxs_high_in_img) // step) # ceil( (high - low) / step )
+    n_vox_in_img = np.clip(n_vox_in_img, 0, n_vox_segm - idxs_put)
+    return idxs_low_in_img, idxs_put, n_vox_in_img
+
+
+def gather_segments(imgs, slices_per_axis, steps, dims_segm, fill_value_per_img, out):
+    # Extracts many segments from 3D images (eg the channels of a subject), in the given output array.
+    # imgs: np array [n_imgs, R_img, C_img, Z_img].
+    # slices_per_axis: List with 3 (rcz) tuples, from get_slices_of_segms_along_axis().
+    # steps: subsampling factor per axis (rcz).
+    # dims_segm: Dimensions (rcz) of the segments.
+    # fill_value_per_img: Value for voxels of segments that fall out of the image, one per image.
+    # out: np array [n_segms, n_imgs, R, C, Z]. Can be a view (eg of the buffers of samples).
+    # Copying a (strided) slice of the image straight in the output is a single copy per segment. This is faster...
+    # ... than fancy-indexing (a strided view of windows of) the image, which gathers voxel by voxel in a temporary.
+    (low_r, put_r, n_r), (low_c, put_c, n_c), (low_z, put_z, n_z) = slices_per_axis
+    segm_in_img = ((put_r == 0) & (n_r == dims_segm[0]) &
+                   (put_c == 0) & (n_c == dims_segm[1]) &
+                   (put_z == 0) & (n_z == dims_segm[2]))
+    fill_values = np.asarray(fill_value_per_img, dtype=out.dtype)[:, np.newaxis, np.newaxis, np.newaxis]
+    
+    for segm_i in range(len(segm_in_img)):
+        slice_of_imgs = imgs[:,
+                             low_r[segm_i]: low_r[segm_i] + n_r[segm_i] * steps[0]: steps[0],
+                             low_c[segm_i]: low_c[segm_i] + n_c[segm_i] * steps[1]: steps[1],
+                             low_z[segm_i]: low_z[segm_i] + n_z[segm_i] * steps[2]: steps[2]]
+        if segm_in_img[segm_i]:
+            out[segm_i] = slice_of_imgs
+        else: # Partly out of the image (eg segments of subsampled pathways near the borders).
+            out[segm_i] = fill_values
+            out[segm_i,
+                :,
+                put_r[segm_i]: put_r[segm_i] + n_r[segm_i],
+                put_c[segm_i]: put_c[segm_i] + n_c[segm_i],
+                put_z[segm_i]: put_z[segm_i] + n_z[segm_i]] = slice_of_imgs
+
+
+# Extracts the segments of all pathways, for many segments, given where their primary (normal) segment starts.
+# Used for both training/val (extract_segments_to_bufs()) and testing (extract_tiles_to_bufs()).
+# Segments of subsampled pathways are taken every subs_factor voxels of the normal-resolution channels.
+# They cover the context of the segment of the primary pathway, as explained in the loop below.
+def extract_segments_of_pathways(train_val_or_test,
+                                 cnn3d,
+                                 idxs_low_primary,
+                                 channels,
+                                 border_int_per_channel,
+                                 bufs_per_pathway):
+    # idxs_low_primary: List with 3(rcz) np arrays [n_segms]. First voxel of each segment of the primary pathway.
+    # channels: numpy array [ n_channels, x, y, z ]
+    # border_int_per_channel: Intensity to fill the parts of segments that are out of the image, one per channel.
+    # bufs_per_pathway: List of arrays [n_segms, channels, R,C,Z], one per pathway that takes input, in the...
+    #     ... order of cnn3d.pathways. Segments are written in them. Can be views (eg rows of the buffers).
+    dims_of_scan = channels[0].shape
+    dims_primary_segm = cnn3d.pathways[0].getShapeOfInput(train_val_or_test)[2:]
+    
+    for pathway_i in range(len(cnn3d.pathways)):
+        pathway = cnn3d.pathways[pathway_i]
         if pathway.pType() == pt.FC:
             continue
-        subSamplingFactor = pathway.subsFactor()
-        pathwayInputShapeRcz = pathway.getShapeOfInput(train_val_or_test)[2:]
-        leftBoundaryRcz = [coord_center[0] - subSamplingFactor[0] * (pathwayInputShapeRcz[0] - 1) // 2,
-                           coord_center[1] - subSamplingFactor[1] * (pathwayInputShapeRcz[1] - 1) // 2,
-                           coord_center[2] - subSamplingFactor[2] * (pathwayInputShapeRcz[2] - 1) // 2]
-        rightBoundaryRcz = [leftBoundaryRcz[0] + subSamplingFactor[0] * pathwayInputShapeRcz[0],
-                            leftBoundaryRcz[1] + subSamplingFactor[1] * pathwayInputShapeRcz[1],
-                            leftBoundaryRcz[2] + subSamplingFactor[2] * pathwayInputShapeRcz[2]]
-
-        channelsForThisImagePart = channels[:,
-                                   leftBoundaryRcz[0]: rightBoundaryRcz[0]: subSamplingFactor[0],
-                                   leftBoundaryRcz[1]: rightBoundaryRcz[1]: subSamplingFactor[1],
-                                   leftBoundaryRcz[2]: rightBoundaryRcz[2]: subSamplingFactor[2]]
-
-        channs_of_sample_per_path.append(channelsForThisImagePart)
-
-    # Extract the samples for secondary pathways. This whole for can go away,
-    # if I update above code to check to slices out of limits.
-    for pathway_i in range(len(cnn3d.pathways)):  # Except Normal 1st, cause that was done already.
-        if cnn3d.pathways[pathway_i].pType() == pt.FC or cnn3d.pathways[pathway_i].pType() == pt.NORM:
-            continue
-        # this datastructure is similar to channelsForThisImagePart, but contains voxels from the subsampled image.
-        dimsOfPrimarySegment = cnn3d.pathways[pathway_i].getShapeOfInput(train_val_or_test)[2:]
-
-        # rightmost  are placeholders here.
-        slicesCoordsOfSegmForPrimaryPathway = [[leftBoundaryRcz[0], rightBoundaryRcz[0] - 1],
-                                               [leftBoundaryRcz[1], rightBoundaryRcz[1] - 1],
-                                               [leftBoundaryRcz[2], rightBoundaryRcz[2] - 1]]
-        channsForThisSubsampledPartAndPathway = getImagePartFromSubsampledImageForTraining(
-            dimsOfPrimarySegment=dimsOfPrimarySegment,
-            recFieldCnn=cnn3d.recFieldCnn,
-            subsampledImageChannels=channels,
-            image_part_slices_coords=slicesCoordsOfSegmForPrimaryPathway,
-            subSamplingFactor=cnn3d.pathways[pathway_i].subsFactor(),
-            subsampledImagePartDimensions=cnn3d.pathways[pathway_i].getShapeOfInput(train_val_or_test)[2:]
-            )
-
-        channs_of_sample_per_path.append(channsForThisSubsampledPartAndPathway)
-
-    # Get ground truth labels for training.
-    numOfCentralVoxelsClassifRcz = cnn3d.finalTargetLayer_outputShape[train_val_or_test][2:]
-    leftBoundaryRcz = [coord_center[0] - (numOfCentralVoxelsClassifRcz[0] - 1) // 2,
-                       coord_center[1] - (numOfCentralVoxelsClassifRcz[1] - 1) // 2,
-                       coord_center[2] - (numOfCentralVoxelsClassifRcz[2] - 1) // 2]
-    rightBoundaryRcz = [leftBoundaryRcz[0] + numOfCentralVoxelsClassifRcz[0],
-                        leftBoundaryRcz[1] + numOfCentralVoxelsClassifRcz[1],
-                        leftBoundaryRcz[2] + numOfCentralVoxelsClassifRcz[2]]
-    lbls_predicted_part_of_sample = gt_lbl_img[leftBoundaryRcz[0]: rightBoundaryRcz[0],
-                                    leftBoundaryRcz[1]: rightBoundaryRcz[1],
-                                    leftBoundaryRcz[2]: rightBoundaryRcz[2]]
-
-    # Make COPIES of the segments, instead of having a VIEW (slice) of them.
-    # This is so that the the whole volume are afterwards released from RAM.
-    channs_of_sample_per_path = \
-        [np.array(pathw_channs, copy=True, dtype='float32') for pathw_channs in channs_of_sample_per_path]
-    lbls_predicted_part_of_sample = np.copy(lbls_predicted_part_of_sample)
-
-    return channs_of_sample_per_path, lbls_predicted_part_of_sample
+        dims_segm = pathway.getShapeOfInput(train_val_or_test)[2:]
+        subs_factor = pathway.subsFactor()
+        slices_per_axis = []
+        for rcz_i in range(3):
+            if pathway.pType() == pt.NORM:
+                idxs_low = idxs_low_primary[rcz_i]
+                idxs_high_non_incl = idxs_low + dims_segm[rcz_i]
+            else: # Subsampled.
+                # From the first voxel of the primary segment, go forward to the voxel that is "central" in the...
+                # ... first subsampled (eg 3x3) area, then back as many voxels as the subsampled segment needs...
+                # ... before it (slots_previously). Take sf * rf voxels for the first central voxel of the subsampled...
+                # ... segment, plus sf for each further one. Central voxels of the primary segment that are not a...
+                # ... multiple of sf give ceil() subsampled ones. The cnn repeats and crops them to match.
+                sf = subs_factor[rcz_i]
+                rf = cnn3d.recFieldCnn[rcz_i]
+                n_central_vox = dims_primary_segm[rcz_i] - rf + 1
+                slots_previously = ((sf - 1) // 2) * rf if sf % 2 == 1 else (sf - 2) // 2 * rf + rf // 2
+                to_central_vox_of_averaged_area = sf // 2 if sf % 2 == 1 else sf // 2 - 1
+                idxs_low = idxs_low_primary[rcz_i] + to_central_vox_of_averaged_area - slots_previously
+                idxs_high_non_incl = idxs_low + int(sf * rf + (math.ceil(n_central_vox * 1.0 / sf) - 1) * sf)
+            slices_per_axis.append(get_slices_of_segms_along_axis(idxs_low,
+                                                                  idxs_high_non_incl,
+                                                                  subs_factor[rcz_i],
+                                                                  dims_segm[rcz_i],
+                                                                  dims_of_scan[rcz_i]))
+        gather_segments(channels,
+                        slices_per_axis,
+                        subs_factor,
+                        dims_segm,
+                        border_int_per_channel,
+                        bufs_per_pathway[pathway_i])
+
+
+# Extracts all segments of a subject that were sampled for a category, with few vectorised operations per pathway.
+# This is used in training/val only. For testing, see extract_tiles_to_bufs().
+def extract_segments_to_bufs(train_val_or_test,
+                             cnn3d,
+                             idxs_of_centers,
+                             channels,
+                             gt_lbl_img,
+                             bufs_of_samples,
+                             idx_first_sample):
+    # idxs_of_centers: np array [3(rcz), n_segms]. Indices of the central voxels of the segments to extract.
+    # channels: numpy array [ n_channels, x, y, z ]
+    # bufs_of_samples: List of arrays, see get_shapes_of_bufs_of_samples(). Segments are written in...
+    #     ... bufs_of_samples[:][idx_first_sample: idx_first_sample + n_segms]
+    idxs_of_centers = np.asarray(idxs_of_centers, dtype="int64")
+    n_segms = idxs_of_centers.shape[1]
+    rows_in_bufs = slice(idx_first_sample, idx_first_sample + n_segms)
+    dims_of_scan = channels[0].shape
+    
+    # Segments for primary pathway (normal resolution). Centers are sampled so that these are within the image.
+    dims_primary_segm = cnn3d.pathways[0].getShapeOfInput(train_val_or_test)[2:]
+    idxs_low_primary = [idxs_of_centers[rcz_i] - (dims_primary_segm[rcz_i] - 1) // 2 for rcz_i in range(3)]
+    # Out of image, segments are filled with the intensity at the corners of each channel.
+    border_int_per_channel = [calc_border_int_of_3d_img(channels[channel_i]) for channel_i in range(len(channels))]
+    extract_segments_of_pathways(train_val_or_test,
+                                 cnn3d,
+                                 idxs_low_primary,
+                                 channels,
+                                 border_int_per_channel,
+                                 [buf[rows_in_bufs] for buf in bufs_of_samples[:-1]])
+    
+    # Get ground truth labels of the central (predicted) part, for training.
+    dims_predicted_part = cnn3d.finalTargetLayer_outputShape[train_val_or_test][2:]
+    slices_per_axis = []
+    for rcz_i in range(3):
+        idxs_low = idxs_of_centers[rcz_i] - (dims_predicted_part[rcz_i] - 1) // 2
+        slices_per_axis.append(get_slices_of_segms_along_axis(idxs_low,
+                                                              idxs_low + dims_predicted_part[rcz_i],
+                                                              1,
+                                                              dims_predicted_part[rcz_i],
+                                                              dims_of_scan[rcz_i]))
+    # Labels are within the image, given how centers are sampled.
+    gather_segments(gt_lbl_img[np.newaxis], slices_per_axis, [1, 1, 1], dims_predicted_part, [0],
+                    bufs_of_samples[-1][rows_in_bufs][:, np.newaxis])
 
 
 # ###########################################################
@@ -806,121 +1111,96 @@ def extractSegmentGivenSliceCoords(train_val_or_test,
 #
 # ###########################################################
 
-# TODO: This is very similar to sample_idxs_of_segments() I believe, which is used for training.
-#       Consider way to merge them.
+def get_lows_of_tiles_along_axis(dim_segm, stride, dim_img):
+    # First voxel of each tile along an axis. Tiles step by stride from 0, until one reaches the end of the image.
+    # The last tile is shifted back to end exactly at the end of the image (overlapping with the previous).
+    # If the image is smaller than the segment, the only tile starts before the image (negative).
+    n_tiles = 1 + max(0, -(-(dim_img - dim_segm) // stride)) # ceil
+    return np.minimum(np.arange(n_tiles) * stride, dim_img - dim_segm)
+
+
+def calc_integral_img_3d(img):
+    # Summed-area table of a 3D image, with an extra leading 0 along each axis: ...
+    # ... integral[r,c,z] = sum(img[:r, :c, :z]). So that the sum of any box is found with 8 lookups.
+    dtype = "int32" if img.size < np.iinfo("int32").max else "int64"
+    integral = np.zeros([dim + 1 for dim in img.shape], dtype=dtype)
+    np.cumsum(img, axis=0, dtype=dtype, out=integral[1:, 1:, 1:])
+    np.cumsum(integral[1:, 1:, 1:], axis=1, out=integral[1:, 1:, 1:])
+    np.cumsum(integral[1:, 1:, 1:], axis=2, out=integral[1:, 1:, 1:])
+    return integral
+
+
+def calc_sum_of_boxes_from_integral_img(integral, lows, highs_non_incl):
+    # lows, highs_non_incl: Lists of 3(rcz) int np arrays [n_boxes], coordinates of boxes in the image, within it.
+    # Returns: np array [n_boxes], sum of the image within each box.
+    (r0, c0, z0) = lows
+    (r1, c1, z1) = highs_non_incl
+    return (integral[r1, c1, z1] - integral[r0, c1, z1] - integral[r1, c0, z1] - integral[r1, c1, z0] +
+            integral[r0, c0, z1] + integral[r0, c1, z0] + integral[r1, c0, z0] - integral[r0, c0, z0])
+
+
 def get_slice_coords_of_all_img_tiles(log,
                                       dimsOfPrimarySegment, # xyz dims of input to primary pathway (normal)
                                       strideOfSegmentsPerDimInVoxels,
-                                      batch_size,
                                       inp_chan_dims,
                                       roi_mask
                                       ):
     # inp_chan_dims: Dimensions of the (padded) input channels. [x, y, z]
+    # Returns: int np array [numberOfSegments, 3(rcz), 2]: Lower and upper limit of each segment, INCLUSIVE both sides.
+    # Tiles are ordered with r changing fastest, then c, then z. The number of tiles is not made a multiple of the...
+    # ... batch size. The last batch of inference is just smaller.
     log.print3("Starting to (tile) extract Segments from the images of the subject for Segmentation...")
 
-    sliceCoordsOfSegmentsToReturn = []
-
-    zLowBoundaryNext = 0
-    zAxisCentralPartPredicted = False
-    while not zAxisCentralPartPredicted:
-        zFarBoundary = min(zLowBoundaryNext + dimsOfPrimarySegment[2], inp_chan_dims[2])  # Excluding.
-        zLowBoundary = zFarBoundary - dimsOfPrimarySegment[2]
-        zLowBoundaryNext = zLowBoundaryNext + strideOfSegmentsPerDimInVoxels[2]
-        zAxisCentralPartPredicted = False if zFarBoundary < inp_chan_dims[2] else True  # IMPORTANT CRITERION
-
-        cLowBoundaryNext = 0
-        cAxisCentralPartPredicted = False
-        while not cAxisCentralPartPredicted:
-            cFarBoundary = min(cLowBoundaryNext + dimsOfPrimarySegment[1], inp_chan_dims[1])  # Excluding.
-            cLowBoundary = cFarBoundary - dimsOfPrimarySegment[1]
-            cLowBoundaryNext = cLowBoundaryNext + strideOfSegmentsPerDimInVoxels[1]
-            cAxisCentralPartPredicted = False if cFarBoundary < inp_chan_dims[1] else True
-
-            rLowBoundaryNext = 0
-            rAxisCentralPartPredicted = False
-            while not rAxisCentralPartPredicted:
-                rFarBoundary = min(rLowBoundaryNext + dimsOfPrimarySegment[0], inp_chan_dims[0])  # Excluding.
-                rLowBoundary = rFarBoundary - dimsOfPrimarySegment[0]
-                rLowBoundaryNext = rLowBoundaryNext + strideOfSegmentsPerDimInVoxels[0]
-                rAxisCentralPartPredicted = False if rFarBoundary < inp_chan_dims[0] else True
-
-                # In case I pass a brain-mask, I ll use it to only predict inside it. Otherwise, whole image.
-                if isinstance(roi_mask, np.ndarray):
-                    if not np.any(roi_mask[rLowBoundary:rFarBoundary,
-                                  cLowBoundary:cFarBoundary,
-                                  zLowBoundary:zFarBoundary]
-                                  ):  # all of it is out of the brain so skip it.
-                        continue
-
-                sliceCoordsOfSegmentsToReturn.append(
-                    [[rLowBoundary, rFarBoundary - 1], [cLowBoundary, cFarBoundary - 1],
-                     [zLowBoundary, zFarBoundary - 1]])
-
-    # I need to have a total number of image-parts that can be exactly-divided by the 'batch_size'.
-    # For this reason, I add in the far end of the list multiple copies of the last element.
-    total_number_of_image_parts = len(sliceCoordsOfSegmentsToReturn)
-    number_of_imageParts_missing_for_exact_division = \
-        batch_size - total_number_of_image_parts % batch_size if total_number_of_image_parts % batch_size != 0 else 0
-    for extra_useless_image_part_i in range(number_of_imageParts_missing_for_exact_division):
-        sliceCoordsOfSegmentsToReturn.append(sliceCoordsOfSegmentsToReturn[-1])
-
-    # I think that since the parts are acquired in a certain order and are sorted this way in the list, it is easy
-    # to know which part of the image they came from, as it depends only on the stride-size and the imagePart size.
+    lows_per_axis = [get_lows_of_tiles_along_axis(dimsOfPrimarySegment[rcz_i],
+                                                  strideOfSegmentsPerDimInVoxels[rcz_i],
+                                                  inp_chan_dims[rcz_i])
+                     for rcz_i in range(3)]
+    # Grid of all tiles. z slowest, r fastest.
+    lows_z, lows_c, lows_r = np.meshgrid(lows_per_axis[2], lows_per_axis[1], lows_per_axis[0], indexing="ij")
+    lows = [lows_r.ravel(), lows_c.ravel(), lows_z.ravel()]
+    highs_non_incl = [lows[rcz_i] + dimsOfPrimarySegment[rcz_i] for rcz_i in range(3)]
+
+    # In case I pass a brain-mask, I ll use it to only predict inside it. Otherwise, whole image.
+    # Tiles all of which is out of the brain are skipped. Their part within the mask is summed via its integral image.
+    if isinstance(roi_mask, np.ndarray):
+        integral_roi = calc_integral_img_3d(roi_mask > 0)
+        n_vox_in_roi_per_tile = calc_sum_of_boxes_from_integral_img(integral_roi,
+                                                                    [np.maximum(low, 0) for low in lows],
+                                                                    highs_non_incl)
+        tiles_in_roi = n_vox_in_roi_per_tile > 0
+        lows = [low[tiles_in_roi] for low in lows]
+        highs_non_incl = [high[tiles_in_roi] for high in highs_non_incl]
+
+    slice_coords_of_tiles = np.stack([np.stack([lows[rcz_i], highs_non_incl[rcz_i] - 1], axis=1) for rcz_i in range(3)],
+                                     axis=1)
 
     log.print3("Finished (tiling) extracting Segments from the images of the subject for Segmentation.")
 
-    # sliceCoordsOfSegmentsToReturn: list with 3 dimensions. numberOfSegments x 3(rcz) x 2
-    # (lower and upper limit of the segment, INCLUSIVE both sides)
-    return sliceCoordsOfSegmentsToReturn
-
-
-# I must merge this with function: extractSegmentGivenSliceCoords() that is used for Training/Validation! Should be easy
-# This is used in testing only.
-def extractSegmentsGivenSliceCoords(cnn3d,
-                                    sliceCoordsOfSegmentsToExtract,
-                                    channelsOfImageNpArray,
-                                    recFieldCnn):
-    # channelsOfImageNpArray: numpy array [ n_channels, x, y, z ]
-    numberOfSegmentsToExtract = len(sliceCoordsOfSegmentsToExtract)
-    channsForSegmentsPerPathToReturn = [[] for i in range(
-        cnn3d.getNumPathwaysThatRequireInput())]  # [pathway, image parts, channels, r, c, z]
-    # RCZ dims of input to primary pathway (NORMAL). Which should be the first one in .pathways.
-    dimsOfPrimarySegment = cnn3d.pathways[0].getShapeOfInput("test")[2:]
-
-    for segment_i in range(numberOfSegmentsToExtract):
-        rLowBoundary = sliceCoordsOfSegmentsToExtract[segment_i][0][0]
-        rFarBoundary = sliceCoordsOfSegmentsToExtract[segment_i][0][1]
-        cLowBoundary = sliceCoordsOfSegmentsToExtract[segment_i][1][0]
-        cFarBoundary = sliceCoordsOfSegmentsToExtract[segment_i][1][1]
-        zLowBoundary = sliceCoordsOfSegmentsToExtract[segment_i][2][0]
-        zFarBoundary = sliceCoordsOfSegmentsToExtract[segment_i][2][1]
-        # segment for primary pathway
-        channsForPrimaryPathForThisSegm = channelsOfImageNpArray[:,
-                                                                 rLowBoundary:rFarBoundary + 1,
-                                                                 cLowBoundary:cFarBoundary + 1,
-                                                                 zLowBoundary:zFarBoundary + 1
-                                                                 ]
-        channsForSegmentsPerPathToReturn[0].append(channsForPrimaryPathForThisSegm)
-
-        # Subsampled pathways
-        for pathway_i in range(len(cnn3d.pathways)):  # Except Normal 1st, cause that was done already.
-            if cnn3d.pathways[pathway_i].pType() == pt.FC or cnn3d.pathways[pathway_i].pType() == pt.NORM:
-                continue
-            # the right hand values are placeholders in this case.
-            slicesCoordsOfSegmForPrimaryPathway = [[rLowBoundary, rFarBoundary - 1],
-                                                   [cLowBoundary, cFarBoundary - 1],
-                                                   [zLowBoundary, zFarBoundary - 1]]
-            channsForThisSubsPathForThisSegm = getImagePartFromSubsampledImageForTraining(
-                dimsOfPrimarySegment=dimsOfPrimarySegment,
-                recFieldCnn=recFieldCnn,
-                subsampledImageChannels=channelsOfImageNpArray,
-                image_part_slices_coords=slicesCoordsOfSegmForPrimaryPathway,
-                subSamplingFactor=cnn3d.pathways[pathway_i].subsFactor(),
-                subsampledImagePartDimensions=cnn3d.pathways[pathway_i].getShapeOfInput("test")[2:]
-                )
-            channsForSegmentsPerPathToReturn[pathway_i].append(channsForThisSubsPathForThisSegm)
-
-    return channsForSegmentsPerPathToReturn
+    return slice_coords_of_tiles
+
+
+# Extracts the segments of all pathways for a batch of tiles, in the given buffers. Used in testing only.
+# Shares the extraction with training/validation, see extract_segments_of_pathways().
+def extract_tiles_to_bufs(cnn3d,
+                          slice_coords_of_tiles,
+                          channels,
+                          border_int_per_channel,
+                          bufs_of_tiles):
+    # slice_coords_of_tiles: [n_tiles, 3(rcz), 2]. Slice coords of the tiles, as from get_slice_coords_of_all_img_tiles()
+    # channels: numpy array [ n_channels, x, y, z ]
+    # border_int_per_channel: Intensity to fill the parts of tiles that are out of the image, one per channel.
+    #     Same for all tiles of a subject, computed once per subject by the caller.
+    # bufs_of_tiles: List of arrays [>= n_tiles, channels, R,C,Z], one per pathway that takes input. Allocated once...
+    #     ... and reused for every batch. Tiles are written in bufs_of_tiles[:][:n_tiles]
+    slice_coords_of_tiles = np.asarray(slice_coords_of_tiles, dtype="int64")
+    n_tiles = len(slice_coords_of_tiles)
+    idxs_low_primary = [slice_coords_of_tiles[:, rcz_i, 0] for rcz_i in range(3)]
+    extract_segments_of_pathways("test",
+                                 cnn3d,
+                                 idxs_low_primary,
+                                 channels,
+                                 border_int_per_channel,
+                                 [buf[:n_tiles] for buf in bufs_of_tiles])
 
 
 ###########################################
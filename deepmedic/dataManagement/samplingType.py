@@ -136,10 +136,8 @@ class SamplingType(object):
         return sampling_maps_per_cat
     
     
-    def distribute_n_samples_to_categs(self, n_samples, sampling_maps_per_cat):
-        # sampling_maps_per_cat: returned by self.derive_sampling_maps_per_cat(...)
-        # The below is a list of booleans, where False if a sampling_map is all 0.
-        valid_cats = [ np.sum(s_map) > 0 for s_map in sampling_maps_per_cat ]
+    def distribute_n_samples_to_categs(self, n_samples, valid_cats):
+        # valid_cats: List of booleans, one per category. False if its sampling map is all 0 (nothing to sample).
         
         # Set weight for sampling a category to 0 if it's not valid.
         perc_samples_per_valid_cat = [p if v else 0. for p,v in zip(self._perc_to_sample_per_cat, valid_cats) ]
@@ -160,7 +158,7 @@ class SamplingType(object):
         for cat_i in cats_to_distribute_samples:
             n_samples_per_cat[cat_i] += 1
                 
-        return n_samples_per_cat, valid_cats
+        return n_samples_per_cat
 
 
 
@@ -7,6 +7,7 @@
 
 from __future__ import absolute_import, print_function, division
 import os
+import math
 
 from deepmedic.neuralnet.utils import calcRecFieldFromKernDimListPerLayerWhenStrides1, checkRecFieldVsSegmSize, checkKernDimPerLayerCorrect3dAndNumLayers, checkSubsampleFactorEven
 
@@ -108,6 +109,12 @@ class ModelParameters(object) :
         print("\t Provide a list that does not iinclude the first layer, eg layersWithResidualConnNormal = [4,6,8], or an empty list [] for no such connections. Exiting!"); exit(1)
         
     @staticmethod
+    def errorSegmDimInferNotSymmetricForTta(segmDimNormalInfer, receptiveFieldNormal, steps, axes_tta) :
+        print("ERROR: Test-time augmentation (tta_prms in the test config) flips or rotates each segment, along axes: ", sorted(axes_tta), ". For this to be the same as flipping/rotating the whole volume, the segments of the subsampled pathways must be symmetric around the center of the normal segment. This requires that, along these axes, the number of central (predicted) voxels (segmentsDimInference - receptive field + 1) minus 1 is a multiple of all the subsampling factors (here: ", steps, "). But segmentsDimInference = ", segmDimNormalInfer, " and receptive field = ", receptiveFieldNormal, ". Please set segmentsDimInference in the model config to receptive field + a multiple of ", steps, " along these axes (eg ", [ receptiveFieldNormal[d] + max(1, (segmDimNormalInfer[d] - receptiveFieldNormal[d]) // steps[d]) * steps[d] for d in range(3) ], "), or give mem_budget_mb_for_segm_dim_infer in the test config, or do not use test-time augmentation along these axes. Exiting!"); exit(1)
+    @staticmethod
+    def errorAnisotropicForTtaRotation(plane_axes) :
+        print("ERROR: Test-time augmentation (tta_prms in the test config) rotates segments in the plane of axes: ", plane_axes, ". This requires that along these two axes the model has the same segmentsDimInference, receptive field and subsampling factors. Please fix the model config, or do not rotate in this plane. Exiting!"); exit(1)
+    @staticmethod
     def warnForSameReceptiveField() :
         print("WARN: Because of limitations to the developed system, the two pathways must have the save size of receptive field. If unsure of how to proceed, please ommit specifying \"numberFMsPerLayerSubsampled\" and \"kernelDimPerLayerSubsampled\" in the config file, and the second subsampled pathway will be automatically created to mirror the normal. Else, if you want to just specify the number of Feature Maps in the subsampled, provide \"numberFMsPerLayerSubsampled\" = [num-FMs-layer1, ..., num-FMs-layerN], with N the same number as the normal pathway, and we will then use the same kernel-sizes as the normal pathway.")
     @staticmethod
@@ -356,7 +363,92 @@ class ModelParameters(object) :
         
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================")
-        
+
+    def calc_mem_of_inference_mb(self, segm_dims, batchsize) :
+        # Estimate of the memory (MB) for the activations of one batch of test segments of size segm_dims (float32).
+        # Sums the input and the output FMs of every layer, as if all were kept at once. Upper bound for inference.
+        n_vox = lambda dims: dims[0] * dims[1] * dims[2]
+        dims_out = [ segm_dims[d] - self.receptiveFieldNormal[d] + 1 for d in range(3) ]
+
+        n_floats = self.numberOfInputChannelsNormal * n_vox(segm_dims)
+        dims_of_layer = list(segm_dims)
+        for (n_fms, kern_dims) in zip(self.numFMsPerLayerNormal, self.kernDimPerLayerNormal) :
+            dims_of_layer = [ dims_of_layer[d] - kern_dims[d] + 1 for d in range(3) ]
+            n_floats += n_fms * n_vox(dims_of_layer)
+        for subpath_i in range(len(self.subsampleFactor)) :
+            # Input of subsampled pathways is made to produce an output of ceil(dims_out/factor). See cnn3d.py.
+            sub_factor = self.subsampleFactor[subpath_i]
+            dims_of_layer = [ -(-dims_out[d] // sub_factor[d]) + self.receptiveFieldSubsampled[d] - 1 for d in range(3) ]
+            n_floats += self.numberOfInputChannelsSubsampled * n_vox(dims_of_layer)
+            for (n_fms, kern_dims) in zip(self.numFMsPerLayerSubsampled[subpath_i], self.kernDimPerLayerSubsampled) :
+                dims_of_layer = [ dims_of_layer[d] - kern_dims[d] + 1 for d in range(3) ]
+                n_floats += n_fms * n_vox(dims_of_layer)
+            n_floats += self.numFMsPerLayerSubsampled[subpath_i][-1] * n_vox(dims_out) # Upsampled.
+        for n_fms in self.numFMsInExtraFcs + [self.numberClasses, self.numberClasses] : # Last two: Classif. layer and probs.
+            n_floats += n_fms * n_vox(dims_out)
+
+        return batchsize * n_floats * 4. / (1024 * 1024)
+
+    def calc_steps_of_segm_dim_infer_for_tta(self, axes_tta) :
+        # Segments of subsampled pathways sample every sf voxels (see extract_segments_of_pathways() in sampling.py). ...
+        # ... They are symmetric around the center of the normal segment only if its central (predicted) voxels ...
+        # ... are 1 + a multiple of sf. Only then, flipping a segment gives the segments of the flipped volume.
+        # axes_tta: axes (0,1,2) that test-time augmentation flips or rotates. See get_axes_and_planes_of_tta()
+        # Returns: list with 3 integers. Along each axis, the step between valid sizes of segments. 1 if any is valid.
+        steps = [1, 1, 1]
+        for axis in axes_tta :
+            for sub_factor in self.subsampleFactor :
+                steps[axis] = steps[axis] * sub_factor[axis] // math.gcd(steps[axis], sub_factor[axis]) # lcm
+        return steps
+    
+    def check_segm_dim_infer_for_tta(self, axes_tta, planes_rot_tta, check_segm_dims=True) :
+        # Exits with an error if flipping/rotating each segment is not the same as flipping/rotating the volume.
+        # planes_rot_tta: list of pairs of axes (planes) in which test-time augmentation rotates.
+        # check_segm_dims: False if the size of segments will be set later (see adapt_segm_dim_infer_to_mem()).
+        for (axis_a, axis_b) in planes_rot_tta :
+            if self.receptiveFieldNormal[axis_a] != self.receptiveFieldNormal[axis_b] or \
+                    (check_segm_dims and self.segmDimNormalInfer[axis_a] != self.segmDimNormalInfer[axis_b]) or \
+                    True in [ sub_factor[axis_a] != sub_factor[axis_b] for sub_factor in self.subsampleFactor ] :
+                self.errorAnisotropicForTtaRotation((axis_a, axis_b))
+        if check_segm_dims :
+            steps = self.calc_steps_of_segm_dim_infer_for_tta(axes_tta)
+            for axis in axes_tta :
+                if (self.segmDimNormalInfer[axis] - self.receptiveFieldNormal[axis]) % steps[axis] != 0 :
+                    self.errorSegmDimInferNotSymmetricForTta(self.segmDimNormalInfer, self.receptiveFieldNormal, steps, axes_tta)
+    
+    def adapt_segm_dim_infer_to_mem(self, mem_budget_mb, batchsize, max_segm_dims, n_models=1, axes_tta=(), planes_rot_tta=()) :
+        # Sets the size of the segments for testing to the largest that fits in mem_budget_mb (see calc_mem_of_inference_mb).
+        # The network is fully convolutional. Larger segments predict more voxels per forward pass, so less computation...
+        # ... is wasted on the receptive field that overlaps between neighbouring segments.
+        # Segments grow equally along all axes, from the receptive field, until max_segm_dims (per axis) or the budget.
+        # max_segm_dims: Larger than the (padded) volumes would only compute on padding. Eg the largest test volume.
+        # n_models: Number of models in the graph that each batch runs through (eg main model + members of ensemble).
+        #           Each holds the activations of a whole batch, so memory is as for a batch n_models times larger.
+        # axes_tta, planes_rot_tta: Axes and planes transformed by test-time augmentation. Segments grow in steps...
+        #           that keep them valid for it (see check_segm_dim_infer_for_tta()), and are isotropic in rotated planes.
+        batchsize_of_all_models = batchsize * n_models
+        steps = self.calc_steps_of_segm_dim_infer_for_tta(axes_tta)
+        max_segm_dims = list(max_segm_dims)
+        for _ in planes_rot_tta : # Repeat, for planes that share an axis.
+            for (axis_a, axis_b) in planes_rot_tta :
+                max_segm_dims[axis_a] = max_segm_dims[axis_b] = min(max_segm_dims[axis_a], max_segm_dims[axis_b])
+        # Largest valid size up to the max. The receptive field (1 central voxel) is always valid.
+        max_segm_dims = [ self.receptiveFieldNormal[d] + max(0, max_segm_dims[d] - self.receptiveFieldNormal[d]) // steps[d] * steps[d]
+                          for d in range(3) ]
+        segm_dims = [ min(self.receptiveFieldNormal[d], max_segm_dims[d]) for d in range(3) ]
+        while True :
+            segm_dims_next = [ min(segm_dims[d] + steps[d], max_segm_dims[d]) for d in range(3) ]
+            if segm_dims_next == segm_dims or self.calc_mem_of_inference_mb(segm_dims_next, batchsize_of_all_models) > mem_budget_mb :
+                break
+            segm_dims = segm_dims_next
+        # The segment must still cover the receptive field, even if the budget does not allow it.
+        segm_dims = [ max(segm_dims[d], self.receptiveFieldNormal[d]) for d in range(3) ]
+
+        self.log.print3("Size of Segments for Testing adapted to memory budget of [" + str(mem_budget_mb) + "] MB," +\
+                        " batch size [" + str(batchsize) + "] and [" + str(n_models) + "] models per batch: " + str(self.segmDimNormalInfer) + " -> " + str(segm_dims) +\
+                        " (Estimated memory: " + str(round(self.calc_mem_of_inference_mb(segm_dims, batchsize_of_all_models), 1)) + " MB)")
+        self.segmDimNormalInfer = segm_dims
+
     def get_args_for_arch(self) :
         
         args = [
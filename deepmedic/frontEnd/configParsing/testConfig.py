@@ -19,6 +19,7 @@ class TestConfig(Config):
     #[REQUIRED]
     FOLDER_OUTP = "folderForOutput" #MUST BE GIVEN
     SAVED_MODEL = "cnnModelFilePath" #MUST BE GIVEN
+    SAVED_MODELS_ENSEMBLE = "cnnModelFilePathsForEnsemble" # Optional. More models, predictions averaged with the above.
     CHANNELS = "channels" #MUST BE GIVEN
     
     NAMES_FOR_PRED_PER_CASE = "namesForPredictionsPerCase"
@@ -34,6 +35,7 @@ class TestConfig(Config):
     SUFFIX_SEGM_PROB = "suffixForSegmAndProbsDict"
     
     BATCHSIZE = "batchsize"
+    MEM_BUDGET_SEGM_INFER = "mem_budget_mb_for_segm_dim_infer" # Default None: Size of segments from model config.
     
     #optionals, cause default is False.
     SAVE_INDIV_FMS = "saveIndividualFms"
@@ -42,6 +44,8 @@ class TestConfig(Config):
     INDICES_OF_FMS_TO_SAVE_SUBSAMPLED = "minMaxIndicesOfFmsToSaveFromEachLayerOfSubsampledPathway"
     INDICES_OF_FMS_TO_SAVE_FC = "minMaxIndicesOfFmsToSaveFromEachLayerOfFullyConnectedPathway"
     
+    TTA_PRMS = "tta_prms" # Default None: No test-time augmentation.
+    
     # ========= GENERICS =========
     # ~~~~ Data compabitiliby checks ~~~
     RUN_INP_CHECKS = "run_input_checks"
@@ -49,6 +53,9 @@ class TestConfig(Config):
     PAD_INPUT = "padInputImagesBool"
     NORM_VERB_LVL = "norm_verbosity_lvl"
     NORM_ZSCORE_PRMS = "norm_zscore_prms"
+    FOLDER_CACHE_PREPROC = "folder_cache_preproc"
+    FOLDER_MMAP_OUTPUTS = "folder_mmap_outputs"
+    NII_WRITER_PRMS = "nii_writer_prms"
     
 
     def __init__(self, abs_path_to_cfg):
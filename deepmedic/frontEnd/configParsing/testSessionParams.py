@@ -8,6 +8,7 @@
 from __future__ import absolute_import, print_function, division
 
 from deepmedic.frontEnd.configParsing.utils import getAbsPathEvenIfRelativeIsGiven, parseAbsFileLinesInList, parseFileLinesInList, check_and_adjust_path_to_ckpt
+from deepmedic.dataManagement.io import load_dims_of_volume
 
 class TestSessionParameters(object) :
     #To be called from outside too.
@@ -33,6 +34,8 @@ class TestSessionParameters(object) :
         # From Session:
         self.log = log
         self.mainOutputAbsFolder = mainOutputAbsFolder
+        self.folderForPredictions = folderForPredictions
+        self.folderForFeatures = folderForFeatures
         
         # From test config:
         self.sessionName = self.getSessionName( cfg[cfg.SESSION_NAME] )
@@ -40,6 +43,9 @@ class TestSessionParameters(object) :
         abs_path_to_cfg = cfg.get_abs_path_to_cfg()
         abs_path_to_saved = getAbsPathEvenIfRelativeIsGiven( cfg[cfg.SAVED_MODEL], abs_path_to_cfg ) if cfg[cfg.SAVED_MODEL] is not None else None # Where to load the model from.
         self.savedModelFilepath = check_and_adjust_path_to_ckpt( self.log, abs_path_to_saved) if abs_path_to_saved is not None else None
+        # More models, of the same architecture, for an ensemble. Their predictions are averaged with the above's.
+        paths_ensemble = cfg[cfg.SAVED_MODELS_ENSEMBLE] if cfg[cfg.SAVED_MODELS_ENSEMBLE] is not None else []
+        self.savedModelFilepathsEnsemble = [ check_and_adjust_path_to_ckpt( self.log, getAbsPathEvenIfRelativeIsGiven(path, abs_path_to_cfg) ) for path in paths_ensemble ]
         
         #Input:
         #[[case1-ch1, ..., caseN-ch1], [case1-ch2,...,caseN-ch2]]
@@ -56,6 +62,7 @@ class TestSessionParameters(object) :
         self.filepathsToSavePredictionsForEachPatient = None #Filled by call to self.makeFilepathsForPredictionsAndFeatures()
         self.suffixForSegmAndProbsDict = cfg[cfg.SUFFIX_SEGM_PROB] if cfg[cfg.SUFFIX_SEGM_PROB] is not None else {"segm": "Segm", "prob": "ProbMapClass"}
         self.batchsize = cfg[cfg.BATCHSIZE] if cfg[cfg.BATCHSIZE] is not None else 10
+        self.mem_budget_segm_dim_infer = cfg[cfg.MEM_BUDGET_SEGM_INFER] # None: Size of segments as in model config.
         #features:
         self.save_fms_flag = cfg[cfg.SAVE_INDIV_FMS] if cfg[cfg.SAVE_INDIV_FMS] is not None else False
         if self.save_fms_flag:
@@ -67,6 +74,14 @@ class TestSessionParameters(object) :
             self.indices_fms_per_pathtype_per_layer_to_save = None
         self.filepathsToSaveFeaturesForEachPatient = None #Filled by call to self.makeFilepathsForPredictionsAndFeatures()
         
+        # == Test-time augmentation. None: No TTA. ==
+        self.tta_prms = None
+        if cfg[cfg.TTA_PRMS] is not None:
+            self.tta_prms = {'reflect': None, 'rotate90': None}
+            for key in cfg[cfg.TTA_PRMS]:
+                assert key in self.tta_prms # Check for typos.
+                self.tta_prms[key] = cfg[cfg.TTA_PRMS][key]
+        
         # ===================== PRE-PROCESSING ======================
         # === Data compatibility checks ===
         self.run_input_checks = cfg[cfg.RUN_INP_CHECKS] if cfg[cfg.RUN_INP_CHECKS] is not None else True
@@ -90,6 +105,22 @@ class TestSessionParameters(object) :
         # norm_prms['verbose_lvl']: 0: No logging, 1: Type of cutoffs and timing 2: Stats.
         self.norm_prms = {'verbose_lvl': cfg[cfg.NORM_VERB_LVL] if cfg[cfg.NORM_VERB_LVL] is not None else 0,
                           'zscore': norm_zscore_prms}
+        # == Cache of pre-processed subjects. None: No caching. ==
+        self.folder_cache_preproc = \
+            getAbsPathEvenIfRelativeIsGiven(cfg[cfg.FOLDER_CACHE_PREPROC], abs_path_to_cfg) \
+            if cfg[cfg.FOLDER_CACHE_PREPROC] is not None else None
+        # == Memory-map predicted volumes to disk, instead of keeping them in RAM. None: In RAM. ==
+        self.folder_mmap_outputs = \
+            getAbsPathEvenIfRelativeIsGiven(cfg[cfg.FOLDER_MMAP_OUTPUTS], abs_path_to_cfg) \
+            if cfg[cfg.FOLDER_MMAP_OUTPUTS] is not None else None
+        # == Writing of output images (in background threads) ==
+        self.nii_writer_prms = {'n_threads': 4, # Images written in parallel.
+                                'compress': True, # True: .nii.gz, False: .nii
+                                'compress_lvl': 1} # Level of gzip, 1 (fastest) to 9 (smallest).
+        if cfg[cfg.NII_WRITER_PRMS] is not None:
+            for key in cfg[cfg.NII_WRITER_PRMS]:
+                assert key in self.nii_writer_prms # Check for typos.
+                self.nii_writer_prms[key] = cfg[cfg.NII_WRITER_PRMS][key]
         
         # ============= OTHERS =============
         #Others useful internally or for reporting:
@@ -124,6 +155,19 @@ class TestSessionParameters(object) :
     def get_path_to_load_model_from(self):
         return self.savedModelFilepath
     
+    def get_paths_to_load_ensemble_from(self):
+        return self.savedModelFilepathsEnsemble
+    
+    def calc_max_segm_dim_infer(self, rec_field):
+        # Largest segment that is useful for inference, given the dimensions of the test volumes (from their headers).
+        # With padding, volumes are padded by the receptive field, and further if smaller than the segment. So...
+        # ... a segment as large as the largest padded volume predicts it in one pass. Without, it must fit in all.
+        dims_per_case = [ load_dims_of_volume(paths_of_chans[0]) for paths_of_chans in self.channelsFilepaths ]
+        if self.pad_input :
+            return [ max(dims[d] for dims in dims_per_case) + rec_field[d] - 1 for d in range(3) ]
+        else :
+            return [ min(dims[d] for dims in dims_per_case) for d in range(3) ]
+    
     
     def print_params(self) :
         logPrint = self.log.print3
@@ -133,12 +177,14 @@ class TestSessionParameters(object) :
         logPrint("=============================================================")
         logPrint("sessionName = " + str(self.sessionName))
         logPrint("Model will be loaded from save = " + str(self.savedModelFilepath))
+        logPrint("Models to ensemble with it, loaded from saves = " + str(self.savedModelFilepathsEnsemble))
         logPrint("~~~~~~~~~~~~~~~~~~~~INPUT~~~~~~~~~~~~~~~~")
         logPrint("Number of cases to perform inference on = " + str(self.numberOfCases))
         logPrint("Paths to the channels of each case = " + str(self.channelsFilepaths))
         logPrint("Paths to provided GT labels per case = " + str(self.gtLabelsFilepaths))
         logPrint("Filepaths of the ROI Masks provided per case = " + str(self.roiMasksFilepaths))
         logPrint("Batch size = " + str(self.batchsize))
+        logPrint("Memory budget (MB) to adapt the size of segments to (None: As in model config) = " + str(self.mem_budget_segm_dim_infer))
         
         logPrint("~~~~~~~~~~~~~~~~~~~OUTPUT~~~~~~~~~~~~~~~")
         logPrint("Path to the main output-folder = " + str(self.mainOutputAbsFolder))
@@ -157,6 +203,9 @@ class TestSessionParameters(object) :
         logPrint("Indices of min/max FMs to save, per type of pathway (normal/subsampled/FC) and per layer = " + str(self.indices_fms_per_pathtype_per_layer_to_save))
         logPrint("Save Feature Maps at = " + str(self.filepathsToSaveFeaturesForEachPatient))
         
+        logPrint("~~~~~~~~~~~~~~~~~~ TEST-TIME AUGMENTATION ~~~~~~~~~~~~~~~~")
+        logPrint("Parameters for test-time augmentation (None: no TTA) = " + str(self.tta_prms))
+        
         logPrint("~~~~~~~~~~~~~~~~~~ PRE-PROCESSING ~~~~~~~~~~~~~~~~")
         logPrint("~~Data Compabitibility Checks~~")
         logPrint("Check whether input data has correct format (can slow down process) = " + str(self.run_input_checks))
@@ -168,11 +217,33 @@ class TestSessionParameters(object) :
         logPrint("~~Intensity Normalization~~")
         logPrint("Verbosity level = " + str(self.norm_prms['verbose_lvl']))
         logPrint("Z-Score parameters = " + str(self.norm_prms['zscore']))
+        logPrint("~~Caching~~")
+        logPrint("Folder to cache pre-processed subjects (None: no caching) = " + str(self.folder_cache_preproc))
+        logPrint("Folder to memory-map predicted volumes to (None: kept in RAM) = " + str(self.folder_mmap_outputs))
+        logPrint("~~Writing of outputs~~")
+        logPrint("Parameters for writing output images = " + str(self.nii_writer_prms))
         
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================\n")
         
     def get_args_for_testing(self) :
+        return self._get_args_for_testing( self.channelsFilepaths,
+                                           self.gtLabelsFilepaths,
+                                           self.roiMasksFilepaths,
+                                           self.filepathsToSavePredictionsForEachPatient,
+                                           self.filepathsToSaveFeaturesForEachPatient )
+    
+    def get_args_for_serving_request(self, paths_channels, path_roi_mask, name_for_outputs) :
+        # For one subject, requested from the inference server. See frontEnd/inferenceServer.py
+        # name_for_outputs: As an entry of namesForPredictionsPerCase. If relative, it is in the session's output folders.
+        return self._get_args_for_testing( [paths_channels],
+                                           None, # No GT. No evaluation.
+                                           [path_roi_mask] if path_roi_mask is not None else None,
+                                           [getAbsPathEvenIfRelativeIsGiven(name_for_outputs, self.folderForPredictions)],
+                                           [getAbsPathEvenIfRelativeIsGiven(name_for_outputs, self.folderForFeatures)] )
+    
+    def _get_args_for_testing(self, channelsFilepaths, gtLabelsFilepaths, roiMasksFilepaths,
+                              filepathsToSavePredictionsForEachPatient, filepathsToSaveFeaturesForEachPatient) :
         
         validation0orTesting1 = 1
         
@@ -180,10 +251,10 @@ class TestSessionParameters(object) :
                 validation0orTesting1,
                 {"segm": self.saveSegmentation, "prob": self.saveProbMapsBoolPerClass},
                 
-                self.channelsFilepaths,
-                self.gtLabelsFilepaths,
-                self.roiMasksFilepaths,
-                self.filepathsToSavePredictionsForEachPatient,
+                channelsFilepaths,
+                gtLabelsFilepaths,
+                roiMasksFilepaths,
+                filepathsToSavePredictionsForEachPatient,
                 self.suffixForSegmAndProbsDict,
                 # Hyper parameters
                 self.batchsize,
@@ -192,10 +263,17 @@ class TestSessionParameters(object) :
                 # Pre-Processing
                 self.pad_input,
                 self.norm_prms,
+                self.folder_cache_preproc,
                 # For FM visualisation
                 self.save_fms_flag,
                 self.indices_fms_per_pathtype_per_layer_to_save,
-                self.filepathsToSaveFeaturesForEachPatient
+                filepathsToSaveFeaturesForEachPatient,
+                # Memory
+                self.folder_mmap_outputs,
+                # Test-time augmentation
+                self.tta_prms,
+                # Writing of outputs
+                self.nii_writer_prms
                 ]
         
         return args
@@ -37,6 +37,7 @@ class TrainConfig(Config):
     NUM_TR_SEGMS_LOADED_PERSUB = "numberTrainingSegmentsLoadedOnGpuPerSubep"
     BATCHSIZE_TR = "batchsize_train"
     NUM_OF_PROC_SAMPL = "num_processes_sampling"
+    TIMEOUT_SAMPL_STALLED = "timeout_secs_sampling_stalled"
     
     # ~~~~~ Learning rate schedule ~~~~~
     LR_SCH_TYPE = "typeOfLearningRateSchedule"
@@ -93,6 +94,8 @@ class TrainConfig(Config):
     # RMS
     RHO_RMS = "rhoRms"
     EPS_RMS = "epsilonRms"
+    # Gradient accumulation
+    NUM_BATCHES_ACCUM_GRADS = "num_batches_accum_grads"
     # Losses
     LOSSES_WEIGHTS = "losses_and_weights"
     W_C_IN_COST = "reweight_classes_in_cost"
@@ -112,6 +115,9 @@ class TrainConfig(Config):
     PAD_INPUT = "padInputImagesBool"
     NORM_VERB_LVL = "norm_verbosity_lvl"
     NORM_ZSCORE_PRMS = "norm_zscore_prms"
+    FOLDER_CACHE_PREPROC = "folder_cache_preproc"
+    # ~~~~~ Storage of samples ~~~~~~~~
+    PRECISION_SAMPLES = "precision_samples"
     
     # ======== DEPRECATED, backwards compatibility =======
     REFL_AUGM_PER_AXIS = "reflectImagesPerAxis"
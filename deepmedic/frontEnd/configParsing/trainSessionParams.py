@@ -249,6 +249,11 @@ class TrainSessionParameters(object):
             cfg[cfg.NUM_TR_SEGMS_LOADED_PERSUB] if cfg[cfg.NUM_TR_SEGMS_LOADED_PERSUB] is not None else 1000
         self.batchsize_train = cfg[cfg.BATCHSIZE_TR] if cfg[cfg.BATCHSIZE_TR] is not None else errReqBatchSizeTr()
         self.num_parallel_proc_sampling = cfg[cfg.NUM_OF_PROC_SAMPL] if cfg[cfg.NUM_OF_PROC_SAMPL] is not None else 0
+        # Parallel sampling fails if no job finishes for that many secs, while the processes are alive. <= 0: Never.
+        self.timeout_secs_sampling_stalled = \
+            cfg[cfg.TIMEOUT_SAMPL_STALLED] if cfg[cfg.TIMEOUT_SAMPL_STALLED] is not None else 3600
+        self.timeout_secs_sampling_stalled = \
+            self.timeout_secs_sampling_stalled if self.timeout_secs_sampling_stalled > 0 else None
 
         # ~~~~~~~ Learning Rate Schedule ~~~~~~~~
 
@@ -423,6 +428,13 @@ class TrainSessionParameters(object):
         # norm_prms['verbose_lvl']: 0: No logging, 1: Type of cutoffs and timing 2: Stats.
         self.norm_prms = {'verbose_lvl': cfg[cfg.NORM_VERB_LVL] if cfg[cfg.NORM_VERB_LVL] is not None else 0,
                           'zscore': norm_zscore_prms}
+        # == Cache of pre-processed subjects, for sampling. None: No caching. ==
+        self.folder_cache_preproc = \
+            getAbsPathEvenIfRelativeIsGiven(cfg[cfg.FOLDER_CACHE_PREPROC], abs_path_to_cfg) \
+            if cfg[cfg.FOLDER_CACHE_PREPROC] is not None else None
+        # == Precision of stored samples. 32: float32 segments & int32 labels. 16: float16 & uint8 (less RAM) ==
+        self.precision_samples = cfg[cfg.PRECISION_SAMPLES] if cfg[cfg.PRECISION_SAMPLES] is not None else 32
+        assert self.precision_samples in [16, 32]
         
         # ============= OTHERS ==========
         # Others useful internally or for reporting:
@@ -475,6 +487,9 @@ class TrainSessionParameters(object):
         else:
             self.errorRequireOptimizer012()
 
+        # Update the parameters once per that many batches, with the mean of their gradients. Effective batch size = batchsize_train * this.
+        self.num_batches_accum_grads = cfg[cfg.NUM_BATCHES_ACCUM_GRADS] if cfg[cfg.NUM_BATCHES_ACCUM_GRADS] is not None else 1
+        assert self.num_batches_accum_grads >= 1
         self.classicMom0Nesterov1 = cfg[cfg.MOM_TYPE] if cfg[cfg.MOM_TYPE] is not None else 1
         if self.classicMom0Nesterov1 not in [0, 1]:
             self.errorRequireMomentumClass0Nestov1()
@@ -605,6 +620,7 @@ class TrainSessionParameters(object):
                  "optimization-iterations that will be performed every subepoch!")
         logPrint("Batch size (train) = " + str(self.batchsize_train))
         logPrint("Number of parallel processes for sampling = " + str(self.num_parallel_proc_sampling))
+        logPrint("Timeout (secs) for parallel sampling without progress = " + str(self.timeout_secs_sampling_stalled))
 
         logPrint("~~Learning Rate Schedule~~")
         logPrint("Type of schedule = " + str(self.lr_sched_params['type']))
@@ -676,6 +692,11 @@ class TrainSessionParameters(object):
         logPrint(
             "Parameters for Adam: b1= " + str(self.b1Adam) + ", b2=" + str(self.b2Adam) + ", e= " + str(self.eAdam))
         logPrint("Parameters for RmsProp: rho= " + str(self.rhoRms) + ", e= " + str(self.eRms))
+        logPrint("Number of batches to accumulate gradients over, per update of the parameters = " + str(self.num_batches_accum_grads) +
+                 " (Effective batch size = " + str(self.batchsize_train * self.num_batches_accum_grads) + ")")
+        if (self.n_samples_per_subep_train // self.batchsize_train) % self.num_batches_accum_grads != 0:
+            logPrint("WARN: The number of training batches per subepoch is not a multiple of the batches accumulated per update." +
+                     " The gradients of the remaining batches are accumulated towards the first update of the next subepoch.")
         logPrint("Momentum Type: Classic (0) or Nesterov (1) = " + str(self.classicMom0Nesterov1))
         logPrint("Momentum Non-Normalized (0) or Normalized (1) = " + str(self.momNonNormalized0Normalized1))
         logPrint("Momentum Value = " + str(self.momentumValue))
@@ -698,6 +719,10 @@ class TrainSessionParameters(object):
         logPrint("~~Intensity Normalization~~")
         logPrint("Verbosity level = " + str(self.norm_prms['verbose_lvl']))
         logPrint("Z-Score parameters = " + str(self.norm_prms['zscore']))
+        logPrint("~~Caching~~")
+        logPrint("Folder to cache pre-processed subjects for sampling = " + str(self.folder_cache_preproc))
+        logPrint("~~Storage of Samples~~")
+        logPrint("Precision (bits) of sampled segments and labels held in RAM = " + str(self.precision_samples))
 
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================\n")
@@ -731,6 +756,7 @@ class TrainSessionParameters(object):
                 self.n_samples_per_subep_train,
                 self.n_samples_per_subep_val,
                 self.num_parallel_proc_sampling,
+                self.timeout_secs_sampling_stalled,
 
                 # -------Sampling Type---------
                 self.sampling_type_inst_tr,
@@ -757,7 +783,9 @@ class TrainSessionParameters(object):
                 
                 # -------- Pre-Processing ------
                 self.pad_input,
-                self.norm_prms
+                self.norm_prms,
+                self.folder_cache_preproc,
+                self.precision_samples
                 ]
         return args
 
@@ -788,6 +816,7 @@ class TrainSessionParameters(object):
                 self.b2Adam,
                 self.eAdam,
                 self.rhoRms,
-                self.eRms
+                self.eRms,
+                self.num_batches_accum_grads
                 ]
         return args
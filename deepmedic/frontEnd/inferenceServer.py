@@ -0,0 +1,81 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+import os
+import time
+import json
+import traceback
+
+from six.moves import BaseHTTPServer
+
+# Server for segmenting subjects on request, with a model that stays loaded. See TestSession.run_server()
+# Requests are HTTP POSTs with a JSON body:
+#     {"channels": ["/path/to/channel1.nii.gz", ...], # One per input channel, as in the test config.
+#      "roi_mask": "/path/to/roi.nii.gz",              # Optional.
+#      "output": "name"}                                # As an entry of namesForPredictionsPerCase.
+# Relative paths of images are relative to the working directory of the server.
+# Reply is a JSON, {"status": "done", "secs": float} or {"status": "error", "error": str}.
+# A GET replies {"status": "ready"}. Requests are served one at a time, in the order received.
+
+HOST_OF_SERVER = "127.0.0.1" # Only accept requests from the local machine.
+
+
+def make_handler_of_requests(log, segment_subject):
+    # segment_subject: Function(paths_channels, path_roi_mask, name_for_outputs). Segments and saves the outputs.
+
+    class HandlerOfRequests(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def _reply(self, code, content):
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._reply(200, {"status": "ready"})
+
+        def do_POST(self):
+            try:
+                length_of_body = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length_of_body).decode("utf-8"))
+                paths_channels = [os.path.abspath(path) for path in request["channels"]]
+                path_roi_mask = os.path.abspath(request["roi_mask"]) if request.get("roi_mask") is not None else None
+                name_for_outputs = request["output"]
+            except Exception as e:
+                self._reply(400, {"status": "error", "error": "Bad request: " + str(e)})
+                return
+
+            log.print3("SERVER: Segmenting subject with channels: " + str(paths_channels))
+            t_start = time.time()
+            try:
+                segment_subject(paths_channels, path_roi_mask, name_for_outputs)
+            except Exception as e:
+                log.print3("ERROR: Caught exception while serving request: " + str(e))
+                log.print3(traceback.format_exc())
+                self._reply(500, {"status": "error", "error": str(e)})
+                return
+            self._reply(200, {"status": "done", "secs": time.time() - t_start})
+
+        def log_message(self, format, *args):
+            log.print3("SERVER: " + self.address_string() + " " + format % args)
+
+    return HandlerOfRequests
+
+
+def serve_inference(log, port, segment_subject):
+    # Blocks, serving requests, until interrupted (Ctrl+C).
+    server = BaseHTTPServer.HTTPServer((HOST_OF_SERVER, port), make_handler_of_requests(log, segment_subject))
+    log.print3("SERVER: Ready. Listening for requests at http://" + HOST_OF_SERVER + ":" + str(port) + "/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.print3("SERVER: Interrupted. Shutting down.")
+    finally:
+        server.server_close()
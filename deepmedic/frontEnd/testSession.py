@@ -15,6 +15,8 @@ from deepmedic.frontEnd.sessHelpers import makeFoldersNeededForTestingSession, h
 
 from deepmedic.neuralnet.cnn3d import Cnn3d
 from deepmedic.routines.testing import inference_on_whole_volumes
+from deepmedic.dataManagement.augmentSample import get_axes_and_planes_of_tta
+from deepmedic.frontEnd.inferenceServer import serve_inference
 
 import tensorflow as tf
 
@@ -49,6 +51,12 @@ class TestSession(Session):
                                     num_classes = model_params.numberClasses,
                                     cfg = self._cfg )
         
+        if self._params.tta_prms is not None:
+            # Size of segments is only checked if not adapted to the memory budget later. Then it is made valid.
+            (axes_tta, planes_rot_tta) = get_axes_and_planes_of_tta(self._params.tta_prms)
+            model_params.check_segm_dim_infer_for_tta( axes_tta, planes_rot_tta,
+                                                       check_segm_dims = self._params.mem_budget_segm_dim_infer is None )
+        
         self._log.print3("")
         self._log.print3("============     NEW TESTING SESSION    ===============")
         self._params.print_params()    
@@ -78,9 +86,22 @@ class TestSession(Session):
             print("Exiting as requested."); exit(0)
     
     
-    def run_session(self, *args):
-        (sess_device,
-         model_params,) = args
+    def _get_scope_of_ensemble_member(self, member_i):
+        return "net_ensemble" + str(member_i)
+    
+    def _build_graph(self, sess_device, model_params):
+        # Returns the graph with the main cnn, the members of an ensemble (if any) and the savers to restore them.
+        if self._params.mem_budget_segm_dim_infer is not None:
+            # Larger segments than in the model config, to predict each volume in fewer passes. ...
+            # ... The graph is built once for this size, and used for all cases.
+            # Every batch runs through the main model and all members of the ensemble, so the budget is shared by all.
+            (axes_tta, planes_rot_tta) = get_axes_and_planes_of_tta(self._params.tta_prms)
+            model_params.adapt_segm_dim_infer_to_mem( self._params.mem_budget_segm_dim_infer,
+                                                      self._params.batchsize,
+                                                      self._params.calc_max_segm_dim_infer(model_params.receptiveFieldNormal),
+                                                      1 + len(self._params.get_paths_to_load_ensemble_from()),
+                                                      axes_tta,
+                                                      planes_rot_tta )
         
         graphTf = tf.Graph()
         
@@ -89,43 +110,103 @@ class TestSession(Session):
                 self._log.print3("=========== Making the CNN graph... ===============")
                 cnn3d = Cnn3d()
                 with tf.variable_scope("net"):
-                    cnn3d.make_cnn_model( *model_params.get_args_for_arch() ) # Creates the network's graph (without optimizer).
+                    # Creates the network's graph (without optimizer). Only the operations for testing are built.
+                    cnn3d.make_cnn_model( *model_params.get_args_for_arch(), modes=["test"] )
+                # Members of an ensemble. Same architecture, in the same graph, so that each batch runs through all.
+                cnns_ensemble = []
+                for member_i in range(len(self._params.get_paths_to_load_ensemble_from())):
+                    self._log.print3("=========== Making the CNN graph of ensemble member #" + str(member_i) + "... ===============")
+                    cnn_member = Cnn3d()
+                    with tf.variable_scope(self._get_scope_of_ensemble_member(member_i)):
+                        cnn_member.make_cnn_model( *model_params.get_args_for_arch(), modes=["test"] )
+                    cnns_ensemble.append(cnn_member)
                     
             self._log.print3("=========== Compiling the Testing Function ============")
             self._log.print3("=======================================================\n")
             
             cnn3d.setup_ops_n_feeds_to_test( self._log,
                                              self._params.indices_fms_per_pathtype_per_layer_to_save )
-            # Create the saver
-            saver_all = tf.train.Saver() # saver_net would suffice
+            for cnn_member in cnns_ensemble:
+                cnn_member.setup_ops_n_feeds_to_test( self._log, None ) # Feature maps are only saved from cnn3d.
+            # Create the saver. Only of the main net. "net/" so that scopes of ensemble members are not matched.
+            saver_all = tf.train.Saver( var_list=tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="net/") )
+            # A saver per ensemble member, mapping the names in the checkpoints (under "net") to the member's scope.
+            savers_ensemble = []
+            for member_i in range(len(cnns_ensemble)):
+                scope_member = self._get_scope_of_ensemble_member(member_i)
+                vars_member = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=scope_member + "/")
+                savers_ensemble.append( tf.train.Saver( var_list={ "net" + var.op.name[len(scope_member):]: var for var in vars_member } ) )
+                
+        return graphTf, cnn3d, cnns_ensemble, saver_all, savers_ensemble
+    
+    def _load_or_init_params(self, sessionTf, saver_all, savers_ensemble):
+        file_to_load_params_from = self._params.get_path_to_load_model_from()
+        if file_to_load_params_from is not None: # Load params
+            self._log.print3("=========== Loading parameters from specified saved model ===============")
+            chkpt_fname = tf.train.latest_checkpoint( file_to_load_params_from ) if os.path.isdir( file_to_load_params_from ) else file_to_load_params_from
+            self._log.print3("Loading parameters from:" + str(chkpt_fname))
+            try:
+                saver_all.restore(sessionTf, chkpt_fname)
+                self._log.print3("Parameters were loaded.")
+            except Exception as e: handle_exception_tf_restore(self._log, e)
+        else:
+            self._ask_user_if_test_with_random() # Asks user whether to continue with randomly initialized model. It exits if no is given.
+            self._log.print3("")
+            self._log.print3("=========== Initializing network variables  ===============")
+            # Only the main net. "net/" so that scopes of ensemble members are not matched. They are loaded below.
+            tf.variables_initializer( var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="net/") ).run()
+            self._log.print3("Model variables were initialized.")
+        
+        # Members of the ensemble are always loaded, even if the main model was not.
+        for member_i in range(len(savers_ensemble)):
+            path_member = self._params.get_paths_to_load_ensemble_from()[member_i]
+            chkpt_fname = tf.train.latest_checkpoint( path_member ) if os.path.isdir( path_member ) else path_member
+            self._log.print3("Loading parameters of ensemble member #" + str(member_i) + " from:" + str(chkpt_fname))
+            try:
+                savers_ensemble[member_i].restore(sessionTf, chkpt_fname)
+                self._log.print3("Parameters were loaded.")
+            except Exception as e: handle_exception_tf_restore(self._log, e)
             
+    def run_session(self, *args):
+        (sess_device,
+         model_params,) = args
+        
+        (graphTf, cnn3d, cnns_ensemble, saver_all, savers_ensemble) = self._build_graph(sess_device, model_params)
+        
         with tf.Session( graph=graphTf, config=tf.ConfigProto(log_device_placement=False, device_count={'CPU':999, 'GPU':99}) ) as sessionTf:
-            file_to_load_params_from = self._params.get_path_to_load_model_from()
-            if file_to_load_params_from is not None: # Load params
-                self._log.print3("=========== Loading parameters from specified saved model ===============")
-                chkpt_fname = tf.train.latest_checkpoint( file_to_load_params_from ) if os.path.isdir( file_to_load_params_from ) else file_to_load_params_from
-                self._log.print3("Loading parameters from:" + str(chkpt_fname))
-                try:
-                    saver_all.restore(sessionTf, chkpt_fname)
-                    self._log.print3("Parameters were loaded.")
-                except Exception as e: handle_exception_tf_restore(self._log, e)
-                
-            else:
-                self._ask_user_if_test_with_random() # Asks user whether to continue with randomly initialized model. It exits if no is given.
-                self._log.print3("")
-                self._log.print3("=========== Initializing network variables  ===============")
-                tf.variables_initializer( var_list = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="net") ).run()
-                self._log.print3("Model variables were initialized.")
-                
+            self._load_or_init_params(sessionTf, saver_all, savers_ensemble)
                 
             self._log.print3("")
             self._log.print3("======================================================")
             self._log.print3("=========== Testing with the CNN model ===============")
             self._log.print3("======================================================")
             
-            res_code = inference_on_whole_volumes( *( [sessionTf, cnn3d] + self._params.get_args_for_testing() ) )
+            res_code = inference_on_whole_volumes( *( [sessionTf, cnn3d] + self._params.get_args_for_testing() + [cnns_ensemble] ) )
         
         self._log.print3("")
         self._log.print3("======================================================")
         self._log.print3("=========== Testing session finished =================")
         self._log.print3("======================================================")
+        
+    def run_server(self, sess_device, model_params, port):
+        # Builds the graph and loads the parameters once. Then segments subjects on request, until interrupted.
+        # The cases listed in the config are not segmented. They are only used if the size of segments is adapted.
+        (graphTf, cnn3d, cnns_ensemble, saver_all, savers_ensemble) = self._build_graph(sess_device, model_params)
+        
+        with tf.Session( graph=graphTf, config=tf.ConfigProto(log_device_placement=False, device_count={'CPU':999, 'GPU':99}) ) as sessionTf:
+            self._load_or_init_params(sessionTf, saver_all, savers_ensemble)
+            
+            def segment_subject(paths_channels, path_roi_mask, name_for_outputs):
+                args_for_testing = self._params.get_args_for_serving_request(paths_channels, path_roi_mask, name_for_outputs)
+                inference_on_whole_volumes( *( [sessionTf, cnn3d] + args_for_testing + [cnns_ensemble] ) )
+                
+            self._log.print3("")
+            self._log.print3("======================================================")
+            self._log.print3("=========== Serving the CNN model ====================")
+            self._log.print3("======================================================")
+            serve_inference(self._log, port, segment_subject)
+            
+        self._log.print3("")
+        self._log.print3("======================================================")
+        self._log.print3("=========== Inference server finished ================")
+        self._log.print3("======================================================")
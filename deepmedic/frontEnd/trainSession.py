@@ -189,6 +189,9 @@ class TrainSession(Session):
                 # tf.train.write_graph( graph_or_graph_def=sessionTf.graph.as_graph_def(),
                 # logdir="", name=filename_to_save_with+".graph.pb", as_text=False)
 
+            # Local variables of trainer (eg accumulators of gradients) are not saved/loaded. Always initialize.
+            tf.variables_initializer(var_list=tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope="trainer")).run()
+
             self._log.print3("")
             self._log.print3("=======================================================")
             self._log.print3("============== Training the CNN model =================")
@@ -11,6 +11,17 @@ import numpy as np
 from deepmedic.logging.utils import strFl4fNA, strFl5fNA, strListFl4fNA, strListFl5fNA, getMeanOfListExclNA
 
 
+def getPerClassRpRnTpTnFromConfMatrix(confMatrix) :
+    # confMatrix: Classes X Classes. Entry [i, j] is the number of samples with real class i, predicted as class j.
+    # Returns: Classes X 4. The Real Pos, Real Neg, True Pos (pred), True Neg (pred) of each class, in a One-Vs-All fashion.
+    numberOfAllSamples = confMatrix.sum()
+    realPosPerClass = confMatrix.sum(axis=1)
+    predPosPerClass = confMatrix.sum(axis=0)
+    truePosPerClass = np.diagonal(confMatrix)
+    trueNegPerClass = numberOfAllSamples - realPosPerClass - predPosPerClass + truePosPerClass
+    return np.stack([realPosPerClass, numberOfAllSamples - realPosPerClass, truePosPerClass, trueNegPerClass], axis=1)
+
+
 class AccuracyMonitorForEpSegm(object):
     
     NA_PATTERN = "N/A"  # not applicable. Eg for accuracy when class not present.
@@ -45,6 +56,7 @@ class AccuracyMonitorForEpSegm(object):
         # --- Per Class Accuracies and Real/True Pos/Neg (in a One-Vs-All fashion)
         # These do not have the class-0 background flipped to foreground!
         
+        self.listPerSubepConfMatrix = [] # subepochs X Classes X Classes. Only if updated with update_metrics_after_subep_from_conf_matrix()
         self.listPerSubepPerClassRpRnTpTn = [] # subepochs X Classes X 4. 4 = RP, RN, TP, TN
         self.listPerSubepPerClassMeanAccSensSpecDsc = [] # NOTE: May contain N0T-APPLICABLE=self.NA_PATTERN elements, eg when class not present!
         
@@ -57,6 +69,12 @@ class AccuracyMonitorForEpSegm(object):
         return np.mean(self.meanEmpiricalAccuracyOfEachSubep)
     
     
+    # Same as update_metrics_after_subep(), but from the full confusion matrix of the subepoch, which is also kept and reported.
+    def update_metrics_after_subep_from_conf_matrix(self, meanCostOfSubepoch, confMatrixInSubep):
+        # confMatrixInSubep: Classes X Classes. Entry [i, j] is the number of samples with real class i, predicted as class j.
+        self.listPerSubepConfMatrix.append(confMatrixInSubep)
+        self.update_metrics_after_subep(meanCostOfSubepoch, getPerClassRpRnTpTnFromConfMatrix(confMatrixInSubep))
+        
     # Generic. Does not flip the class-0 background class.
     def update_metrics_after_subep(self, meanCostOfSubepoch, perClassRpRnTpTnInSubep):
         # perClassRpRnTpTnInSubep # Class X 4. The Real Pos, Real Neg, True Pos (pred), True Neg (pred).
@@ -123,6 +141,10 @@ class AccuracyMonitorForEpSegm(object):
                         "\t=> Correctly-Classified-Voxels/All-Predicted-Voxels = " + str(self.correctlyPredVoxelsInEachSubep[currSubep]) + "/" + str(self.numberOfAllSamplesOfEachSubep[currSubep]) )
         if self.training0orValidation1 == 0:  # During training, also report the mean value of the Cost Function:
             self.log.print3(logStr + ", Overall:\t mean cost:      \t" + strFl5fNA(self.meanCostOfEachSubep[currSubep], self.NA_PATTERN))
+        if len(self.listPerSubepConfMatrix) == self.numberOfSubepochsForWhichUpdated : # If updated with confusion matrices.
+            self.log.print3(logStr + ", Overall:\t confusion matrix (Row: Real class, Column: Predicted class):")
+            for class_i in range(self.numberOfClasses):
+                self.log.print3("\t Class-" + str(class_i) + ":\t" + "\t".join([ str(numOfSamples) for numOfSamples in self.listPerSubepConfMatrix[currSubep][class_i] ]))
             
         # Report accuracy over subepoch for each class_i:
         for class_i in range(self.numberOfClasses):
@@ -16,30 +16,23 @@ import tensorflow as tf
 from deepmedic.neuralnet.pathwayTypes import PathwayTypes as pt
 from deepmedic.neuralnet.pathways import NormalPathway, SubsampledPathway, FcPathway
 from deepmedic.neuralnet.layers import SoftmaxLayer
+from deepmedic.neuralnet.ops import DATA_FORMATS, getAxisOfFms, getAxesOfRcz, sliceAlongAxes, transposeFromNCDHW
 
 from deepmedic.neuralnet.utils import calcRecFieldFromKernDimListPerLayerWhenStrides1
 
 ######### Helper functions used in this module ########
 
-def padImageWithMirroring(inputImage, voxelsPerDimToPad) :
-    # inputImage shape: [batchSize, #channels#, r, c, z]
-    # inputImageDimensions : [ batchSize, #channels, dim r, dim c, dim z ] of inputImage
+def padImageWithMirroring(inputImage, voxelsPerDimToPad, dataFormat) :
+    # inputImage shape: [batchSize, #channels#, r, c, z] or [batchSize, r, c, z, #channels#], as dataFormat.
     # voxelsPerDimToPad shape: [ num o voxels in r-dim to add, ...c-dim, ...z-dim ]
     # If voxelsPerDimToPad is odd, 1 more voxel is added to the right side.
-    # r-axis
     assert np.all(voxelsPerDimToPad) >= 0
-    padLeft = int(voxelsPerDimToPad[0] // 2); padRight = int((voxelsPerDimToPad[0] + 1) // 2);
-    paddedImage = tf.concat([inputImage[:, :, int(voxelsPerDimToPad[0] // 2) - 1::-1 , :, :], inputImage], axis=2) if padLeft > 0 else inputImage
-    paddedImage = tf.concat([paddedImage, paddedImage[ :, :, -1:-1 - int((voxelsPerDimToPad[0] + 1) // 2):-1, :, :]], axis=2) if padRight > 0 else paddedImage
-    # c-axis
-    padLeft = int(voxelsPerDimToPad[1] // 2); padRight = int((voxelsPerDimToPad[1] + 1) // 2);
-    paddedImage = tf.concat([paddedImage[:, :, :, padLeft - 1::-1 , :], paddedImage], axis=3) if padLeft > 0 else paddedImage
-    paddedImage = tf.concat([paddedImage, paddedImage[:, :, :, -1:-1 - padRight:-1, :]], axis=3) if padRight > 0 else paddedImage
-    # z-axis
-    padLeft = int(voxelsPerDimToPad[2] // 2); padRight = int((voxelsPerDimToPad[2] + 1) // 2)
-    paddedImage = tf.concat([paddedImage[:, :, :, :, padLeft - 1::-1 ], paddedImage], axis=4) if padLeft > 0 else paddedImage
-    paddedImage = tf.concat([paddedImage, paddedImage[:, :, :, :, -1:-1 - padRight:-1]], axis=4) if padRight > 0 else paddedImage
-    
+    paddedImage = inputImage
+    for rcz_i, axis in enumerate(getAxesOfRcz(dataFormat)) :
+        padLeft = int(voxelsPerDimToPad[rcz_i] // 2); padRight = int((voxelsPerDimToPad[rcz_i] + 1) // 2)
+        paddedImage = tf.concat([sliceAlongAxes(paddedImage, {axis: slice(padLeft - 1, None, -1)}), paddedImage], axis=axis) if padLeft > 0 else paddedImage
+        paddedImage = tf.concat([paddedImage, sliceAlongAxes(paddedImage, {axis: slice(-1, -1 - padRight, -1)})], axis=axis) if padRight > 0 else paddedImage
+        
     return paddedImage
 
 
@@ -59,6 +52,11 @@ class Cnn3d(object):
         
         self.finalTargetLayer = ""
         
+        # Modes ("train", "val", "test") that the model is built for. Operations are built once per mode. See make_cnn_model()
+        self._modes = []
+        # Layout of the tensors inside the model. See ops.DATA_FORMATS. Fed inputs and returned outputs are always [batch, chans, r, c, z].
+        self._dataFormat = None
+        
         self.num_classes = None
         
         #=====================================
@@ -80,15 +78,14 @@ class Cnn3d(object):
         
         #======= Input tensors X. Placeholders OR given tensors =======
         # Symbolic variables, which stand for the input. Will be loaded by the compiled trainining/val/test function. Can also be pre-set by an existing tensor if required in future extensions.
-        self._inp_x = { 'train': {},
-                        'val': {},
-                        'test': {} }
+        # One entry per mode built.
+        self._inp_x = {}
         
         
         #======= Output tensors Y_GT ========
         # For each targetLayer, I should be placing a y_gt placeholder/feed, by calls to finalTargetLayer.get_output_gt_tensor_feed()
-        self._output_gt_tensor_feeds = {'train': {},
-                                   'val': {} }
+        # One entry per mode built, from 'train' and 'val'.
+        self._output_gt_tensor_feeds = {}
         
         ######## These entries are setup in the setup_train/val/test functions here ############
         self._ops_main = { 'train': {} , 'val': {}, 'test': {} }
@@ -109,6 +106,11 @@ class Cnn3d(object):
                 count += 1
         return count
     
+    def getModes(self):
+        return self._modes
+    def getDataFormat(self):
+        return self._dataFormat
+    
     def getFcPathway(self):
         for pathway in self.pathways :
             if pathway.pType() == pt.FC :
@@ -117,18 +119,10 @@ class Cnn3d(object):
     
 
         
-    # for inference with batch-normalization. Every training batch, this is called to update an internal matrix of each layer, with the last mus and vars, so that I can compute the rolling average for inference.
-    def updateMatricesOfBnMovingAvForInference(self, sessionTf) :
-        self._updateMatricesOfBnMovingAvForInference(sessionTf)
-        
-    def _updateMatricesOfBnMovingAvForInference(self, sessionTf):
-        for pathway in self.pathways :
-            for layer in pathway.getLayers() :
-                layer.updateMatricesOfBnMovingAvForInference(sessionTf)  # Will do nothing if no BN.
-                    
     def _getUpdatesForBnRollingAverage(self) :
-        # These are not the variables of the normalization of the FMs' distributions that are optimized during training. These are only the Mu and Stds that are used during inference,
-        # ... and here we update the sharedVariable which is used "from the outside during do_training()" to update the rolling-average-matrix for inference. Do for all layers.
+        # These are not the variables of the normalization of the FMs' distributions that are optimized during training. These are only the Mu and Stds that are used during inference.
+        # Every training batch, the internal matrix of each layer is updated with the last mus and vars, to compute the rolling average for inference. Do for all layers.
+        # Grouped with the training step, so that no extra session.run is needed per batch.
         updatesForBnRollingAverage = []
         for pathway in self.pathways :
             for layer in pathway.getLayers() :
@@ -170,6 +164,7 @@ class Cnn3d(object):
     
     def setup_ops_n_feeds_to_train(self, log, total_cost, updates_of_params_wrt_total_cost) :
         log.print3("...Building the training function...")
+        assert "train" in self._modes
         
         y_gt = self._output_gt_tensor_feeds['train']['y_gt']
         
@@ -181,7 +176,7 @@ class Cnn3d(object):
         log.print3("...Collecting ops and feeds for training...")
         
         self._ops_main['train']['cost'] = total_cost
-        self._ops_main['train']['list_rp_rn_tp_tn'] = self.finalTargetLayer.getRpRnTpTnForTrain0OrVal1(y_gt, 0)
+        self._ops_main['train']['conf_matrix'] = self.finalTargetLayer.getConfusionMatrixForTrain0OrVal1(y_gt, 0)
         self._ops_main['train']['updates_grouped_op'] = updates_grouped_op
         
         self._feeds_main['train']['x'] = self._inp_x['train']['x']
@@ -193,13 +188,14 @@ class Cnn3d(object):
         
     def setup_ops_n_feeds_to_val(self, log) :
         log.print3("...Building the validation function...")
+        assert "val" in self._modes
         
         y_gt = self._output_gt_tensor_feeds['val']['y_gt']
         
         log.print3("...Collecting ops and feeds for validation...")
         
         self._ops_main['val'] = {}
-        self._ops_main['val']['list_rp_rn_tp_tn'] = self.finalTargetLayer.getRpRnTpTnForTrain0OrVal1(y_gt, 1)
+        self._ops_main['val']['conf_matrix'] = self.finalTargetLayer.getConfusionMatrixForTrain0OrVal1(y_gt, 1)
         
         self._feeds_main['val'] = {}
         self._feeds_main['val']['x'] = self._inp_x['val']['x']
@@ -212,6 +208,7 @@ class Cnn3d(object):
         
     def setup_ops_n_feeds_to_test(self, log, indices_fms_per_pathtype_per_layer_to_save=None) :
         log.print3("...Building the function for testing and visualisation of FMs...")
+        assert "test" in self._modes
         
         listToReturnWithAllTheFmActivationsPerLayer = []
         if indices_fms_per_pathtype_per_layer_to_save is not None:
@@ -239,24 +236,19 @@ class Cnn3d(object):
         
         
     def _setupInputXTensors(self):
-        self._inp_x['train']['x'] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_train")
-        self._inp_x['val']['x'] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_val")
-        self._inp_x['test']['x'] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_test")
-        for subpath_i in range(self.numSubsPaths) : # if there are subsampled paths...
-            self._inp_x['train']['x_sub_'+str(subpath_i)] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_sub_"+str(subpath_i)+"_train")
-            self._inp_x['val']['x_sub_'+str(subpath_i)] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_sub_"+str(subpath_i)+"_val")
-            self._inp_x['test']['x_sub_'+str(subpath_i)] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_sub_"+str(subpath_i)+"_test")
+        for mode in self._modes :
+            self._inp_x[mode] = {}
+            self._inp_x[mode]['x'] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_"+mode)
+            for subpath_i in range(self.numSubsPaths) : # if there are subsampled paths...
+                self._inp_x[mode]['x_sub_'+str(subpath_i)] = tf.placeholder(dtype="float32", shape=[None, None, None, None, None], name="inp_x_sub_"+str(subpath_i)+"_"+mode)
             
         
-    def _setupInputXTensorsFromGivenArgs(self, givenInputTensorNormTrain, givenInputTensorNormVal, givenInputTensorNormTest,
-                                         givenListInputTensorPerSubsTrain, givenListInputTensorPerSubsVal, givenListInputTensorPerSubsTest):
-        self._inp_x['train']['x'] = givenInputTensorNormTrain
-        self._inp_x['val']['x'] = givenInputTensorNormVal
-        self._inp_x['test']['x'] = givenInputTensorNormTest
-        for subpath_i in range(self.numSubsPaths):
-            self._inp_x['train']['x_sub_'+str(subpath_i)] = givenListInputTensorPerSubsTrain[subpath_i]
-            self._inp_x['val']['x_sub_'+str(subpath_i)] = givenListInputTensorPerSubsVal[subpath_i]
-            self._inp_x['test']['x_sub_'+str(subpath_i)] = givenListInputTensorPerSubsTest[subpath_i]
+    def _setupInputXTensorsFromGivenArgs(self, givenInputTensorNormPerMode, givenListInputTensorPerSubsPerMode):
+        for mode in self._modes :
+            self._inp_x[mode] = {}
+            self._inp_x[mode]['x'] = givenInputTensorNormPerMode[mode]
+            for subpath_i in range(self.numSubsPaths):
+                self._inp_x[mode]['x_sub_'+str(subpath_i)] = givenListInputTensorPerSubsPerMode[mode][subpath_i]
         
         
     def _getClassificationLayer(self):
@@ -310,9 +302,19 @@ class Cnn3d(object):
                         applyBnToInputOfPathways,  # one Boolean flag per pathway type. Placeholder for the FC pathway.
                         movingAvForBnOverXBatches,
                         
+                        #=== Modes to build the model for ===
+                        # Operations are built only for these, sharing the same parameters. Eg only "test" for a testing session.
+                        modes=("train", "val", "test"),
+                        #=== Layout of the tensors inside the model ===
+                        # "NDHWC" (channels last) is native to tf's conv3d and pooling, avoiding transposes around them.
+                        # "NCDHW" is the original layout. Saved models can be loaded with either.
+                        dataFormat="NDHWC"
                         ):
         
         self.cnnModelName = cnnModelName
+        self._modes = [ mode for mode in ["train", "val", "test"] if mode in modes ]
+        assert dataFormat in DATA_FORMATS
+        self._dataFormat = dataFormat
         
         # ============= Model Parameters Passed as arguments ================
         self.num_classes = numberOfOutputClasses
@@ -352,7 +354,7 @@ class Cnn3d(object):
         if True: # Not given input tensors as arguments
             self._setupInputXTensors()
         else: # Inputs given as argument tensors. Eg in adv from discr or from batcher.
-            self._setupInputXTensorsFromGivenArgs(1,2,3,4,5,6) # Placeholder. Todo: Replace with normal arguments, when input tensor is given. Eg adversarial G.
+            self._setupInputXTensorsFromGivenArgs(1,2) # Placeholder. Todo: Replace with normal arguments, when input tensor is given. Eg adversarial G.
 
         
         #=======================Make the NORMAL PATHWAY of the CNN=======================
@@ -360,12 +362,12 @@ class Cnn3d(object):
         self.pathways.append(thisPathway)
         thisPathwayType = thisPathway.pType()
         
-        inputToPathwayTrain = self._inp_x['train']['x']
-        inputToPathwayVal = self._inp_x['val']['x']
-        inputToPathwayTest = self._inp_x['test']['x']
-        inputToPathwayShapeTrain = [None, numberOfImageChannelsPath1] + imagePartDimensionsTraining
-        inputToPathwayShapeVal = [None, numberOfImageChannelsPath1] + imagePartDimensionsValidation
-        inputToPathwayShapeTest = [None, numberOfImageChannelsPath1] + imagePartDimensionsTesting
+        imagePartDimensionsPerMode = {"train": imagePartDimensionsTraining, "val": imagePartDimensionsValidation, "test": imagePartDimensionsTesting}
+        inputToPathwayPerMode = {}
+        inputToPathwayShapePerMode = {}
+        for mode in self._modes :
+            inputToPathwayPerMode[mode] = transposeFromNCDHW(self._inp_x[mode]['x'], self._dataFormat) # Inputs are fed as [batch, chans, r, c, z].
+            inputToPathwayShapePerMode[mode] = [None, numberOfImageChannelsPath1] + imagePartDimensionsPerMode[mode]
         
         thisPathWayNKerns = nkerns
         thisPathWayKernelDimensions = kernelDimensions
@@ -379,12 +381,8 @@ class Cnn3d(object):
         
         thisPathway.makeLayersOfThisPathwayAndReturnDimensionsOfOutputFM(log,
                                                                          rng,
-                                                                         inputToPathwayTrain,
-                                                                         inputToPathwayVal,
-                                                                         inputToPathwayTest,
-                                                                         inputToPathwayShapeTrain,
-                                                                         inputToPathwayShapeVal,
-                                                                         inputToPathwayShapeTest,
+                                                                         inputToPathwayPerMode,
+                                                                         inputToPathwayShapePerMode,
                                                                          
                                                                          thisPathWayNKerns,
                                                                          thisPathWayKernelDimensions,
@@ -399,10 +397,11 @@ class Cnn3d(object):
                                                                          
                                                                          indicesOfLowerRankLayersPerPathway[thisPathwayType],
                                                                          ranksOfLowerRankLayersForEachPathway[thisPathwayType],
-                                                                         indicesOfLayersToConnectResidualsInOutput[thisPathwayType]
+                                                                         indicesOfLayersToConnectResidualsInOutput[thisPathwayType],
+                                                                         self._dataFormat
                                                                          )
         
-        [dimsOfOutputFrom1stPathwayTrain, dimsOfOutputFrom1stPathwayVal, dimsOfOutputFrom1stPathwayTest] = thisPathway.getShapeOfOutput()
+        dimsOfOutputFrom1stPathwayPerMode = thisPathway.getShapeOfOutput()
         
         #=======================Make the SUBSAMPLED PATHWAYs of the CNN=============================
         for subpath_i in range(self.numSubsPaths) :
@@ -410,10 +409,6 @@ class Cnn3d(object):
             self.pathways.append(thisPathway) # There will be at least an entry as a secondary pathway. But it won't have any layers if it was not actually used.
             thisPathwayType = thisPathway.pType()
             
-            inputToPathwayTrain = self._inp_x['train']['x_sub_'+str(subpath_i)]
-            inputToPathwayVal = self._inp_x['val']['x_sub_'+str(subpath_i)]
-            inputToPathwayTest = self._inp_x['test']['x_sub_'+str(subpath_i)]
-            
             thisPathWayNKerns = nkernsSubsampled[subpath_i]
             thisPathWayKernelDimensions = kernelDimensionsSubsampled
             
@@ -424,18 +419,16 @@ class Cnn3d(object):
             thisPathwayActivFuncPerLayer = [activationFunc] * thisPathwayNumOfLayers
             thisPathwayActivFuncPerLayer[0] = "linear" if thisPathwayType != pt.FC else activationFunc  # To not apply activation on raw input. -1 is linear activation.
             
-            inputToPathwayShapeTrain = [None, numberOfImageChannelsPath2] + thisPathway.calcInputRczDimsToProduceOutputFmsOfCompatibleDims(thisPathWayKernelDimensions, dimsOfOutputFrom1stPathwayTrain);
-            inputToPathwayShapeVal = [None, numberOfImageChannelsPath2] + thisPathway.calcInputRczDimsToProduceOutputFmsOfCompatibleDims(thisPathWayKernelDimensions, dimsOfOutputFrom1stPathwayVal)
-            inputToPathwayShapeTest = [None, numberOfImageChannelsPath2] + thisPathway.calcInputRczDimsToProduceOutputFmsOfCompatibleDims(thisPathWayKernelDimensions, dimsOfOutputFrom1stPathwayTest)
+            inputToPathwayPerMode = {}
+            inputToPathwayShapePerMode = {}
+            for mode in self._modes :
+                inputToPathwayPerMode[mode] = transposeFromNCDHW(self._inp_x[mode]['x_sub_'+str(subpath_i)], self._dataFormat)
+                inputToPathwayShapePerMode[mode] = [None, numberOfImageChannelsPath2] + thisPathway.calcInputRczDimsToProduceOutputFmsOfCompatibleDims(thisPathWayKernelDimensions, dimsOfOutputFrom1stPathwayPerMode[mode])
             
             thisPathway.makeLayersOfThisPathwayAndReturnDimensionsOfOutputFM(log,
                                                                      rng,
-                                                                     inputToPathwayTrain,
-                                                                     inputToPathwayVal,
-                                                                     inputToPathwayTest,
-                                                                     inputToPathwayShapeTrain,
-                                                                     inputToPathwayShapeVal,
-                                                                     inputToPathwayShapeTest,
+                                                                     inputToPathwayPerMode,
+                                                                     inputToPathwayShapePerMode,
                                                                      thisPathWayNKerns,
                                                                      thisPathWayKernelDimensions,
                                                                      
@@ -449,27 +442,25 @@ class Cnn3d(object):
                                                                      
                                                                      indicesOfLowerRankLayersPerPathway[thisPathwayType],
                                                                      ranksOfLowerRankLayersForEachPathway[thisPathwayType],
-                                                                     indicesOfLayersToConnectResidualsInOutput[thisPathwayType]
+                                                                     indicesOfLayersToConnectResidualsInOutput[thisPathwayType],
+                                                                     self._dataFormat
                                                                      )
             
             
             # this creates essentially the "upsampling layer"
             thisPathway.upsampleOutputToNormalRes(upsamplingScheme="repeat",
-                                                  shapeToMatchInRczTrain=dimsOfOutputFrom1stPathwayTrain,
-                                                  shapeToMatchInRczVal=dimsOfOutputFrom1stPathwayVal,
-                                                  shapeToMatchInRczTest=dimsOfOutputFrom1stPathwayTest)
+                                                  shapeToMatchInRczPerMode=dimsOfOutputFrom1stPathwayPerMode)
             
             
         #====================================CONCATENATE the output of the 2 cnn-pathways=============================
-        inputToFirstFcLayerTrain = None; inputToFirstFcLayerVal = None; inputToFirstFcLayerTest = None; numberOfFmsOfInputToFirstFcLayer = 0
+        inputToFirstFcLayerPerMode = {}; numberOfFmsOfInputToFirstFcLayer = 0
         for path_i in range(len(self.pathways)) :
-            [outputNormResOfPathTrain, outputNormResOfPathVal, outputNormResOfPathTest] = self.pathways[path_i].getOutputAtNormalRes()
-            [dimsOfOutputNormResOfPathTrain, dimsOfOutputNormResOfPathVal, dimsOfOutputNormResOfPathTest] = self.pathways[path_i].getShapeOfOutputAtNormalRes()
+            outputNormResOfPathPerMode = self.pathways[path_i].getOutputAtNormalRes()
+            dimsOfOutputNormResOfPathPerMode = self.pathways[path_i].getShapeOfOutputAtNormalRes()
             
-            inputToFirstFcLayerTrain =  tf.concat([inputToFirstFcLayerTrain, outputNormResOfPathTrain], axis=1) if path_i != 0 else outputNormResOfPathTrain
-            inputToFirstFcLayerVal = tf.concat([inputToFirstFcLayerVal, outputNormResOfPathVal], axis=1) if path_i != 0 else outputNormResOfPathVal
-            inputToFirstFcLayerTest = tf.concat([inputToFirstFcLayerTest, outputNormResOfPathTest], axis=1) if path_i != 0 else outputNormResOfPathTest
-            numberOfFmsOfInputToFirstFcLayer += dimsOfOutputNormResOfPathTrain[1]
+            for mode in self._modes :
+                inputToFirstFcLayerPerMode[mode] = tf.concat([inputToFirstFcLayerPerMode[mode], outputNormResOfPathPerMode[mode]], axis=getAxisOfFms(self._dataFormat)) if path_i != 0 else outputNormResOfPathPerMode[mode]
+            numberOfFmsOfInputToFirstFcLayer += dimsOfOutputNormResOfPathPerMode[self._modes[0]][1]
         
         #======================= Make the Fully Connected Layers =======================
         thisPathway = FcPathway()
@@ -485,16 +476,13 @@ class Cnn3d(object):
         voxelsToPadPerDim = [ kernelDim - 1 for kernelDim in firstFcLayerAfterConcatenationKernelShape ]
         log.print3("DEBUG: Shape of the kernel of the first FC layer is : " + str(firstFcLayerAfterConcatenationKernelShape))
         log.print3("DEBUG: Input to the FC Pathway will be padded by that many voxels per dimension: " + str(voxelsToPadPerDim))
-        inputToPathwayTrain = padImageWithMirroring(inputToFirstFcLayerTrain, voxelsToPadPerDim)
-        inputToPathwayVal = padImageWithMirroring(inputToFirstFcLayerVal, voxelsToPadPerDim)
-        inputToPathwayTest = padImageWithMirroring(inputToFirstFcLayerTest, voxelsToPadPerDim)
-        inputToPathwayShapeTrain = [None, numberOfFmsOfInputToFirstFcLayer] + dimsOfOutputFrom1stPathwayTrain[2:5]
-        inputToPathwayShapeVal = [None, numberOfFmsOfInputToFirstFcLayer] + dimsOfOutputFrom1stPathwayVal[2:5]
-        inputToPathwayShapeTest = [None, numberOfFmsOfInputToFirstFcLayer] + dimsOfOutputFrom1stPathwayTest[2:5]
-        for rcz_i in range(3) : 
-            inputToPathwayShapeTrain[2+rcz_i] += voxelsToPadPerDim[rcz_i]
-            inputToPathwayShapeVal[2+rcz_i] += voxelsToPadPerDim[rcz_i]
-            inputToPathwayShapeTest[2+rcz_i] += voxelsToPadPerDim[rcz_i]
+        inputToPathwayPerMode = {}
+        inputToPathwayShapePerMode = {}
+        for mode in self._modes :
+            inputToPathwayPerMode[mode] = padImageWithMirroring(inputToFirstFcLayerPerMode[mode], voxelsToPadPerDim, self._dataFormat)
+            inputToPathwayShapePerMode[mode] = [None, numberOfFmsOfInputToFirstFcLayer] + dimsOfOutputFrom1stPathwayPerMode[mode][2:5]
+            for rcz_i in range(3) : 
+                inputToPathwayShapePerMode[mode][2+rcz_i] += voxelsToPadPerDim[rcz_i]
         
         thisPathWayNKerns = fcLayersFMs + [self.num_classes]
         thisPathWayKernelDimensions = [firstFcLayerAfterConcatenationKernelShape] + [[1, 1, 1]] * (len(thisPathWayNKerns) - 1)
@@ -508,12 +496,8 @@ class Cnn3d(object):
         
         thisPathway.makeLayersOfThisPathwayAndReturnDimensionsOfOutputFM(log,
                                                                          rng,
-                                                                         inputToPathwayTrain,
-                                                                         inputToPathwayVal,
-                                                                         inputToPathwayTest,
-                                                                         inputToPathwayShapeTrain,
-                                                                         inputToPathwayShapeVal,
-                                                                         inputToPathwayShapeTest,
+                                                                         inputToPathwayPerMode,
+                                                                         inputToPathwayShapePerMode,
                                                                          
                                                                          thisPathWayNKerns,
                                                                          thisPathWayKernelDimensions,
@@ -528,7 +512,8 @@ class Cnn3d(object):
                                                                          
                                                                          indicesOfLowerRankLayersPerPathway[thisPathwayType],
                                                                          ranksOfLowerRankLayersForEachPathway[thisPathwayType],
-                                                                         indicesOfLayersToConnectResidualsInOutput[thisPathwayType]
+                                                                         indicesOfLayersToConnectResidualsInOutput[thisPathwayType],
+                                                                         self._dataFormat
                                                                          )
         
         # =========== Make the final Target Layer (softmax, regression, whatever) ==========
@@ -536,8 +521,9 @@ class Cnn3d(object):
         
         self.finalTargetLayer = self._getClassificationLayer()
         self.finalTargetLayer.makeLayer(rng, self.getFcPathway().getLayer(-1), softmaxTemperature)
-        (self._output_gt_tensor_feeds['train']['y_gt'],
-         self._output_gt_tensor_feeds['val']['y_gt']) = self.finalTargetLayer.get_output_gt_tensor_feed()
+        for mode in ['train', 'val'] :
+            if mode in self._modes :
+                self._output_gt_tensor_feeds[mode] = {'y_gt': self.finalTargetLayer.get_output_gt_tensor_feed(mode)}
         
         log.print3("Finished building the CNN's model.")
         
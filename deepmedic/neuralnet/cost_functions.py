@@ -9,47 +9,54 @@ from __future__ import absolute_import, print_function, division
 
 import tensorflow as tf
 
+from deepmedic.neuralnet.ops import getAxisOfFms, getAxesOfRcz, vectorPerFmTo5D
 
-def x_entr( p_y_given_x_train, y_gt, weightPerClass, eps=1e-6 ):
-    # p_y_given_x_train : tensor5 [batchSize, classes, r, c, z]
+
+def x_entr( p_y_given_x_train, y_gt, weightPerClass, eps=1e-6, dataFormat="NDHWC" ):
+    # p_y_given_x_train : tensor5 [batchSize, classes, r, c, z] or [batchSize, r, c, z, classes], as dataFormat (see ops.DATA_FORMATS).
     # y: T.itensor4('y'). Dimensions [batchSize, r, c, z]
     # weightPerClass is a vector with 1 element per class.
     
     #Weighting the cost of the different classes in the cost-function, in order to counter class imbalance.
     log_p_y_given_x_train = tf.log( p_y_given_x_train + eps)
     
-    weightPerClass5D = tf.reshape(weightPerClass, shape=[1, tf.shape(p_y_given_x_train)[1], 1, 1, 1])
+    axisOfClasses = getAxisOfFms(dataFormat)
+    weightPerClass5D = vectorPerFmTo5D(weightPerClass, tf.shape(p_y_given_x_train)[axisOfClasses], dataFormat)
     weighted_log_p_y_given_x_train = log_p_y_given_x_train * weightPerClass5D
     
-    y_one_hot = tf.one_hot( indices=y_gt, depth=tf.shape(p_y_given_x_train)[1], axis=1, dtype="float32" )
+    y_one_hot = tf.one_hot( indices=y_gt, depth=tf.shape(p_y_given_x_train)[axisOfClasses], axis=axisOfClasses, dtype="float32" )
     
     num_samples = tf.cast( tf.reduce_prod( tf.shape(y_gt) ), "float32")
     
     return - (1./ num_samples) * tf.reduce_sum( weighted_log_p_y_given_x_train * y_one_hot )
 
 
-def iou(p_y_given_x_train, y_gt, eps=1e-5):
+def iou(p_y_given_x_train, y_gt, eps=1e-5, dataFormat="NDHWC"):
     # Intersection-Over-Union / Jaccard: https://en.wikipedia.org/wiki/Jaccard_index
     # Analysed in: Nowozin S, Optimal Decisions from Probabilistic Models: the Intersection-over-Union Case, CVPR 2014
     # First computes IOU per class. Finally averages over the class-ious.
-    # p_y_given_x_train : tensor5 [batchSize, classes, r, c, z]
+    # p_y_given_x_train : tensor5 [batchSize, classes, r, c, z] or [batchSize, r, c, z, classes], as dataFormat.
     # y: T.itensor4('y'). Dimensions [batchSize, r, c, z]
-    y_one_hot = tf.one_hot( indices=y_gt, depth=tf.shape(p_y_given_x_train)[1], axis=1, dtype="float32" )
+    axisOfClasses = getAxisOfFms(dataFormat)
+    axesToSum = tuple([0] + getAxesOfRcz(dataFormat)) # All but the class-axis.
+    y_one_hot = tf.one_hot( indices=y_gt, depth=tf.shape(p_y_given_x_train)[axisOfClasses], axis=axisOfClasses, dtype="float32" )
     ones_at_real_negs = tf.cast( tf.less(y_one_hot, 0.0001), dtype="float32") # tf.equal(y_one_hot,0), but less may be more stable with floats.
-    numer = tf.reduce_sum(p_y_given_x_train * y_one_hot, axis=(0,2,3,4)) # 2 * TP
-    denom = tf.reduce_sum(p_y_given_x_train * ones_at_real_negs, axis=(0,2,3,4)) + tf.reduce_sum(y_one_hot, axis=(0,2,3,4)) # Pred + RP
+    numer = tf.reduce_sum(p_y_given_x_train * y_one_hot, axis=axesToSum) # 2 * TP
+    denom = tf.reduce_sum(p_y_given_x_train * ones_at_real_negs, axis=axesToSum) + tf.reduce_sum(y_one_hot, axis=axesToSum) # Pred + RP
     iou = (numer + eps) / (denom + eps) # eps in both num/den => dsc=1 when class missing.
     av_class_iou = tf.reduce_mean(iou) # Along the class-axis. Mean DSC of classes. 
     cost = 1. - av_class_iou
     return cost
 
 
-def dsc(p_y_given_x_train, y_gt, eps=1e-5):
+def dsc(p_y_given_x_train, y_gt, eps=1e-5, dataFormat="NDHWC"):
     # Similar to Intersection-Over-Union / Jaccard above.
     # Dice coefficient: https://en.wikipedia.org/wiki/S%C3%B8rensen%E2%80%93Dice_coefficient
-    y_one_hot = tf.one_hot( indices=y_gt, depth=tf.shape(p_y_given_x_train)[1], axis=1, dtype="float32" )
-    numer = 2. * tf.reduce_sum(p_y_given_x_train * y_one_hot, axis=(0,2,3,4)) # 2 * TP
-    denom = tf.reduce_sum(p_y_given_x_train, axis=(0,2,3,4)) + tf.reduce_sum(y_one_hot, axis=(0,2,3,4)) # Pred + RP
+    axisOfClasses = getAxisOfFms(dataFormat)
+    axesToSum = tuple([0] + getAxesOfRcz(dataFormat)) # All but the class-axis.
+    y_one_hot = tf.one_hot( indices=y_gt, depth=tf.shape(p_y_given_x_train)[axisOfClasses], axis=axisOfClasses, dtype="float32" )
+    numer = 2. * tf.reduce_sum(p_y_given_x_train * y_one_hot, axis=axesToSum) # 2 * TP
+    denom = tf.reduce_sum(p_y_given_x_train, axis=axesToSum) + tf.reduce_sum(y_one_hot, axis=axesToSum) # Pred + RP
     dsc = (numer + eps) / (denom + eps) # eps in both num/den => dsc=1 when class missing.
     av_class_dsc = tf.reduce_mean(dsc) # Along the class-axis. Mean DSC of classes. 
     cost = 1. - av_class_dsc
@@ -11,8 +11,9 @@ import random
 
 import tensorflow as tf
 
-from deepmedic.neuralnet.ops import applyDropout, makeBiasParamsAndApplyToFms, applyRelu, applyPrelu, applyElu, applySelu, pool3dMirrorPad
-from deepmedic.neuralnet.ops import applyBn, createAndInitializeWeightsTensor, convolveWithGivenWeightMatrix
+from deepmedic.neuralnet.ops import applyDropout, createBiasParams, applyBiasToFms, applyRelu, createPreluParams, applyPrelu, applyElu, applySelu, pool3dMirrorPad
+from deepmedic.neuralnet.ops import createBnParams, applyBn, updateBnRollingAverage, createAndInitializeWeightsTensor, convolveWithGivenWeightMatrix
+from deepmedic.neuralnet.ops import getAxisOfFms, sliceRcz, sliceFms, transposeToNCDHW
 
 try:
     from sys import maxint as MAX_INT
@@ -33,12 +34,14 @@ class Block(object):
     
     def __init__(self) :
         # === Input to the layer ===
-        self.input= {"train": None, "val": None, "test": None}
-        self.inputShape = {"train": None, "val": None, "test": None}
+        # Inputs and outputs have one entry per mode ("train", "val", "test") that the layer is built for. See makeLayer().
+        self.input= {}
+        self.inputShape = {}
         
         # === Basic architecture parameters === 
         self._numberOfFeatureMaps = None
         self._poolingParameters = None
+        self._dataFormat = None # Layout of the 5D tensors. See ops.DATA_FORMATS. Shapes are always [batch, fms, r, c, z].
         
         #=== All Trainable Parameters of the Block ===
         self._appliedBnInLayer = None # This flag is a combination of rollingAverageForBn>0 AND useBnFlag, with the latter used for the 1st layers of pathways (on image).
@@ -52,53 +55,37 @@ class Block(object):
         self._gBn = None # ONLY WHEN BN is applied
         self._aPrelu = None # ONLY WHEN PreLu
         
-        # ONLY WHEN BN! All of these are for the rolling average! If I fix this, only 2 will remain!
+        # ONLY WHEN BN! All of these are for the rolling average!
         self._muBnsArrayForRollingAverage = None # Array
         self._varBnsArrayForRollingAverage = None # Arrays
         self._movingAvForBnOverXBatches = None
-        self._indexWhereRollingAverageIs = 0 #Index in the rolling-average matrices of the layers, of the entry to update in the next batch.
-        self._sharedNewMu_B = None # last value shared, to update the rolling average array.
-        self._sharedNewVar_B = None
-        self._newMu_B = None # last value tensor, to update the corresponding shared.
+        self._newMu_B = None # Tensors of the training batch's mu and var, to update the rolling average arrays with.
         self._newVar_B = None
-        self._tf_plchld_int32 = tf.placeholder( dtype="int32", name="tf_plchld_int32") # convenience for tf.assign
-        self._op_update_mtrx_bn_inf_mu = None
-        self._op_update_mtrx_bn_inf_var = None
         
         # === Output of the block ===
-        self.output = {"train": None, "val": None, "test": None}
-        self.outputShape = {"train": None, "val": None, "test": None}
+        self.output = {}
+        self.outputShape = {}
         # New and probably temporary, for the residual connections to be "visible".
-        self.outputAfterResidualConnIfAnyAtOutp = {"train": None, "val": None, "test": None}
+        self.outputAfterResidualConnIfAnyAtOutp = {}
         
         # ==== Target Block Connected to that layer (softmax, regression, auxiliary loss etc), if any ======
         self.targetBlock = None
         
     # Setters
-    def _setBlocksInputAttributes(self, inputToLayerTrain, inputToLayerVal, inputToLayerTest, inputToLayerShapeTrain, inputToLayerShapeVal, inputToLayerShapeTest) :
-        self.input["train"] = inputToLayerTrain
-        self.input["val"] = inputToLayerVal
-        self.input["test"] = inputToLayerTest
-        self.inputShape["train"] = inputToLayerShapeTrain
-        self.inputShape["val"] = inputToLayerShapeVal
-        self.inputShape["test"] = inputToLayerShapeTest
-        
-    def _setBlocksArchitectureAttributes(self, filterShape, poolingParameters) :
+    def _setBlocksInputAttributes(self, mode, inputToLayer, inputToLayerShape) :
+        self.input[mode] = inputToLayer
+        self.inputShape[mode] = inputToLayerShape
+        
+    def _setBlocksArchitectureAttributes(self, filterShape, poolingParameters, dataFormat) :
         self._numberOfFeatureMaps = filterShape[0] # Of the output! Used in trainValidationVisualise.py. Not of the input!
-        assert self.inputShape["train"][1] == filterShape[1]
         self._poolingParameters = poolingParameters
+        self._dataFormat = dataFormat
         
-    def _setBlocksOutputAttributes(self, outputTrain, outputVal, outputTest, outputShapeTrain, outputShapeVal, outputShapeTest) :
-        self.output["train"] = outputTrain
-        self.output["val"] = outputVal
-        self.output["test"] = outputTest
-        self.outputShape["train"] = outputShapeTrain
-        self.outputShape["val"] = outputShapeVal
-        self.outputShape["test"] = outputShapeTest
+    def _setBlocksOutputAttributes(self, mode, output, outputShape) :
+        self.output[mode] = output
+        self.outputShape[mode] = outputShape
         # New and probably temporary, for the residual connections to be "visible".
-        self.outputAfterResidualConnIfAnyAtOutp["train"] = self.output["train"]
-        self.outputAfterResidualConnIfAnyAtOutp["val"] = self.output["val"]
-        self.outputAfterResidualConnIfAnyAtOutp["test"] = self.output["test"]
+        self.outputAfterResidualConnIfAnyAtOutp[mode] = self.output[mode]
         
     def setTargetBlock(self, targetBlockInstance):
         # targetBlockInstance : eg softmax layer. Future: Regression layer, or other auxiliary classifiers.
@@ -106,8 +93,12 @@ class Block(object):
     # Getters
     def getNumberOfFeatureMaps(self):
         return self._numberOfFeatureMaps
+    def getDataFormat(self):
+        return self._dataFormat
     def fmsActivations(self, indices_of_fms_in_layer_to_visualise_from_to_exclusive) :
-        return self.output["test"][:, indices_of_fms_in_layer_to_visualise_from_to_exclusive[0] : indices_of_fms_in_layer_to_visualise_from_to_exclusive[1], :, :, :]
+        # Returned in shape [batch, fms, r, c, z], whatever the layout of the model.
+        fmsToVisualise = sliceFms( self.output["test"], slice(indices_of_fms_in_layer_to_visualise_from_to_exclusive[0], indices_of_fms_in_layer_to_visualise_from_to_exclusive[1]), self._dataFormat )
+        return transposeToNCDHW( fmsToVisualise, self._dataFormat )
     
     # Other API
     def _get_L1_cost(self) : #Called for L1 weigths regularisation
@@ -120,18 +111,10 @@ class Block(object):
         else :
             return self.params + self.targetBlock.getTrainableParams()
         
-    def updateMatricesOfBnMovingAvForInference(self, sessionTf):
-        # This function should be erazed when I reimplement the Rolling average.
-        if self._appliedBnInLayer :
-            sessionTf.run( fetches=self._op_update_mtrx_bn_inf_mu, feed_dict={self._tf_plchld_int32: self._indexWhereRollingAverageIs} )
-            sessionTf.run( fetches=self._op_update_mtrx_bn_inf_var, feed_dict={self._tf_plchld_int32: self._indexWhereRollingAverageIs} )
-            self._indexWhereRollingAverageIs = (self._indexWhereRollingAverageIs + 1) % self._movingAvForBnOverXBatches
-            
     def getUpdatesForBnRollingAverage(self) :
-        # This function or something similar should stay, even if I clean the BN rolling average.
+        # Ops to update the rolling average arrays with the mu and var of the training batch. Run along with the training step.
         if self._appliedBnInLayer :
-            return [ tf.assign( ref=self._sharedNewMu_B, value=self._newMu_B, validate_shape=True ),
-                    tf.assign( ref=self._sharedNewVar_B, value=self._newVar_B, validate_shape=True ) ]
+            return updateBnRollingAverage( self._muBnsArrayForRollingAverage, self._varBnsArrayForRollingAverage, self._newMu_B, self._newVar_B )
         else :
             return []
         
@@ -141,168 +124,156 @@ class ConvLayer(Block):
         Block.__init__(self)
         self._activationFunctionType = "" #linear, relu or prelu
         
-    def _processInputWithBnNonLinearityDropoutPooling(self,
-                rng,
-                inputToLayerTrain,
-                inputToLayerVal,
-                inputToLayerTest,
-                inputToLayerShapeTrain,
-                inputToLayerShapeVal,
-                inputToLayerShapeTest,
-                useBnFlag, # Must be true to do BN. Used to not allow doing BN on first layers straight on image, even if rollingAvForBnOverThayManyBatches > 0.
-                movingAvForBnOverXBatches, #If this is <= 0, we are not using BatchNormalization, even if above is True.
-                activationFunc,
-                dropoutRate) :
-        # ---------------- Order of what is applied -----------------
-        #  Input -> [ BatchNorm OR biases applied] -> NonLinearity -> DropOut -> Pooling --> Conv ] # ala He et al "Identity Mappings in Deep Residual Networks" 2016
-        # -----------------------------------------------------------
-        
+    def _createParamsOfBnOrBiasAndNonLinearity(self,
+                                                numberOfInputChannels,
+                                                useBnFlag, # Must be true to do BN. Used to not allow doing BN on first layers straight on image, even if rollingAvForBnOverThayManyBatches > 0.
+                                                movingAvForBnOverXBatches, #If this is <= 0, we are not using BatchNormalization, even if above is True.
+                                                activationFunc) :
         #---------------------------------------------------------
         #------------------ Batch Normalization ------------------
         #---------------------------------------------------------
         if useBnFlag and movingAvForBnOverXBatches > 0 :
             self._appliedBnInLayer = True
             self._movingAvForBnOverXBatches = movingAvForBnOverXBatches
-            (inputToNonLinearityTrain,
-            inputToNonLinearityVal,
-            inputToNonLinearityTest,
-            self._gBn,
+            (self._gBn,
             self._b,
             # For rolling average :
             self._muBnsArrayForRollingAverage,
-            self._varBnsArrayForRollingAverage,
-            self._sharedNewMu_B,
-            self._sharedNewVar_B,
-            self._newMu_B,
-            self._newVar_B
-            ) = applyBn( movingAvForBnOverXBatches, inputToLayerTrain, inputToLayerVal, inputToLayerTest, inputToLayerShapeTrain)
+            self._varBnsArrayForRollingAverage
+            ) = createBnParams( movingAvForBnOverXBatches, numberOfInputChannels )
             self.params = self.params + [self._gBn, self._b]
-            # Create ops for updating the matrices with the bn inference stats.
-            self._op_update_mtrx_bn_inf_mu = tf.assign( self._muBnsArrayForRollingAverage[self._tf_plchld_int32], self._sharedNewMu_B )
-            self._op_update_mtrx_bn_inf_var = tf.assign( self._varBnsArrayForRollingAverage[self._tf_plchld_int32], self._sharedNewVar_B )
-    
+        
         else : #Not using batch normalization
             self._appliedBnInLayer = False
-            #make the bias terms and apply them. Like the old days before BN's own learnt bias terms.
-            numberOfInputChannels = inputToLayerShapeTrain[1]
-            
-            (self._b,
-            inputToNonLinearityTrain,
-            inputToNonLinearityVal,
-            inputToNonLinearityTest) = makeBiasParamsAndApplyToFms( inputToLayerTrain, inputToLayerVal, inputToLayerTest, numberOfInputChannels )
+            #make the bias terms. Like the old days before BN's own learnt bias terms.
+            self._b = createBiasParams( numberOfInputChannels )
             self.params = self.params + [self._b]
-            
+        
         #--------------------------------------------------------
-        #------------ Apply Activation/ non-linearity -----------
+        #------------ Activation/ non-linearity -----------------
         #--------------------------------------------------------
         self._activationFunctionType = activationFunc
+        if self._activationFunctionType == "prelu" :
+            self._aPrelu = createPreluParams( numberOfInputChannels )
+            self.params = self.params + [self._aPrelu]
+    
+    def _processInputWithBnNonLinearityDropoutPooling(self,
+                rng,
+                mode,
+                inputToLayer,
+                inputToLayerShape,
+                dropoutRate) :
+        # ---------------- Order of what is applied -----------------
+        #  Input -> [ BatchNorm OR biases applied] -> NonLinearity -> DropOut -> Pooling --> Conv ] # ala He et al "Identity Mappings in Deep Residual Networks" 2016
+        # -----------------------------------------------------------
+        
+        #---------------------------------------------------------
+        #------------------ Batch Normalization ------------------
+        #---------------------------------------------------------
+        if self._appliedBnInLayer :
+            (inputToNonLinearity,
+            newMu_B,
+            newVar_B
+            ) = applyBn( inputToLayer, mode, self._gBn, self._b, self._muBnsArrayForRollingAverage, self._varBnsArrayForRollingAverage, self._dataFormat )
+            if mode == "train" :
+                self._newMu_B = newMu_B
+                self._newVar_B = newVar_B
+        else : #Not using batch normalization
+            inputToNonLinearity = applyBiasToFms( inputToLayer, self._b, self._dataFormat )
+        
+        #--------------------------------------------------------
+        #------------ Apply Activation/ non-linearity -----------
+        #--------------------------------------------------------
         if self._activationFunctionType == "linear" : # -1 stands for "no nonlinearity". Used for input layers of the pathway.
-            ( inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = (inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest)
+            inputToDropout = inputToNonLinearity
         elif self._activationFunctionType == "relu" :
-            ( inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = applyRelu(inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest)
+            inputToDropout = applyRelu(inputToNonLinearity)
         elif self._activationFunctionType == "prelu" :
-            numberOfInputChannels = inputToLayerShapeTrain[1]
-            ( self._aPrelu, inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = applyPrelu(inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest, numberOfInputChannels)
-            self.params = self.params + [self._aPrelu]
+            inputToDropout = applyPrelu(inputToNonLinearity, self._aPrelu, self._dataFormat)
         elif self._activationFunctionType == "elu" :
-            ( inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = applyElu(inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest)
+            inputToDropout = applyElu(inputToNonLinearity)
         elif self._activationFunctionType == "selu" :
-            ( inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = applySelu(inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest)
-            
+            inputToDropout = applySelu(inputToNonLinearity)
+        
         #------------------------------------
         #------------- Dropout --------------
         #------------------------------------
-        (inputToPoolTrain, inputToPoolVal, inputToPoolTest) = applyDropout(rng, dropoutRate, inputToLayerShapeTrain, inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest)
+        inputToPool = applyDropout(rng, dropoutRate, inputToLayerShape, inputToDropout, mode)
         
         #-------------------------------------------------------
         #-----------  Pooling ----------------------------------
         #-------------------------------------------------------
         if self._poolingParameters == [] : #no max pooling before this conv
-            inputToConvTrain = inputToPoolTrain
-            inputToConvVal = inputToPoolVal
-            inputToConvTest = inputToPoolTest
-            
-            inputToConvShapeTrain = inputToLayerShapeTrain
-            inputToConvShapeVal = inputToLayerShapeVal
-            inputToConvShapeTest = inputToLayerShapeTest
+            inputToConv = inputToPool
+            inputToConvShape = inputToLayerShape
         else : #Max pooling is actually happening here...
-            (inputToConvTrain, inputToConvShapeTrain) = pool3dMirrorPad(inputToPoolTrain, inputToLayerShapeTrain, self._poolingParameters)
-            (inputToConvVal, inputToConvShapeVal) = pool3dMirrorPad(inputToPoolVal, inputToLayerShapeVal, self._poolingParameters)
-            (inputToConvTest, inputToConvShapeTest) = pool3dMirrorPad(inputToPoolTest, inputToLayerShapeTest, self._poolingParameters)
-            
-        return (inputToConvTrain, inputToConvVal, inputToConvTest,
-                inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest )
+            (inputToConv, inputToConvShape) = pool3dMirrorPad(inputToPool, inputToLayerShape, self._poolingParameters, self._dataFormat)
         
-    def _createWeightsTensorAndConvolve(self, rng, filterShape, convWInitMethod, 
-                                        inputToConvTrain, inputToConvVal, inputToConvTest,
-                                        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) :
-        #-----------------------------------------------
-        #------------------ Convolution ----------------
-        #-----------------------------------------------
+        return (inputToConv, inputToConvShape)
+    
+    def _createWeightsTensor(self, rng, filterShape, convWInitMethod) :
         #----- Initialise the weights -----
         # W shape: [#FMs of this layer, #FMs of Input, rKernDim, cKernDim, zKernDim]
         self._W = createAndInitializeWeightsTensor(filterShape, convWInitMethod, rng)
         self.params = [self._W] + self.params
-        
-        #---------- Convolve --------------
-        tupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(self._W, filterShape, inputToConvTrain, inputToConvVal, inputToConvTest, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
-        
-        return tupleWithOuputAndShapeTrValTest
+    
+    def _convolve(self, filterShape, inputToConv, inputToConvShape) :
+        #-----------------------------------------------
+        #------------------ Convolution ----------------
+        #-----------------------------------------------
+        return convolveWithGivenWeightMatrix(self._W, filterShape, inputToConv, inputToConvShape, self._dataFormat)
     
     # The main function that builds this.
     def makeLayer(self,
                 rng,
-                inputToLayerTrain,
-                inputToLayerVal,
-                inputToLayerTest,
-                inputToLayerShapeTrain,
-                inputToLayerShapeVal,
-                inputToLayerShapeTest,
+                inputToLayerPerMode,
+                inputToLayerShapePerMode,
                 filterShape,
                 poolingParameters, # Can be []
                 convWInitMethod,
                 useBnFlag, # Must be true to do BN. Used to not allow doing BN on first layers straight on image, even if rollingAvForBnOverThayManyBatches > 0.
                 movingAvForBnOverXBatches, #If this is <= 0, we are not using BatchNormalization, even if above is True.
                 activationFunc="relu",
-                dropoutRate=0.0):
+                dropoutRate=0.0,
+                dataFormat="NDHWC"): # Layout of the input tensors and of the built ones. See ops.DATA_FORMATS.
         """
         type rng: numpy.random.RandomState
         param rng: a random number generator used to initialize weights
         
-        type inputToLayer:  tensor5
-        param inputToLayer: symbolic image tensor, of shape inputToLayerShape
+        type inputToLayerPerMode: dictionary of tensor5
+        param inputToLayerPerMode: {mode: symbolic image tensor, of shape inputToLayerShapePerMode[mode]}.
+                            One entry per mode ("train", "val", "test") to build the layer for.
         
         type filterShape: tuple or list of length 5
         param filterShape: (number of filters, num input feature maps,
                             filter height, filter width, filter depth)
-                            
-        type inputToLayerShape: tuple or list of length 5
-        param inputToLayerShape: (batch size, num input feature maps,
-                            image height, image width, filter depth)
+        
+        type inputToLayerShapePerMode: dictionary of tuples or lists of length 5
+        param inputToLayerShapePerMode: {mode: (batch size, num input feature maps,
+                            image height, image width, filter depth)}
         """
-        self._setBlocksInputAttributes(inputToLayerTrain, inputToLayerVal, inputToLayerTest, inputToLayerShapeTrain, inputToLayerShapeVal, inputToLayerShapeTest)
-        self._setBlocksArchitectureAttributes(filterShape, poolingParameters)
-        
-        # Apply all the straightforward operations on the input, such as BN, activation function, dropout, pooling        
-        (inputToConvTrain, inputToConvVal, inputToConvTest,
-        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) = self._processInputWithBnNonLinearityDropoutPooling( rng,
-                                                                                        inputToLayerTrain,
-                                                                                        inputToLayerVal,
-                                                                                        inputToLayerTest,
-                                                                                        inputToLayerShapeTrain,
-                                                                                        inputToLayerShapeVal,
-                                                                                        inputToLayerShapeTest,
-                                                                                        useBnFlag,
-                                                                                        movingAvForBnOverXBatches,
-                                                                                        activationFunc,
-                                                                                        dropoutRate)
-        
-        tupleWithOuputAndShapeTrValTest = self._createWeightsTensorAndConvolve( rng, filterShape, convWInitMethod, 
-                                                                                inputToConvTrain, inputToConvVal, inputToConvTest,
-                                                                                inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
-        
-        self._setBlocksOutputAttributes(*tupleWithOuputAndShapeTrValTest)
+        self._setBlocksArchitectureAttributes(filterShape, poolingParameters, dataFormat)
+        
+        # Trainable parameters are created once, and shared by the operations of all modes.
+        self._createParamsOfBnOrBiasAndNonLinearity(filterShape[1], useBnFlag, movingAvForBnOverXBatches, activationFunc)
+        self._createWeightsTensor(rng, filterShape, convWInitMethod)
         
+        # Operations are only built for the modes given. Eg for a testing session, only for "test".
+        for mode in inputToLayerPerMode :
+            assert inputToLayerShapePerMode[mode][1] == filterShape[1]
+            self._setBlocksInputAttributes(mode, inputToLayerPerMode[mode], inputToLayerShapePerMode[mode])
+            
+            # Apply all the straightforward operations on the input, such as BN, activation function, dropout, pooling
+            (inputToConv, inputToConvShape) = self._processInputWithBnNonLinearityDropoutPooling( rng,
+                                                                                                mode,
+                                                                                                self.input[mode],
+                                                                                                self.inputShape[mode],
+                                                                                                dropoutRate)
+            
+            (output, outputShape) = self._convolve(filterShape, inputToConv, inputToConvShape)
+            
+            self._setBlocksOutputAttributes(mode, output, outputShape)
+
     # Override parent's abstract classes.
     def _get_L1_cost(self) : #Called for L1 weigths regularisation
         return tf.reduce_sum(tf.abs(self._W))
@@ -335,59 +306,53 @@ class LowRankConvLayer(ConvLayer):
         rCropSlice = slice( (filterShape[2]-1)//2, (filterShape[2]-1)//2 + concatOutputShape[2] )
         cCropSlice = slice( (filterShape[3]-1)//2, (filterShape[3]-1)//2 + concatOutputShape[3] )
         zCropSlice = slice( (filterShape[4]-1)//2, (filterShape[4]-1)//2 + concatOutputShape[4] )
-        rSubconvOutputCropped = rSubconvOutput[:,:, :, cCropSlice if self._rank == 1 else slice(0, MAX_INT), zCropSlice  ]
-        cSubconvOutputCropped = cSubconvOutput[:,:, rCropSlice, :, zCropSlice if self._rank == 1 else slice(0, MAX_INT) ]
-        zSubconvOutputCropped = zSubconvOutput[:,:, rCropSlice if self._rank == 1 else slice(0, MAX_INT), cCropSlice, : ]
-        concatSubconvOutputs = tf.concat([rSubconvOutputCropped, cSubconvOutputCropped, zSubconvOutputCropped], axis=1) #concatenate the FMs
+        rSubconvOutputCropped = sliceRcz( rSubconvOutput, [slice(None), cCropSlice if self._rank == 1 else slice(0, MAX_INT), zCropSlice], self._dataFormat )
+        cSubconvOutputCropped = sliceRcz( cSubconvOutput, [rCropSlice, slice(None), zCropSlice if self._rank == 1 else slice(0, MAX_INT)], self._dataFormat )
+        zSubconvOutputCropped = sliceRcz( zSubconvOutput, [rCropSlice if self._rank == 1 else slice(0, MAX_INT), cCropSlice, slice(None)], self._dataFormat )
+        concatSubconvOutputs = tf.concat([rSubconvOutputCropped, cSubconvOutputCropped, zSubconvOutputCropped], axis=getAxisOfFms(self._dataFormat)) #concatenate the FMs
         
         return (concatSubconvOutputs, concatOutputShape)
     
-    # Overload the ConvLayer's function. Called from makeLayer. The only different behaviour, because BN, ActivationFunc, DropOut and Pooling are done on a per-FM fashion.        
-    def _createWeightsTensorAndConvolve(self, rng, filterShape, convWInitMethod, 
-                                        inputToConvTrain, inputToConvVal, inputToConvTest,
-                                        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) :
-        # Behaviour: Create W, set self._W, set self.params, convolve, return ouput and outputShape.
+    def _getFilterShapesOfSubconvs(self, filterShape) :
         # The created filters are either 1-dimensional (rank=1) or 2-dim (rank=2), depending  on the self._rank
         # If 1-dim: rSubconv is the input convolved with the row-1dimensional filter.
-        # If 2-dim: rSubconv is the input convolved with the RC-2D filter, cSubconv with CZ-2D filter, zSubconv with ZR-2D filter. 
-        
-        #----- Initialise the weights and Convolve for 3 separate, low rank filters, R,C,Z. -----
-        # W shape: [#FMs of this layer, #FMs of Input, rKernDim, cKernDim, zKernDim]
-        
+        # If 2-dim: rSubconv is the input convolved with the RC-2D filter, cSubconv with CZ-2D filter, zSubconv with ZR-2D filter.
         rSubconvFilterShape = [ filterShape[0]//3, filterShape[1], filterShape[2], 1 if self._rank == 1 else filterShape[3], 1 ]
-        rSubconvW = createAndInitializeWeightsTensor(rSubconvFilterShape, convWInitMethod, rng)
-        rSubconvTupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(rSubconvW, rSubconvFilterShape, inputToConvTrain, inputToConvVal, inputToConvTest, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
-        
         cSubconvFilterShape = [ filterShape[0]//3, filterShape[1], 1, filterShape[3], 1 if self._rank == 1 else filterShape[4] ]
-        cSubconvW = createAndInitializeWeightsTensor(cSubconvFilterShape, convWInitMethod, rng)
-        cSubconvTupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(cSubconvW, cSubconvFilterShape, inputToConvTrain, inputToConvVal, inputToConvTest, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
-        
         numberOfFmsForTotalToBeExact = filterShape[0] - 2*(filterShape[0]//3) # Cause of possibly inexact integer division.
         zSubconvFilterShape = [ numberOfFmsForTotalToBeExact, filterShape[1], 1 if self._rank == 1 else filterShape[2], 1, filterShape[4] ]
+        return [rSubconvFilterShape, cSubconvFilterShape, zSubconvFilterShape]
+    
+    # Overload the ConvLayer's functions. Called from makeLayer. The only different behaviour, because BN, ActivationFunc, DropOut and Pooling are done on a per-FM fashion.
+    def _createWeightsTensor(self, rng, filterShape, convWInitMethod) :
+        # Behaviour: Create W per subconv, set self._WperSubconv, set self.params.
+        #----- Initialise the weights for 3 separate, low rank filters, R,C,Z. -----
+        # W shape: [#FMs of this layer, #FMs of Input, rKernDim, cKernDim, zKernDim]
+        [rSubconvFilterShape, cSubconvFilterShape, zSubconvFilterShape] = self._getFilterShapesOfSubconvs(filterShape)
+        rSubconvW = createAndInitializeWeightsTensor(rSubconvFilterShape, convWInitMethod, rng)
+        cSubconvW = createAndInitializeWeightsTensor(cSubconvFilterShape, convWInitMethod, rng)
         zSubconvW = createAndInitializeWeightsTensor(zSubconvFilterShape, convWInitMethod, rng)
-        zSubconvTupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(zSubconvW, zSubconvFilterShape, inputToConvTrain, inputToConvVal, inputToConvTest, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
         
         # Set the W attribute and trainable parameters.
         self._WperSubconv = [rSubconvW, cSubconvW, zSubconvW] # Bear in mind that these sub tensors have different shapes! Treat carefully.
         self.params = self._WperSubconv + self.params
+    
+    def _convolve(self, filterShape, inputToConv, inputToConvShape) :
+        # Behaviour: Convolve with the 3 subconv filters, return the concatenated ouput and outputShape.
+        [rSubconvFilterShape, cSubconvFilterShape, zSubconvFilterShape] = self._getFilterShapesOfSubconvs(filterShape)
+        [rSubconvW, cSubconvW, zSubconvW] = self._WperSubconv
+        (rSubconvOutput, rSubconvOutputShape) = convolveWithGivenWeightMatrix(rSubconvW, rSubconvFilterShape, inputToConv, inputToConvShape, self._dataFormat)
+        (cSubconvOutput, cSubconvOutputShape) = convolveWithGivenWeightMatrix(cSubconvW, cSubconvFilterShape, inputToConv, inputToConvShape, self._dataFormat)
+        (zSubconvOutput, zSubconvOutputShape) = convolveWithGivenWeightMatrix(zSubconvW, zSubconvFilterShape, inputToConv, inputToConvShape, self._dataFormat)
         
         # concatenate together.
-        (concatSubconvOutputsTrain, concatOutputShapeTrain) = self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvTupleWithOuputAndShapeTrValTest[0], rSubconvTupleWithOuputAndShapeTrValTest[3],
-                                                                                                        cSubconvTupleWithOuputAndShapeTrValTest[0], cSubconvTupleWithOuputAndShapeTrValTest[3],
-                                                                                                        zSubconvTupleWithOuputAndShapeTrValTest[0], zSubconvTupleWithOuputAndShapeTrValTest[3],
-                                                                                                        filterShape)
-        (concatSubconvOutputsVal, concatOutputShapeVal) = self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvTupleWithOuputAndShapeTrValTest[1], rSubconvTupleWithOuputAndShapeTrValTest[4],
-                                                                                                        cSubconvTupleWithOuputAndShapeTrValTest[1], cSubconvTupleWithOuputAndShapeTrValTest[4],
-                                                                                                        zSubconvTupleWithOuputAndShapeTrValTest[1], zSubconvTupleWithOuputAndShapeTrValTest[4],
+        (concatSubconvOutputs, concatOutputShape) = self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvOutput, rSubconvOutputShape,
+                                                                                                        cSubconvOutput, cSubconvOutputShape,
+                                                                                                        zSubconvOutput, zSubconvOutputShape,
                                                                                                         filterShape)
-        (concatSubconvOutputsTest, concatOutputShapeTest) = self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvTupleWithOuputAndShapeTrValTest[2], rSubconvTupleWithOuputAndShapeTrValTest[5],
-                                                                                                        cSubconvTupleWithOuputAndShapeTrValTest[2], cSubconvTupleWithOuputAndShapeTrValTest[5],
-                                                                                                        zSubconvTupleWithOuputAndShapeTrValTest[2], zSubconvTupleWithOuputAndShapeTrValTest[5],
-                                                                                                        filterShape)
-        
-        return (concatSubconvOutputsTrain, concatSubconvOutputsVal, concatSubconvOutputsTest, concatOutputShapeTrain, concatOutputShapeVal, concatOutputShapeTest)
-        
-        
+        return (concatSubconvOutputs, concatOutputShape)
+
+
     # Implement parent's abstract classes.
     def _get_L1_cost(self) : #Called for L1 weigths regularisation
         l1Cost = 0
@@ -407,7 +372,7 @@ class TargetLayer(Block):
     def __init__(self):
         Block.__init__(self)
         
-    def get_output_gt_tensor_feed(self):
+    def get_output_gt_tensor_feed(self, mode):
         raise NotImplementedError("Not implemented virtual function.")
     
     
@@ -420,52 +385,50 @@ class SoftmaxLayer(TargetLayer):
         self._numberOfOutputClasses = None
         #self._b = None # The only type of trainable parameter that a softmax layer has.
         self._temperature = None
+        # Per mode:
+        self.p_y_given_x = {}
+        self.y_pred = {}
         
     def makeLayer(  self,
                     rng,
                     layerConnected, # the basic layer, at the output of which to connect this softmax.
                     t = 1):
         # t: temperature. Scalar
+        # Built for the same modes as layerConnected.
         
         self._numberOfOutputClasses = layerConnected.getNumberOfFeatureMaps()
         self._temperature = t
-        
-        self._setBlocksInputAttributes(layerConnected.output["train"], layerConnected.output["val"], layerConnected.output["test"],
-                                        layerConnected.outputShape["train"], layerConnected.outputShape["val"], layerConnected.outputShape["test"])
+        self._dataFormat = layerConnected.getDataFormat()
         
         # At this last classification layer, the conv output needs to have bias added before the softmax.
         # NOTE: So, two biases are associated with this layer. self.b which is added in the ouput of the previous layer's output of conv,
         # and this self._bClassLayer that is added only to this final output before the softmax.
-        (self._b,
-        logits_train,
-        logits_val,
-        logits_test) = makeBiasParamsAndApplyToFms( self.input["train"], self.input["val"], self.input["test"], self._numberOfOutputClasses )
+        self._b = createBiasParams( self._numberOfOutputClasses )
         self.params = self.params + [self._b]
         
-        # ============ Softmax ==============
-        self.p_y_given_x_train = tf.nn.softmax(logits_train/t, axis=1)
-        self.y_pred_train = tf.argmax(self.p_y_given_x_train, axis=1)
-        self.p_y_given_x_val = tf.nn.softmax(logits_val/t, axis=1)
-        self.y_pred_val = tf.argmax(self.p_y_given_x_val, axis=1)
-        self.p_y_given_x_test = tf.nn.softmax(logits_test/t, axis=1)
-        self.y_pred_test = tf.argmax(self.p_y_given_x_test, axis=1)
-    
-        self._setBlocksOutputAttributes(self.p_y_given_x_train, self.p_y_given_x_val, self.p_y_given_x_test, self.inputShape["train"], self.inputShape["val"], self.inputShape["test"])
+        for mode in layerConnected.output :
+            self._setBlocksInputAttributes(mode, layerConnected.output[mode], layerConnected.outputShape[mode])
+            logits = applyBiasToFms( self.input[mode], self._b, self._dataFormat )
+            
+            # ============ Softmax ==============
+            self.p_y_given_x[mode] = tf.nn.softmax(logits/t, axis=getAxisOfFms(self._dataFormat))
+            self.y_pred[mode] = tf.argmax(self.p_y_given_x[mode], axis=getAxisOfFms(self._dataFormat))
+            
+            self._setBlocksOutputAttributes(mode, self.p_y_given_x[mode], self.inputShape[mode])
         
         layerConnected.setTargetBlock(self)
-        
-    def get_output_gt_tensor_feed(self):
+    
+    def get_output_gt_tensor_feed(self, mode):
         # Input. Dimensions of y labels: [batchSize, r, c, z]
-        y_gt_train = tf.placeholder(dtype="int32", shape=[None, None, None, None], name="y_train")
-        y_gt_val = tf.placeholder(dtype="int32", shape=[None, None, None, None], name="y_val")
-        return (y_gt_train, y_gt_val)
-        
+        y_gt = tf.placeholder(dtype="int32", shape=[None, None, None, None], name="y_"+mode)
+        return y_gt
+    
     def meanErrorTraining(self, y):
         # Returns float = number of errors / number of examples of the minibatch ; [0., 1.]
         # param y: y = T.itensor4('y'). Dimensions [batchSize, r, c, z]
         
         #Mean error of the training batch.
-        tneq = tf.logical_not( tf.equal(self.y_pred_train, y) )
+        tneq = tf.logical_not( tf.equal(self.y_pred["train"], y) )
         meanError = tf.reduce_mean(tneq)
         return meanError
     
@@ -476,39 +439,27 @@ class SoftmaxLayer(TargetLayer):
         if y.dtype.startswith('int'):
             # the T.neq operator returns a vector of 0s and 1s, where 1
             # represents a mistake in prediction
-            tneq = tf.logical_not( tf.equal(self.y_pred_val, y) )
+            tneq = tf.logical_not( tf.equal(self.y_pred["val"], y) )
             meanError = tf.reduce_mean(tneq)
             return meanError #The percentage of the predictions that is not the correct class.
         else:
             raise NotImplementedError("Not implemented behaviour for y.dtype different than int.")
-        
-    def getRpRnTpTnForTrain0OrVal1(self, y, training0OrValidation1):
-        # The returned list has (numberOfClasses)x4 integers: >numberOfRealPositives, numberOfRealNegatives, numberOfTruePredictedPositives, numberOfTruePredictedNegatives< for each class (incl background).
-        # Order in the list is the natural order of the classes (ie class-0 RP,RN,TPP,TPN, class-1 RP,RN,TPP,TPN, class-2 RP,RN,TPP,TPN ...)
-        # param y: y = T.itensor4('y'). Dimensions [batchSize, r, c, z]
-        
-        yPredToUse = self.y_pred_train if  training0OrValidation1 == 0 else self.y_pred_val
-        
-        returnedListWithNumberOfRpRnTpTnForEachClass = []
-        
-        for class_i in range(0, self._numberOfOutputClasses) :
-            #Number of Real Positive, Real Negatives, True Predicted Positives and True Predicted Negatives are reported PER CLASS (first for WHOLE).
-            tensorOneAtRealPos = tf.equal(y, class_i)
-            tensorOneAtRealNeg = tf.logical_not(tensorOneAtRealPos)
-
-            tensorOneAtPredictedPos = tf.equal(yPredToUse, class_i)
-            tensorOneAtPredictedNeg = tf.logical_not(tensorOneAtPredictedPos)
-            tensorOneAtTruePos = tf.logical_and(tensorOneAtRealPos,tensorOneAtPredictedPos)
-            tensorOneAtTrueNeg = tf.logical_and(tensorOneAtRealNeg,tensorOneAtPredictedNeg)
-                    
-            returnedListWithNumberOfRpRnTpTnForEachClass.append( tf.reduce_sum( tf.cast(tensorOneAtRealPos, dtype="int32")) )
-            returnedListWithNumberOfRpRnTpTnForEachClass.append( tf.reduce_sum( tf.cast(tensorOneAtRealNeg, dtype="int32")) )
-            returnedListWithNumberOfRpRnTpTnForEachClass.append( tf.reduce_sum( tf.cast(tensorOneAtTruePos, dtype="int32")) )
-            returnedListWithNumberOfRpRnTpTnForEachClass.append( tf.reduce_sum( tf.cast(tensorOneAtTrueNeg, dtype="int32")) )
-            
-        return returnedListWithNumberOfRpRnTpTnForEachClass
+    
+    def getConfusionMatrixForTrain0OrVal1(self, y, training0OrValidation1):
+        # Returns a single int32 tensor of shape [numberOfClasses, numberOfClasses]. Entry [i, j] is the number of voxels with label i, predicted as class j.
+        # Counted by a single bincount over (label * numberOfClasses + prediction). Per class Real/True Pos/Neg can be derived from it. See logging/accuracyMonitor.py
+        # param y: y = T.itensor4('y'). Dimensions [batchSize, r, c, z]. Labels should be in [0, numberOfClasses).
+        
+        yPredToUse = self.y_pred["train"] if  training0OrValidation1 == 0 else self.y_pred["val"]
+        
+        numberOfCellsOfMatrix = self._numberOfOutputClasses * self._numberOfOutputClasses
+        indicesInMatrix = tf.reshape( y * self._numberOfOutputClasses + tf.cast(yPredToUse, dtype="int32"), shape=[-1] )
+        # Without the min/max, length of vector can change.
+        confMatrixFlat = tf.bincount( arr = indicesInMatrix, minlength=numberOfCellsOfMatrix, maxlength=numberOfCellsOfMatrix, dtype="int32" )
+        return tf.reshape( confMatrixFlat, shape=[self._numberOfOutputClasses, self._numberOfOutputClasses] )
     
     def predictionProbabilities(self) :
-        return self.p_y_given_x_test
+        # Returned in shape [batch, classes, r, c, z], whatever the layout of the model.
+        return transposeToNCDHW( self.p_y_given_x["test"], self._dataFormat )
     
     
@@ -20,133 +20,171 @@ except ImportError:
     from sys import maxsize as MAX_INT
 
 
+###############################################################
+#            Layout of the 5D tensors of the model            #
+###############################################################
+# "NCDHW": [batch, fms, r, c, z]. Layout of the fed inputs and of the returned outputs (eg probability maps, FMs).
+# "NDHWC": [batch, r, c, z, fms]. Native layout of tf's conv3d and pooling. No transposes are needed around them.
+# Shapes kept in lists (eg Block.outputShape) are always [batch, fms, r, c, z], whatever the layout.
+# Trainable parameters have the same shape in both layouts, so saved models can be loaded by either.
+DATA_FORMATS = ["NCDHW", "NDHWC"]
+
+def getAxisOfFms(dataFormat) :
+    return 1 if dataFormat == "NCDHW" else 4
+
+def getAxesOfRcz(dataFormat) :
+    return [2, 3, 4] if dataFormat == "NCDHW" else [1, 2, 3]
+
+def sliceAlongAxes(tensor5, slicePerAxis) :
+    # slicePerAxis: {axis: slice}. Other axes are taken whole.
+    return tensor5[ tuple([ slicePerAxis[axis] if axis in slicePerAxis else slice(None) for axis in range(5) ]) ]
+
+def sliceRcz(tensor5, rczSlices, dataFormat) :
+    return sliceAlongAxes(tensor5, dict(zip(getAxesOfRcz(dataFormat), rczSlices)))
+
+def sliceFms(tensor5, fmsSlice, dataFormat) :
+    return sliceAlongAxes(tensor5, {getAxisOfFms(dataFormat): fmsSlice})
+
+def vectorPerFmTo5D(vector, numberOfFms, dataFormat) :
+    # Reshape a vector with one value per FM, to be broadcasted over a 5D tensor.
+    shape = [1, 1, 1, 1, 1]
+    shape[getAxisOfFms(dataFormat)] = numberOfFms
+    return tf.reshape(vector, shape=shape)
+
+def transposeFromNCDHW(tensor5, dataFormat) :
+    # From the layout of the fed inputs, to the layout of the model.
+    return tensor5 if dataFormat == "NCDHW" else tf.transpose(tensor5, perm=[0,2,3,4,1])
+
+def transposeToNCDHW(tensor5, dataFormat) :
+    # From the layout of the model, to the layout of the returned outputs.
+    return tensor5 if dataFormat == "NCDHW" else tf.transpose(tensor5, perm=[0,4,1,2,3])
+
+
 ###############################################################
 # Functions used by layers but do not change Layer Attributes #
 ###############################################################
 
-def applyDropout(rng, dropoutRate, inputTrainShape, inputTrain, inputVal, inputTest) :
+# Each function below applies an operation on the input of one mode: "train", "val" or "test".
+# Functions that behave differently during training and inference (eg dropout, BN) are given the mode.
+# Trainable parameters are created separately, once, so that all modes share them.
+
+def applyDropout(rng, dropoutRate, inputShape, inputTensor, mode) :
     if dropoutRate > 0.001 : #Below 0.001 I take it as if there is no dropout at all. (To avoid float problems with == 0.0. Although my tries show it actually works fine.)
         keep_prob = (1-dropoutRate)
         
-        random_tensor = keep_prob
-        random_tensor += tf.random_uniform(shape=tf.shape(inputTrain), minval=0., maxval=1., seed=rng.randint(999999), dtype="float32")
-        # 0. if [keep_prob, 1.0) and 1. if [1.0, 1.0 + keep_prob)
-        dropoutMask = tf.floor(random_tensor)
-    
-        # tf.nn.dropout(x, keep_prob) scales kept values UP, so that at inference you dont need to scale then. 
-        inputImgAfterDropoutTrain = inputTrain * dropoutMask
-        inputImgAfterDropoutVal = inputVal * keep_prob
-        inputImgAfterDropoutTest = inputTest * keep_prob
+        if mode == "train" :
+            random_tensor = keep_prob
+            random_tensor += tf.random_uniform(shape=tf.shape(inputTensor), minval=0., maxval=1., seed=rng.randint(999999), dtype="float32")
+            # 0. if [keep_prob, 1.0) and 1. if [1.0, 1.0 + keep_prob)
+            dropoutMask = tf.floor(random_tensor)
+            
+            # tf.nn.dropout(x, keep_prob) scales kept values UP, so that at inference you dont need to scale then. 
+            inputImgAfterDropout = inputTensor * dropoutMask
+        else : # Validation or testing
+            inputImgAfterDropout = inputTensor * keep_prob
     else :
-        inputImgAfterDropoutTrain = inputTrain
-        inputImgAfterDropoutVal = inputVal
-        inputImgAfterDropoutTest = inputTest
-    return (inputImgAfterDropoutTrain, inputImgAfterDropoutVal, inputImgAfterDropoutTest)
+        inputImgAfterDropout = inputTensor
+    return inputImgAfterDropout
 
 
-def applyBn(rollingAverageForBatchNormalizationOverThatManyBatches, inputTrain, inputVal, inputTest, inputShapeTrain) :
-    numOfChanns = inputShapeTrain[1]
-    
+def createBnParams(rollingAverageForBatchNormalizationOverThatManyBatches, numOfChanns) :
     gBn = tf.Variable( np.ones( (numOfChanns), dtype='float32'), name="gBn" )
     bBn = tf.Variable( np.zeros( (numOfChanns), dtype='float32'), name="bBn" )
-    gBn_resh = tf.reshape(gBn, shape=[1,numOfChanns,1,1,1])
-    bBn_resh = tf.reshape(bBn, shape=[1,numOfChanns,1,1,1])
     
     #for rolling average:
     muBnsArrayForRollingAverage = tf.Variable( np.zeros( (rollingAverageForBatchNormalizationOverThatManyBatches, numOfChanns), dtype='float32' ), name="muBnsForRollingAverage" )
     varBnsArrayForRollingAverage = tf.Variable( np.ones( (rollingAverageForBatchNormalizationOverThatManyBatches, numOfChanns), dtype='float32' ), name="varBnsForRollingAverage" )        
-    sharedNewMu_B = tf.Variable(np.zeros( (numOfChanns), dtype='float32'), name="sharedNewMu_B")
-    sharedNewVar_B = tf.Variable(np.ones( (numOfChanns), dtype='float32'), name="sharedNewVar_B")
     
-    e1 = np.finfo(np.float32).tiny 
+    return (gBn,
+            bBn,
+            # For rolling average
+            muBnsArrayForRollingAverage,
+            varBnsArrayForRollingAverage
+            )
     
-    mu_B, var_B = tf.nn.moments(inputTrain, axes=[0,2,3,4])
+def updateBnRollingAverage(muBnsArrayForRollingAverage, varBnsArrayForRollingAverage, mu_B, var_B) :
+    # Returns the ops that push the mu and var of the training batch into the rolling-average arrays, dropping the oldest entry.
+    # They are run along with the training step. The average does not depend on the order of the entries, ...
+    # ... so the arrays are shifted, instead of keeping the index of the entry to update (which would need feeding, or another variable in the saved models).
+    newMuBnsArray = tf.concat( [muBnsArrayForRollingAverage[1:], tf.expand_dims(mu_B, axis=0)], axis=0 )
+    newVarBnsArray = tf.concat( [varBnsArrayForRollingAverage[1:], tf.expand_dims(var_B, axis=0)], axis=0 )
+    return [ tf.assign( ref=muBnsArrayForRollingAverage, value=newMuBnsArray, validate_shape=True ),
+             tf.assign( ref=varBnsArrayForRollingAverage, value=newVarBnsArray, validate_shape=True ) ]
     
-    #---computing mu and var for inference from rolling average---
-    mu_MoveAv = tf.reduce_mean(muBnsArrayForRollingAverage, axis=0)
-    mu_MoveAv = tf.reshape(mu_MoveAv, shape=[1,numOfChanns,1,1,1])
-    var_MoveAv = tf.reduce_mean(varBnsArrayForRollingAverage, axis=0)
-    var_MoveAv = var_MoveAv + e1
-    var_MoveAv = tf.reshape(var_MoveAv, shape=[1,numOfChanns,1,1,1])
+def applyBn(inputTensor, mode, gBn, bBn, muBnsArrayForRollingAverage, varBnsArrayForRollingAverage, dataFormat) :
+    # Returns the normalized input. For training, also the mu and var of the batch, to update the rolling average. Otherwise None.
+    numOfChanns = gBn.get_shape().as_list()[0]
+    gBn_resh = vectorPerFmTo5D(gBn, numOfChanns, dataFormat)
+    bBn_resh = vectorPerFmTo5D(bBn, numOfChanns, dataFormat)
     
-    #OUTPUT FOR TRAINING
-    mu_B_resh = tf.reshape(mu_B, shape=[1,numOfChanns,1,1,1])
-    var_B_resh = tf.reshape(var_B, shape=[1,numOfChanns,1,1,1])
-    normXi_train = (inputTrain - mu_B_resh ) /  tf.sqrt(var_B_resh + e1) # e1 should come OUT of the sqrt! 
-    normYi_train = gBn_resh * normXi_train + bBn_resh
-    #OUTPUT FOR VALIDATION
-    normXi_val = (inputVal - mu_MoveAv) /  tf.sqrt(var_MoveAv) 
-    normYi_val = gBn_resh * normXi_val + bBn_resh
-    #OUTPUT FOR TESTING
-    normXi_test = (inputTest - mu_MoveAv) /  tf.sqrt(var_MoveAv) 
-    normYi_test = gBn_resh * normXi_test + bBn_resh
+    e1 = np.finfo(np.float32).tiny 
     
-    return (normYi_train,
-            normYi_val,
-            normYi_test,
-            gBn,
-            bBn,
-            # For rolling average
-            muBnsArrayForRollingAverage,
-            varBnsArrayForRollingAverage,
-            sharedNewMu_B,
-            sharedNewVar_B,
-            mu_B, # this is the current value of muB calculated in this training iteration. It will be saved in the "sharedNewMu_B" (update), in order to be used for updating the rolling average. Something could be simplified here.
+    if mode == "train" :
+        mu_B, var_B = tf.nn.moments(inputTensor, axes=[0] + getAxesOfRcz(dataFormat))
+        mu_B_resh = vectorPerFmTo5D(mu_B, numOfChanns, dataFormat)
+        var_B_resh = vectorPerFmTo5D(var_B, numOfChanns, dataFormat)
+        normXi = (inputTensor - mu_B_resh ) /  tf.sqrt(var_B_resh + e1) # e1 should come OUT of the sqrt! 
+    else : # Validation or testing. Use mu and var computed from rolling average.
+        mu_B, var_B = None, None
+        mu_MoveAv = tf.reduce_mean(muBnsArrayForRollingAverage, axis=0)
+        mu_MoveAv = vectorPerFmTo5D(mu_MoveAv, numOfChanns, dataFormat)
+        var_MoveAv = tf.reduce_mean(varBnsArrayForRollingAverage, axis=0)
+        var_MoveAv = var_MoveAv + e1
+        var_MoveAv = vectorPerFmTo5D(var_MoveAv, numOfChanns, dataFormat)
+        normXi = (inputTensor - mu_MoveAv) /  tf.sqrt(var_MoveAv) 
+    normYi = gBn_resh * normXi + bBn_resh
+    
+    return (normYi,
+            mu_B, # this is the current value of muB calculated in this training iteration. Used for updating the rolling average, see updateBnRollingAverage().
             var_B
             )
     
     
-def makeBiasParamsAndApplyToFms( fmsTrain, fmsVal, fmsTest, numberOfFms ) :
+def createBiasParams( numberOfFms ) :
     b_values = np.zeros( (numberOfFms), dtype = 'float32')
     b = tf.Variable(b_values, name="b")
-    b_resh = tf.reshape(b, shape=[1,numberOfFms,1,1,1])
-    fmsWithBiasAppliedTrain = fmsTrain + b_resh
-    fmsWithBiasAppliedVal = fmsVal + b_resh
-    fmsWithBiasAppliedTest = fmsTest + b_resh
-    return (b, fmsWithBiasAppliedTrain, fmsWithBiasAppliedVal, fmsWithBiasAppliedTest)
+    return b
 
-def applyRelu(inputTrain, inputVal, inputTest):
-    #input is a tensor of shape (batchSize, FMs, r, c, z)
-    outputTrain= tf.maximum(0., inputTrain)
-    outputVal = tf.maximum(0., inputVal)
-    outputTest = tf.maximum(0., inputTest)
-    return ( outputTrain, outputVal, outputTest )
+def applyBiasToFms( fms, b, dataFormat ) :
+    numberOfFms = b.get_shape().as_list()[0]
+    b_resh = vectorPerFmTo5D(b, numberOfFms, dataFormat)
+    fmsWithBiasApplied = fms + b_resh
+    return fmsWithBiasApplied
 
-def applyPrelu( inputTrain, inputVal, inputTest, numberOfInputChannels ) :
+def applyRelu(inputTensor):
     #input is a tensor of shape (batchSize, FMs, r, c, z)
+    output= tf.maximum(0., inputTensor)
+    return output
+
+def createPreluParams( numberOfInputChannels ) :
     aPreluValues = np.ones( (numberOfInputChannels), dtype = 'float32' ) * 0.01 #"Delving deep into rectifiers" initializes it like this. LeakyRelus are at 0.01
     aPrelu = tf.Variable(aPreluValues, name="aPrelu") #One separate a (activation) per feature map.
-    aPrelu5D = tf.reshape(aPrelu, shape=[1, numberOfInputChannels, 1, 1, 1] )
+    return aPrelu
+
+def applyPrelu( inputTensor, aPrelu, dataFormat ) :
+    #input is a tensor of shape (batchSize, FMs, r, c, z) or (batchSize, r, c, z, FMs), as dataFormat.
+    numberOfInputChannels = aPrelu.get_shape().as_list()[0]
+    aPrelu5D = vectorPerFmTo5D(aPrelu, numberOfInputChannels, dataFormat)
     
-    posTrain = tf.maximum(0., inputTrain)
-    negTrain = aPrelu5D * (inputTrain - abs(inputTrain)) * 0.5
-    outputTrain = posTrain + negTrain
-    posVal = tf.maximum(0., inputVal)
-    negVal = aPrelu5D * (inputVal - abs(inputVal)) * 0.5
-    outputVal = posVal + negVal
-    posTest = tf.maximum(0., inputTest)
-    negTest = aPrelu5D * (inputTest - abs(inputTest)) * 0.5
-    outputTest = posTest + negTest
+    pos = tf.maximum(0., inputTensor)
+    neg = aPrelu5D * (inputTensor - abs(inputTensor)) * 0.5
+    output = pos + neg
     
-    return ( aPrelu, outputTrain, outputVal, outputTest )
+    return output
 
-def applyElu(inputTrain, inputVal, inputTest):
+def applyElu(inputTensor):
     #input is a tensor of shape (batchSize, FMs, r, c, z)
-    outputTrain = tf.nn.elu(inputTrain)
-    outputVal = tf.nn.elu(inputVal)
-    outputTest = tf.nn.elu(inputTest)
-    return ( outputTrain, outputVal, outputTest )
+    output = tf.nn.elu(inputTensor)
+    return output
 
-def applySelu(inputTrain, inputVal, inputTest):
+def applySelu(inputTensor):
     #input is a tensor of shape (batchSize, FMs, r, c, z)
     lambda01 = 1.0507 # calc in p4 of paper.
     alpha01 = 1.6733
     
-    outputTrain = lambda01 * tf.nn.elu(inputTrain)
-    outputVal = lambda01 *  tf.nn.elu(inputVal)
-    outputTest = lambda01 * tf.nn.elu(inputTest)
+    output = lambda01 * tf.nn.elu(inputTensor)
     
-    return ( outputTrain, outputVal, outputTest )
+    return output
 
 def createAndInitializeWeightsTensor(filterShape, convWInitMethod, rng) :
     # filterShape of dimensions: [#FMs in this layer, #FMs in input, rKernelDim, cKernelDim, zKernelDim]
@@ -161,100 +199,84 @@ def createAndInitializeWeightsTensor(filterShape, convWInitMethod, rng) :
     # W shape: [#FMs of this layer, #FMs of Input, rKernFims, cKernDims, zKernDims]
     return W
 
-def convolveWithGivenWeightMatrix(W, filterShape, inputToConvTrain, inputToConvVal, inputToConvTest, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) :
+def convolveWithGivenWeightMatrix(W, filterShape, inputToConv, inputToConvShape, dataFormat) :
     # input weight matrix W has shape: [ #ChannelsOut, #ChannelsIn, R, C, Z ] == filterShape
     # filterShape is the shape of W.
-    # Input signal given in shape [BatchSize, Channels, R, C, Z]
+    # Input signal given in shape [BatchSize, Channels, R, C, Z] if dataFormat is NCDHW, else [BatchSize, R, C, Z, Channels].
     
-    # Tensorflow's Conv3d requires filter shape: [ D/Z, H/C, W/R, C_in, C_out ] #ChannelsOut, #ChannelsIn, Z, R, C ]
-    wReshapedForConv = tf.transpose( W, perm=[4,3,2,1,0] )
-    
-    # Conv3d requires signal in shape: [BatchSize, Channels, Z, R, C]
-    inputToConvReshapedTrain = tf.transpose( inputToConvTrain, perm=[0,4,3,2,1] )
-    outputOfConvTrain = tf.nn.conv3d(input = inputToConvReshapedTrain, # batch_size, time, num_of_input_channels, rows, columns
-                                  filter = wReshapedForConv, # TF: Depth, Height, Wight, Chans_in, Chans_out
-                                  strides = [1,1,1,1,1],
-                                  padding = "VALID",
-                                  data_format = "NDHWC"
-                                  )
-    #Output is in the shape of the input image (signals_shape).
-    outputTrain = tf.transpose( outputOfConvTrain, perm=[0,4,3,2,1] ) #reshape the result, back to the shape of the input image.
-    
-    #Validation
-    inputToConvReshapedVal = tf.transpose( inputToConvVal, perm=[0,4,3,2,1] )
-    outputOfConvVal = tf.nn.conv3d(input = inputToConvReshapedVal,
-                                  filter = wReshapedForConv,
-                                  strides = [1,1,1,1,1],
-                                  padding = "VALID",
-                                  data_format = "NDHWC"
-                                  )
-    outputVal = tf.transpose( outputOfConvVal, perm=[0,4,3,2,1] )
-    
-    #Testing
-    inputToConvReshapedTest = tf.transpose( inputToConvTest, perm=[0,4,3,2,1] )
-    outputOfConvTest = tf.nn.conv3d(input = inputToConvReshapedTest,
-                                  filter = wReshapedForConv,
-                                  strides = [1,1,1,1,1],
-                                  padding = "VALID",
-                                  data_format = "NDHWC"
-                                  )
-    outputTest = tf.transpose( outputOfConvTest, perm=[0,4,3,2,1] )
+    if dataFormat == "NCDHW" :
+        # Tensorflow's Conv3d requires filter shape: [ D/Z, H/C, W/R, C_in, C_out ] #ChannelsOut, #ChannelsIn, Z, R, C ]
+        wReshapedForConv = tf.transpose( W, perm=[4,3,2,1,0] )
+        
+        # Conv3d requires signal in shape: [BatchSize, Channels, Z, R, C]
+        inputToConvReshaped = tf.transpose( inputToConv, perm=[0,4,3,2,1] )
+        outputOfConv = tf.nn.conv3d(input = inputToConvReshaped, # batch_size, time, num_of_input_channels, rows, columns
+                                      filter = wReshapedForConv, # TF: Depth, Height, Wight, Chans_in, Chans_out
+                                      strides = [1,1,1,1,1],
+                                      padding = "VALID",
+                                      data_format = "NDHWC"
+                                      )
+        #Output is in the shape of the input image (signals_shape).
+        output = tf.transpose( outputOfConv, perm=[0,4,3,2,1] ) #reshape the result, back to the shape of the input image.
+    else : # NDHWC, native. Only the (small) filter is transposed, to: [ D/R, H/C, W/Z, C_in, C_out ]
+        wReshapedForConv = tf.transpose( W, perm=[2,3,4,1,0] )
+        output = tf.nn.conv3d(input = inputToConv,
+                              filter = wReshapedForConv,
+                              strides = [1,1,1,1,1],
+                              padding = "VALID",
+                              data_format = "NDHWC"
+                              )
     
-    outputShapeTrain = [inputToConvShapeTrain[0],
-                        filterShape[0],
-                        inputToConvShapeTrain[2]-filterShape[2]+1,
-                        inputToConvShapeTrain[3]-filterShape[3]+1,
-                        inputToConvShapeTrain[4]-filterShape[4]+1]
-    outputShapeVal = [  inputToConvShapeVal[0],
-                        filterShape[0],
-                        inputToConvShapeVal[2]-filterShape[2]+1,
-                        inputToConvShapeVal[3]-filterShape[3]+1,
-                        inputToConvShapeVal[4]-filterShape[4]+1]
-    outputShapeTest = [ inputToConvShapeTest[0],
-                        filterShape[0],
-                        inputToConvShapeTest[2]-filterShape[2]+1,
-                        inputToConvShapeTest[3]-filterShape[3]+1,
-                        inputToConvShapeTest[4]-filterShape[4]+1]
+    outputShape = [ inputToConvShape[0],
+                    filterShape[0],
+                    inputToConvShape[2]-filterShape[2]+1,
+                    inputToConvShape[3]-filterShape[3]+1,
+                    inputToConvShape[4]-filterShape[4]+1]
     
-    return (outputTrain, outputVal, outputTest, outputShapeTrain, outputShapeVal, outputShapeTest)
+    return (output, outputShape)
 
 
 # Currently only used for pooling3d
-def mirrorFinalBordersOfImage(image3dBC012, mirrorFinalBordersForThatMuch) :
+def mirrorFinalBordersOfImage(image3dBC012, mirrorFinalBordersForThatMuch, dataFormat) :
     image3dBC012WithMirrorPad = image3dBC012
-    for time_i in range(0, mirrorFinalBordersForThatMuch[0]) :
-        image3dBC012WithMirrorPad = tf.concat([ image3dBC012WithMirrorPad, image3dBC012WithMirrorPad[:,:,-1:,:,:] ], axis=2)
-    for time_i in range(0, mirrorFinalBordersForThatMuch[1]) :
-        image3dBC012WithMirrorPad = tf.concat([ image3dBC012WithMirrorPad, image3dBC012WithMirrorPad[:,:,:,-1:,:] ], axis=3)
-    for time_i in range(0, mirrorFinalBordersForThatMuch[2]) :
-        image3dBC012WithMirrorPad = tf.concat([ image3dBC012WithMirrorPad, image3dBC012WithMirrorPad[:,:,:,:,-1:] ], axis=4)
+    for rcz_i, axis in enumerate(getAxesOfRcz(dataFormat)) :
+        for time_i in range(0, mirrorFinalBordersForThatMuch[rcz_i]) :
+            image3dBC012WithMirrorPad = tf.concat([ image3dBC012WithMirrorPad, sliceAlongAxes(image3dBC012WithMirrorPad, {axis: slice(-1, None)}) ], axis=axis)
     return image3dBC012WithMirrorPad
 
 
-def pool3dMirrorPad(image3dBC012, image3dBC012Shape, poolParams) :
-    # image3dBC012 dimensions: (batch, fms, r, c, z)
+def pool3dMirrorPad(image3dBC012, image3dBC012Shape, poolParams, dataFormat) :
+    # image3dBC012 dimensions: (batch, fms, r, c, z) or (batch, r, c, z, fms), as dataFormat.
     # poolParams: [[dsr,dsc,dsz], [strr,strc,strz], [mirrorPad-r,-c,-z], mode]
     ws = poolParams[0] # window size
     stride = poolParams[1] # stride
     mode1 = poolParams[3] # MAX or AVG
     
-    image3dBC012WithMirrorPad = mirrorFinalBordersOfImage(image3dBC012, poolParams[2])
+    image3dBC012WithMirrorPad = mirrorFinalBordersOfImage(image3dBC012, poolParams[2], dataFormat)
     
-    pooled_out = tf.nn.pool( input = tf.transpose( image3dBC012WithMirrorPad, perm=[0,4,3,2,1] ),
-                            window_shape=ws,
-                            strides=stride,
-                            padding="VALID", # SAME or VALID
-                            pooling_type=mode1,
-                            data_format="NDHWC") # AVG or MAX
-    pooled_out = tf.transpose( pooled_out, perm=[0,4,3,2,1] )
+    if dataFormat == "NCDHW" :
+        pooled_out = tf.nn.pool( input = tf.transpose( image3dBC012WithMirrorPad, perm=[0,4,3,2,1] ),
+                                window_shape=ws,
+                                strides=stride,
+                                padding="VALID", # SAME or VALID
+                                pooling_type=mode1,
+                                data_format="NDHWC") # AVG or MAX
+        pooled_out = tf.transpose( pooled_out, perm=[0,4,3,2,1] )
+    else : # NDHWC, native.
+        pooled_out = tf.nn.pool( input = image3dBC012WithMirrorPad,
+                                window_shape=ws,
+                                strides=stride,
+                                padding="VALID",
+                                pooling_type=mode1,
+                                data_format="NDHWC")
     
     #calculate the shape of the image after the max pooling.
     #This calculation is for ignore_border=True! Pooling should only be done in full areas in the mirror-padded image.
     imgShapeAfterPoolAndPad = [ image3dBC012Shape[0],
                                 image3dBC012Shape[1],
-                                int(ceil( (image3dBC012Shape[2] + poolParams[2][0] - ds[0] + 1) / (1.0*stride[0])) ),
-                                int(ceil( (image3dBC012Shape[3] + poolParams[2][1] - ds[1] + 1) / (1.0*stride[1])) ),
-                                int(ceil( (image3dBC012Shape[4] + poolParams[2][2] - ds[2] + 1) / (1.0*stride[2])) )
+                                int(ceil( (image3dBC012Shape[2] + poolParams[2][0] - ws[0] + 1) / (1.0*stride[0])) ),
+                                int(ceil( (image3dBC012Shape[3] + poolParams[2][1] - ws[1] + 1) / (1.0*stride[1])) ),
+                                int(ceil( (image3dBC012Shape[4] + poolParams[2][2] - ws[2] + 1) / (1.0*stride[2])) )
                             ]
     return (pooled_out, imgShapeAfterPoolAndPad)
 
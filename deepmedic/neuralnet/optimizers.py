@@ -11,9 +11,15 @@ import tensorflow as tf
 
 # Abstract
 class Optimizer(object):
-    def __init__(self, params_to_opt):
+    def __init__(self, params_to_opt, num_batches_accum_grads=1):
         self._params_to_opt = params_to_opt
+        # If > 1, grads of that many consecutive batches are accumulated, and params are updated once with their mean.
+        self._num_batches_accum_grads = num_batches_accum_grads
+        self._accum_grads = None # list of tf.var. Only when accumulating grads.
+        self._num_batches_accum_tfv = None # tf.var. Number of batches accumulated since last update.
         self._initialize_vars()
+        if self._num_batches_accum_grads > 1 :
+            self._initialize_vars_for_accum_grads()
     
     # Abstract
     def _initialize_vars(self):
@@ -30,15 +36,47 @@ class Optimizer(object):
     
     def get_update_ops_given_cost(self, cost) :
         grads = self.get_grads_for_params_responsible(cost)
+        if self._num_batches_accum_grads > 1 :
+            return self._get_update_ops_accumulating_grads(grads)
         return self.get_update_ops_given_grads(grads)
     
+    # ==== Gradient accumulation ====
+    def _initialize_vars_for_accum_grads(self):
+        # Local variables, not saved with the model. Partially accumulated grads are not needed to resume training.
+        self._accum_grads = []
+        for param in self._params_to_opt :
+            self._accum_grads.append( tf.Variable( tf.zeros(param.get_shape(), dtype="float32"), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="accum_grads") )
+        self._num_batches_accum_tfv = tf.Variable(0, dtype="int32", trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name="num_batches_accum")
+        
+    def _get_update_ops_accumulating_grads(self, grads):
+        # Every batch, add the grads to the accumulators. Every self._num_batches_accum_grads batches, ...
+        # ... update the params once with the mean of the accumulated grads (same as a larger batch), and reset the accumulators.
+        # Optimizer's state (momentum, Adam's iteration, etc) only changes with the updates.
+        accum_grads_new = [ tf.assign_add(ref=accu, value=grad) for accu, grad in zip(self._accum_grads, grads) ]
+        num_batches_accum_new = tf.assign_add(ref=self._num_batches_accum_tfv, value=1)
+        with tf.control_dependencies(accum_grads_new) : # So that grads are accumulated, even if no update is made.
+            update_now = tf.equal(num_batches_accum_new, self._num_batches_accum_grads)
+        op_update_if_accumulated = tf.cond( update_now,
+                                            true_fn=lambda: self._get_op_update_with_accum_grads_and_reset(accum_grads_new),
+                                            false_fn=tf.no_op )
+        return [op_update_if_accumulated]
+    
+    def _get_op_update_with_accum_grads_and_reset(self, accum_grads):
+        mean_grads = [ accu / self._num_batches_accum_grads for accu in accum_grads ]
+        updates = self.get_update_ops_given_grads(mean_grads)
+        with tf.control_dependencies(updates) :
+            resets = [ tf.assign(ref=accu, value=tf.zeros_like(accu), validate_shape=True) for accu in self._accum_grads ]
+            resets.append( tf.assign(ref=self._num_batches_accum_tfv, value=0) )
+        return tf.group(*resets)
+    
 class SgdOptimizer(Optimizer):
     def __init__(self,
                  params_to_opt,
                  learning_rate,
                  momentum,
                  momentumTypeNONNormalized0orNormalized1,
-                 classicMomentum0OrNesterov1):
+                 classicMomentum0OrNesterov1,
+                 num_batches_accum_grads=1):
         
         self.name = "SgdOptimizer"
         
@@ -49,7 +87,7 @@ class SgdOptimizer(Optimizer):
         
         self._velocities_for_mom = None # list  tf.var
         
-        Optimizer.__init__(self, params_to_opt)
+        Optimizer.__init__(self, params_to_opt, num_batches_accum_grads)
         
     def _initialize_vars(self):
         self._velocities_for_mom = []
@@ -83,7 +121,8 @@ class AdamOptimizer(Optimizer):
                  learning_rate,
                  b1_adam,
                  b2_adam,
-                 eps):
+                 eps,
+                 num_batches_accum_grads=1):
         
         self.name = "AdamOptimizer"
         
@@ -97,7 +136,7 @@ class AdamOptimizer(Optimizer):
         self._vars_of_grads = None
 
         
-        Optimizer.__init__(self, params_to_opt)
+        Optimizer.__init__(self, params_to_opt, num_batches_accum_grads)
         
     def _initialize_vars(self) :
         self._i_adam = tf.Variable(0.0, dtype="float32", name="i_adam")  # Current iteration of Adam
@@ -139,7 +178,8 @@ class RmsPropOptimizer(Optimizer):
                  momentumTypeNONNormalized0orNormalized1,
                  classicMomentum0OrNesterov1,
                  rho,
-                 eps):
+                 eps,
+                 num_batches_accum_grads=1):
         
         self.name = "RmsPropOptimizer"
         
@@ -153,7 +193,7 @@ class RmsPropOptimizer(Optimizer):
         self._accu_grad_squared = None
         self._velocities_for_mom = None
         
-        Optimizer.__init__(self, params_to_opt)
+        Optimizer.__init__(self, params_to_opt, num_batches_accum_grads)
         
     def _initialize_vars(self) :
         self._accu_grad_squared = []
@@ -15,106 +15,104 @@ import tensorflow as tf
 from deepmedic.neuralnet.pathwayTypes import PathwayTypes
 from deepmedic.neuralnet.utils import calcRecFieldFromKernDimListPerLayerWhenStrides1
 from deepmedic.neuralnet.layers import ConvLayer, LowRankConvLayer
+from deepmedic.neuralnet.ops import getAxisOfFms, getAxesOfRcz, sliceRcz, sliceFms
 
 
 #################################################################
 #                         Pathway Types                         #
 #################################################################
 
-def cropRczOf5DimArrayToMatchOther(array5DimToCrop, dimensionsOf5DimArrayToMatchInRcz):
+def cropRczOf5DimArrayToMatchOther(array5DimToCrop, dimensionsOf5DimArrayToMatchInRcz, dataFormat):
     # dimensionsOf5DimArrayToMatchInRcz : [ batch size, num of fms, r, c, z] 
-    output = array5DimToCrop[:,
-                            :,
-                            :dimensionsOf5DimArrayToMatchInRcz[2],
-                            :dimensionsOf5DimArrayToMatchInRcz[3],
-                            :dimensionsOf5DimArrayToMatchInRcz[4]]
+    output = sliceRcz(array5DimToCrop,
+                      [slice(None, dimensionsOf5DimArrayToMatchInRcz[2]),
+                       slice(None, dimensionsOf5DimArrayToMatchInRcz[3]),
+                       slice(None, dimensionsOf5DimArrayToMatchInRcz[4])],
+                      dataFormat)
     return output
     
-def repeatRcz5DimArrayByFactor(array5Dim, factor3Dim):
-    # array5Dim: [batch size, num of FMs, r, c, z]. Ala input/output of conv layers.
-    # Repeat FM in the three last dimensions, to upsample back to the normal resolution space.
+def repeatRcz5DimArrayByFactor(array5Dim, factor3Dim, dataFormat):
+    # array5Dim: [batch size, num of FMs, r, c, z] or [batch size, r, c, z, num of FMs], as dataFormat. Ala input/output of conv layers.
+    # Repeat FM in the three r,c,z dimensions, to upsample back to the normal resolution space.
     # In numpy below: (but tf has no repeat, only tile, so, implementation is funny.
     #expandedR = array5Dim.repeat(factor3Dim[0], axis=2)
     #expandedRC = expandedR.repeat(factor3Dim[1], axis=3)
     #expandedRCZ = expandedRC.repeat(factor3Dim[2], axis=4)
     res = array5Dim
-    res_shape = tf.shape(array5Dim) # Dynamic. For batch and r,c,z dimensions. (unknown prior to runtime)
-    n_fms = array5Dim.get_shape()[1] # Static via get_shape(). Known. For reshape to return tensor with *known* shape[1].
-    # If tf.shape()[1] is used, reshape changes res.get_shape()[1] to (?).
-    
-    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1]*res_shape[2], 1, res_shape[3], res_shape[4]] ),
-                               multiples=[1, 1, factor3Dim[0], 1, 1] ),
-                    shape=[res_shape[0], n_fms, res_shape[2]*factor3Dim[0], res_shape[3], res_shape[4]] )
-    res_shape = tf.shape(res)
-    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1], res_shape[2]*res_shape[3], 1, res_shape[4]] ),
-                               multiples=[1, 1, 1, factor3Dim[1], 1] ),
-                    shape=[res_shape[0], n_fms, res_shape[2], res_shape[3]*factor3Dim[1], res_shape[4]] )
-    res_shape = tf.shape(res)
-    res = tf.reshape( tf.tile( tf.reshape( res, shape=[res_shape[0], res_shape[1], res_shape[2], res_shape[3]*res_shape[4], 1] ),
-                               multiples=[1, 1, 1, 1, factor3Dim[2]] ),
-                    shape=[res_shape[0], n_fms, res_shape[2], res_shape[3], res_shape[4]*factor3Dim[2]] )
+    axisOfFms = getAxisOfFms(dataFormat)
+    n_fms = array5Dim.get_shape()[axisOfFms] # Static via get_shape(). Known. For reshape to return tensor with *known* number of fms.
+    # If tf.shape()[axisOfFms] is used, reshape changes the number of fms in res.get_shape() to (?).
+    for rcz_i, axis in enumerate(getAxesOfRcz(dataFormat)) :
+        res_shape = tf.shape(res) # Dynamic. For batch and r,c,z dimensions. (unknown prior to runtime)
+        # Flatten the dimensions up to (incl) the repeated one, and those after it. Tile in a new dimension in between.
+        shapeToTile = [ tf.reduce_prod(res_shape[:axis+1]), 1, tf.reduce_prod(res_shape[axis+1:]) ]
+        shapeOfRes = [ n_fms if dim_i == axisOfFms else res_shape[dim_i] for dim_i in range(5) ]
+        shapeOfRes[axis] = res_shape[axis] * factor3Dim[rcz_i]
+        res = tf.reshape( tf.tile( tf.reshape( res, shape=shapeToTile ),
+                                   multiples=[1, factor3Dim[rcz_i], 1] ),
+                        shape=shapeOfRes )
     return res
     
 def upsampleRcz5DimArrayAndOptionalCrop(array5dimToUpsample,
                                         upsamplingFactor,
                                         upsamplingScheme="repeat",
-                                        dimensionsOf5DimArrayToMatchInRcz=None) :
-    # array5dimToUpsample : [batch_size, numberOfFms, r, c, z].
+                                        dimensionsOf5DimArrayToMatchInRcz=None,
+                                        dataFormat="NDHWC") :
+    # array5dimToUpsample : [batch_size, numberOfFms, r, c, z] or [batch_size, r, c, z, numberOfFms], as dataFormat.
     if upsamplingScheme == "repeat" :
-        upsampledOutput = repeatRcz5DimArrayByFactor(array5dimToUpsample, upsamplingFactor)
+        upsampledOutput = repeatRcz5DimArrayByFactor(array5dimToUpsample, upsamplingFactor, dataFormat)
     else :
         print("ERROR: in upsampleRcz5DimArrayAndOptionalCrop(...). Not implemented type of upsampling! Exiting!"); exit(1)
         
     if dimensionsOf5DimArrayToMatchInRcz != None :
         # If the central-voxels are eg 10, the susampled-part will have 4 central voxels. Which above will be repeated to 3*4 = 12.
         # I need to clip the last ones, to have the same dimension as the input from 1st pathway, which will have dimensions equal to the centrally predicted voxels (10)
-        output = cropRczOf5DimArrayToMatchOther(upsampledOutput, dimensionsOf5DimArrayToMatchInRcz)
+        output = cropRczOf5DimArrayToMatchOther(upsampledOutput, dimensionsOf5DimArrayToMatchInRcz, dataFormat)
     else :
         output = upsampledOutput
         
     return output
     
-def getMiddlePartOfFms(fms, listOfNumberOfCentralVoxelsToGetPerDimension) :
-    # fms: a 5D tensor, [batch, fms, r, c, z]
-    # listOfNumberOfCentralVoxelsToGetPerDimension: list of 3 scalars or Tensorflow 1D tensor (eg from tf.shape(x)). [r, c, z]
+def getMiddlePartOfFms(fms, listOfNumberOfCentralVoxelsToGetPerDimension, dataFormat) :
+    # fms: a 5D tensor, [batch, fms, r, c, z] or [batch, r, c, z, fms], as dataFormat.
+    # listOfNumberOfCentralVoxelsToGetPerDimension: list of 3 scalars or Tensorflow scalar tensors (eg from tf.shape(x)). [r, c, z]
     fmsShape = tf.shape(fms) #fms.shape works too.
-    # if part is of even width, one voxel to the left is the centre.
-    rCentreOfPartIndex = (fmsShape[2] - 1) // 2
-    rIndexToStartGettingCentralVoxels = rCentreOfPartIndex - (listOfNumberOfCentralVoxelsToGetPerDimension[0] - 1) // 2
-    rIndexToStopGettingCentralVoxels = rIndexToStartGettingCentralVoxels + listOfNumberOfCentralVoxelsToGetPerDimension[0]  # Excluding
-    cCentreOfPartIndex = (fmsShape[3] - 1) // 2
-    cIndexToStartGettingCentralVoxels = cCentreOfPartIndex - (listOfNumberOfCentralVoxelsToGetPerDimension[1] - 1) // 2
-    cIndexToStopGettingCentralVoxels = cIndexToStartGettingCentralVoxels + listOfNumberOfCentralVoxelsToGetPerDimension[1]  # Excluding
-    zCentreOfPartIndex = (fmsShape[4] - 1) // 2
-    zIndexToStartGettingCentralVoxels = zCentreOfPartIndex - (listOfNumberOfCentralVoxelsToGetPerDimension[2] - 1) // 2
-    zIndexToStopGettingCentralVoxels = zIndexToStartGettingCentralVoxels + listOfNumberOfCentralVoxelsToGetPerDimension[2]  # Excluding
-    return fms[	:, :,
-                rIndexToStartGettingCentralVoxels : rIndexToStopGettingCentralVoxels,
-                cIndexToStartGettingCentralVoxels : cIndexToStopGettingCentralVoxels,
-                zIndexToStartGettingCentralVoxels : zIndexToStopGettingCentralVoxels]
+    slicesOfCentralVoxels = []
+    for rcz_i, axis in enumerate(getAxesOfRcz(dataFormat)) :
+        # if part is of even width, one voxel to the left is the centre.
+        centreOfPartIndex = (fmsShape[axis] - 1) // 2
+        indexToStartGettingCentralVoxels = centreOfPartIndex - (listOfNumberOfCentralVoxelsToGetPerDimension[rcz_i] - 1) // 2
+        indexToStopGettingCentralVoxels = indexToStartGettingCentralVoxels + listOfNumberOfCentralVoxelsToGetPerDimension[rcz_i]  # Excluding
+        slicesOfCentralVoxels.append( slice(indexToStartGettingCentralVoxels, indexToStopGettingCentralVoxels) )
+    return sliceRcz(fms, slicesOfCentralVoxels, dataFormat)
 
         
-def makeResidualConnection(log, deeperLOut, earlierLOut) :
+def makeResidualConnection(log, deeperLOut, earlierLOut, dataFormat) :
     # Add the outputs of the two layers and return the output, as well as its dimensions.
-    # deeperLOut & earlierLOut: 5D tensors [batchsize, chans, x, y, z], outputs of deepest and earliest layer of the Res.Conn.
+    # deeperLOut & earlierLOut: 5D tensors [batchsize, chans, x, y, z] (or channels last, as dataFormat), outputs of deepest and earliest layer of the Res.Conn.
     # Result: Shape of result should be exactly the same as the output of Deeper layer.
+    axisOfFms = getAxisOfFms(dataFormat)
     deeperLOutShape = tf.shape(deeperLOut)
     earlierLOutShape = tf.shape(earlierLOut)
     # Get part of the earlier layer that is of the same dimensions as the FMs of the deeper:
-    partOfEarlierFmsToAddTrain = getMiddlePartOfFms(earlierLOut, deeperLOutShape[2:])
+    partOfEarlierFmsToAddTrain = getMiddlePartOfFms(earlierLOut, [deeperLOutShape[axis] for axis in getAxesOfRcz(dataFormat)], dataFormat)
     # Add the FMs, after taking care of zero padding if the deeper layer has more FMs.
-    if deeperLOut.get_shape()[1] >= earlierLOut.get_shape()[1] : # ifs not allowed via tensor (from tf.shape(...))
-        zeroFmsToConcatTrain = tf.zeros(shape=[deeperLOutShape[0],
-                                               deeperLOutShape[1] - earlierLOutShape[1],
-                                               deeperLOutShape[2], deeperLOutShape[3], deeperLOutShape[4]], dtype="float32")
-        outputOfResConnTrain = deeperLOut + tf.concat( [partOfEarlierFmsToAddTrain, zeroFmsToConcatTrain], axis=1)
+    if deeperLOut.get_shape()[axisOfFms] >= earlierLOut.get_shape()[axisOfFms] : # ifs not allowed via tensor (from tf.shape(...))
+        shapeOfZeroFms = [ deeperLOutShape[dim_i] for dim_i in range(5) ]
+        shapeOfZeroFms[axisOfFms] = deeperLOutShape[axisOfFms] - earlierLOutShape[axisOfFms]
+        zeroFmsToConcatTrain = tf.zeros(shape=shapeOfZeroFms, dtype="float32")
+        outputOfResConnTrain = deeperLOut + tf.concat( [partOfEarlierFmsToAddTrain, zeroFmsToConcatTrain], axis=axisOfFms)
 
     else : # Deeper FMs are fewer than earlier. This should not happen in most architectures. But oh well...
-        outputOfResConnTrain = deeperLOut + partOfEarlierFmsToAddTrain[:, :deeperLOutShape[1], :,:,:]
+        outputOfResConnTrain = deeperLOut + sliceFms(partOfEarlierFmsToAddTrain, slice(None, deeperLOutShape[axisOfFms]), dataFormat)
         
     # Dimensions of output are the same as those of the deeperLayer
     return outputOfResConnTrain
     
+def strOfShapesPerMode(shapePerMode) :
+    # For logging. shapePerMode: {mode: shape}, for the modes built.
+    return ", ".join([ "(" + mode.capitalize() + ") " + str(shapePerMode[mode]) for mode in ["train", "val", "test"] if mode in shapePerMode ])
+    
     
 #################################################################
 #                        Classes of Pathways                    #
@@ -128,27 +126,25 @@ class Pathway(object):
         self._pType = None # Pathway Type.
         
         # === Input to the pathway ===
-        self._input = {"train": None, "val": None, "test": None}
-        self._inputShape = {"train": None, "val": None, "test": None}
+        # Inputs and outputs have one entry per mode ("train", "val", "test") that the pathway is built for.
+        self._input = {}
+        self._inputShape = {}
         
         # === Basic architecture parameters === 
         self._layersInPathway = []
         self._subsFactor = [1,1,1]
+        self._dataFormat = None # Layout of the 5D tensors. See ops.DATA_FORMATS.
         self._recField = None # At the end of pathway
         
         # === Output of the block ===
-        self._output = {"train": None, "val": None, "test": None}
-        self._outputShape = {"train": None, "val": None, "test": None}
+        self._output = {}
+        self._outputShape = {}
         
     def makeLayersOfThisPathwayAndReturnDimensionsOfOutputFM(self,
                                                     log,
                                                     rng,
-                                                    inputTrain,
-                                                    inputVal,
-                                                    inputTest,
-                                                    inputDimsTrain,
-                                                    inputDimsVal,
-                                                    inputDimsTest,
+                                                    inputPerMode, # {mode: tensor}. Layers are built only for these modes.
+                                                    inputDimsPerMode,
                                                     
                                                     numKernsPerLayer,
                                                     kernelDimsPerLayer,
@@ -163,21 +159,23 @@ class Pathway(object):
                                                     
                                                     indicesOfLowerRankLayersForPathway=[],
                                                     ranksOfLowerRankLayersForPathway = [],
-                                                    indicesOfLayersToConnectResidualsInOutputForPathway=[]
+                                                    indicesOfLayersToConnectResidualsInOutputForPathway=[],
+                                                    dataFormat="NDHWC" # Layout of the input tensors and of the built ones.
                                                     ) :
         log.print3("[Pathway_" + str(self.getStringType()) + "] is being built...")
         
         self._recField = self.calcRecFieldOfPathway(kernelDimsPerLayer)
+        self._dataFormat = dataFormat
         
-        self._setInputAttributes(inputTrain, inputVal, inputTest, inputDimsTrain, inputDimsVal, inputDimsTest)                
-        log.print3("\t[Pathway_"+str(self.getStringType())+"]: Input's Shape: (Train) " + str(self._inputShape["train"]) + \
-                ", (Val) " + str(self._inputShape["val"]) + ", (Test) " + str(self._inputShape["test"]))
+        self._setInputAttributes(inputPerMode, inputDimsPerMode)
+        log.print3("\t[Pathway_"+str(self.getStringType())+"]: Input's Shape: " + strOfShapesPerMode(self._inputShape))
         
-        inputToNextLayerTrain = self._input["train"]; inputToNextLayerVal = self._input["val"]; inputToNextLayerTest = self._input["test"]
-        inputToNextLayerShapeTrain = self._inputShape["train"]; inputToNextLayerShapeVal = self._inputShape["val"]; inputToNextLayerShapeTest = self._inputShape["test"]
+        inputToNextLayer = dict(self._input)
+        inputToNextLayerShape = dict(self._inputShape)
         numOfLayers = len(numKernsPerLayer)
         for layer_i in range(0, numOfLayers) :
-            thisLayerFilterShape = [numKernsPerLayer[layer_i],inputToNextLayerShapeTrain[1]] + kernelDimsPerLayer[layer_i]
+            numOfFmsOfInputToLayer = list(inputToNextLayerShape.values())[0][1] # Same for all modes.
+            thisLayerFilterShape = [numKernsPerLayer[layer_i], numOfFmsOfInputToLayer] + kernelDimsPerLayer[layer_i]
             
             thisLayerUseBn = useBnPerLayer[layer_i]
             thisLayerActivFunc = activFuncPerLayer[layer_i]
@@ -186,20 +184,15 @@ class Pathway(object):
             thisLayerPoolingParameters = poolingParamsStructureForThisPathwayType[layer_i]
             
             log.print3("\t[Conv.Layer_" + str(layer_i) + "], Filter Shape: " + str(thisLayerFilterShape))
-            log.print3("\t[Conv.Layer_" + str(layer_i) + "], Input's Shape: (Train) " + str(inputToNextLayerShapeTrain) + \
-                            ", (Val) " + str(inputToNextLayerShapeVal) + ", (Test) " + str(inputToNextLayerShapeTest))
+            log.print3("\t[Conv.Layer_" + str(layer_i) + "], Input's Shape: " + strOfShapesPerMode(inputToNextLayerShape))
             
             if layer_i in indicesOfLowerRankLayersForPathway :
                 layer = LowRankConvLayer(ranksOfLowerRankLayersForPathway[ indicesOfLowerRankLayersForPathway.index(layer_i) ])
             else : # normal conv layer
                 layer = ConvLayer()
             layer.makeLayer(rng,
-                            inputToLayerTrain=inputToNextLayerTrain,
-                            inputToLayerVal=inputToNextLayerVal,
-                            inputToLayerTest=inputToNextLayerTest,
-                            inputToLayerShapeTrain=inputToNextLayerShapeTrain,
-                            inputToLayerShapeVal=inputToNextLayerShapeVal,
-                            inputToLayerShapeTest=inputToNextLayerShapeTest,
+                            inputToLayerPerMode=inputToNextLayer,
+                            inputToLayerShapePerMode=inputToNextLayerShape,
                             
                             filterShape=thisLayerFilterShape,
                             poolingParameters=thisLayerPoolingParameters,
@@ -207,35 +200,27 @@ class Pathway(object):
                             useBnFlag = thisLayerUseBn,
                             movingAvForBnOverXBatches=movingAvForBnOverXBatches,
                             activationFunc=thisLayerActivFunc,
-                            dropoutRate=thisLayerDropoutRate
+                            dropoutRate=thisLayerDropoutRate,
+                            dataFormat=dataFormat
                             ) 
             self._layersInPathway.append(layer)
             
             if layer_i not in indicesOfLayersToConnectResidualsInOutputForPathway : #not a residual connecting here
-                inputToNextLayerTrain = layer.output["train"]
-                inputToNextLayerVal = layer.output["val"]
-                inputToNextLayerTest = layer.output["test"]
+                inputToNextLayer = dict(layer.output)
             else : #make residual connection
                 log.print3("\t[Pathway_"+str(self.getStringType())+"]: making Residual Connection between output of [Layer_"+str(layer_i)+"] to input of previous layer.")
                 assert layer_i > 0 # The very first layer (index 0), should never be provided for now. Cause I am connecting 2 layers back.
                 earlierLayer = self._layersInPathway[layer_i-1]
                 
-                inputToNextLayerTrain = makeResidualConnection(log, layer.output["train"], earlierLayer.input["train"])
-                inputToNextLayerVal = makeResidualConnection(log, layer.output["val"], earlierLayer.input["val"])
-                inputToNextLayerTest = makeResidualConnection(log, layer.output["test"], earlierLayer.input["test"])
-                layer.outputAfterResidualConnIfAnyAtOutp["train"] = inputToNextLayerTrain
-                layer.outputAfterResidualConnIfAnyAtOutp["val"] = inputToNextLayerVal
-                layer.outputAfterResidualConnIfAnyAtOutp["test"] = inputToNextLayerTest
+                for mode in layer.output :
+                    inputToNextLayer[mode] = makeResidualConnection(log, layer.output[mode], earlierLayer.input[mode], dataFormat)
+                    layer.outputAfterResidualConnIfAnyAtOutp[mode] = inputToNextLayer[mode]
             # Residual connections preserve the both the number of FMs and the dimensions of the FMs, the same as in the later, deeper layer.
-            inputToNextLayerShapeTrain = layer.outputShape["train"]
-            inputToNextLayerShapeVal = layer.outputShape["val"]
-            inputToNextLayerShapeTest = layer.outputShape["test"]
+            inputToNextLayerShape = dict(layer.outputShape)
         
-        self._setOutputAttributes(inputToNextLayerTrain, inputToNextLayerVal, inputToNextLayerTest,
-                                inputToNextLayerShapeTrain, inputToNextLayerShapeVal, inputToNextLayerShapeTest)
+        self._setOutputAttributes(inputToNextLayer, inputToNextLayerShape)
         
-        log.print3("\t[Pathway_"+str(self.getStringType())+"]: Output's Shape: (Train) " + str(self._outputShape["train"]) + \
-                 		", (Val) " + str(self._outputShape["val"]) + ", (Test) " + str(self._outputShape["test"]))
+        log.print3("\t[Pathway_"+str(self.getStringType())+"]: Output's Shape: " + strOfShapesPerMode(self._outputShape))
         
         log.print3("[Pathway_" + str(self.getStringType()) + "] done.")
         
@@ -256,13 +241,13 @@ class Pathway(object):
         return rczDimsOfInputToPathwayShouldBe
         
     # Setters
-    def _setInputAttributes(self, inputToLayerTrain, inputToLayerVal, inputToLayerTest, inputToLayerShapeTrain, inputToLayerShapeVal, inputToLayerShapeTest) :
-        self._input["train"] = inputToLayerTrain; self._input["val"] = inputToLayerVal; self._input["test"] = inputToLayerTest
-        self._inputShape["train"] = inputToLayerShapeTrain; self._inputShape["val"] = inputToLayerShapeVal; self._inputShape["test"] = inputToLayerShapeTest
+    def _setInputAttributes(self, inputPerMode, inputShapePerMode) :
+        self._input = dict(inputPerMode)
+        self._inputShape = dict(inputShapePerMode)
         
-    def _setOutputAttributes(self, outputTrain, outputVal, outputTest, outputShapeTrain, outputShapeVal, outputShapeTest) :
-        self._output["train"] = outputTrain; self._output["val"] = outputVal; self._output["test"] = outputTest
-        self._outputShape["train"] = outputShapeTrain; self._outputShape["val"] = outputShapeVal; self._outputShape["test"] = outputShapeTest
+    def _setOutputAttributes(self, outputPerMode, outputShapePerMode) :
+        self._output = dict(outputPerMode)
+        self._outputShape = dict(outputShapePerMode)
         
     # Getters
     def pName(self):
@@ -275,12 +260,14 @@ class Pathway(object):
         return self._layersInPathway[index]
     def subsFactor(self):
         return self._subsFactor
+    def getModes(self):
+        # The modes that the pathway is built for.
+        return [ mode for mode in ["train", "val", "test"] if mode in self._output ]
     def getOutput(self):
-        return [ self._output["train"], self._output["val"], self._output["test"] ]
+        # Dictionary: {mode: output}, for each mode built.
+        return self._output
     def getShapeOfOutput(self):
-        return [ self._outputShape["train"], self._outputShape["val"], self._outputShape["test"] ]
-    def getShapeOfInput(self):
-        return [ self._inputShape["train"], self._inputShape["val"], self._inputShape["test"] ]
+        return self._outputShape
     def getShapeOfInput(self, train_val_test_str):
         assert train_val_test_str in ["train", "val", "test"]
         return self._inputShape[train_val_test_str]
@@ -305,40 +292,31 @@ class SubsampledPathway(Pathway):
         self._pType = PathwayTypes.SUBS
         self._subsFactor = subsamplingFactor
         
-        self._outputNormRes = {"train": None, "val": None, "test": None}
-        self._outputNormResShape = {"train": None, "val": None, "test": None}
+        self._outputNormRes = {}
+        self._outputNormResShape = {}
         
-    def upsampleOutputToNormalRes(self, upsamplingScheme="repeat",
-                            shapeToMatchInRczTrain=None, shapeToMatchInRczVal=None, shapeToMatchInRczTest=None):
+    def upsampleOutputToNormalRes(self, upsamplingScheme="repeat", shapeToMatchInRczPerMode=None):
         #should be called only once to build. Then just call getters if needed to get upsampled layer again.
-        [outputTrain, outputVal, outputTest] = self.getOutput()
-        [outputShapeTrain, outputShapeVal, outputShapeTest] = self.getShapeOfOutput()
-        
-        outputNormResTrain = upsampleRcz5DimArrayAndOptionalCrop(outputTrain,
-                                                                self.subsFactor(),
-                                                                upsamplingScheme,
-                                                                shapeToMatchInRczTrain)
-        outputNormResVal = upsampleRcz5DimArrayAndOptionalCrop(	outputVal,
-                                                                self.subsFactor(),
-                                                                upsamplingScheme,
-                                                                shapeToMatchInRczVal)
-        outputNormResTest = upsampleRcz5DimArrayAndOptionalCrop(outputTest,
-                                                                self.subsFactor(),
-                                                                upsamplingScheme,
-                                                                shapeToMatchInRczTest)
-        
-        outputNormResShapeTrain = outputShapeTrain[:2] + shapeToMatchInRczTrain[2:]
-        outputNormResShapeVal = outputShapeVal[:2] + shapeToMatchInRczVal[2:]
-        outputNormResShapeTest = outputShapeTest[:2] + shapeToMatchInRczTest[2:]
-        
-        self._setOutputAttributesNormRes(outputNormResTrain, outputNormResVal, outputNormResTest,
-                                outputNormResShapeTrain, outputNormResShapeVal, outputNormResShapeTest)
-        
-    def _setOutputAttributesNormRes(self, outputNormResTrain, outputNormResVal, outputNormResTest,
-                                    outputNormResShapeTrain, outputNormResShapeVal, outputNormResShapeTest) :
+        # shapeToMatchInRczPerMode: {mode: shape}, for each mode that the pathway is built for.
+        outputPerMode = self.getOutput()
+        outputShapePerMode = self.getShapeOfOutput()
+        
+        outputNormResPerMode = {}
+        outputNormResShapePerMode = {}
+        for mode in outputPerMode :
+            outputNormResPerMode[mode] = upsampleRcz5DimArrayAndOptionalCrop(outputPerMode[mode],
+                                                                            self.subsFactor(),
+                                                                            upsamplingScheme,
+                                                                            shapeToMatchInRczPerMode[mode],
+                                                                            self._dataFormat)
+            outputNormResShapePerMode[mode] = outputShapePerMode[mode][:2] + shapeToMatchInRczPerMode[mode][2:]
+            
+        self._setOutputAttributesNormRes(outputNormResPerMode, outputNormResShapePerMode)
+        
+    def _setOutputAttributesNormRes(self, outputNormResPerMode, outputNormResShapePerMode) :
         #Essentially this is after the upsampling "layer"
-        self._outputNormRes["train"] = outputNormResTrain; self._outputNormRes["val"] = outputNormResVal; self._outputNormRes["test"] = outputNormResTest
-        self._outputNormResShape["train"] = outputNormResShapeTrain; self._outputNormResShape["val"] = outputNormResShapeVal; self._outputNormResShape["test"] = outputNormResShapeTest
+        self._outputNormRes = dict(outputNormResPerMode)
+        self._outputNormResShape = dict(outputNormResShapePerMode)
         
         
     # OVERRIDING parent's classes.
@@ -347,11 +325,11 @@ class SubsampledPathway(Pathway):
         
     def getOutputAtNormalRes(self):
         # upsampleOutputToNormalRes() must be called first once.
-        return [ self._outputNormRes["train"], self._outputNormRes["val"], self._outputNormRes["test"] ]
+        return self._outputNormRes
         
     def getShapeOfOutputAtNormalRes(self):
         # upsampleOutputToNormalRes() must be called first once.
-        return [ self._outputNormResShape["train"], self._outputNormResShape["val"], self._outputNormResShape["test"] ]
+        return self._outputNormResShape
         
              
 class FcPathway(Pathway):
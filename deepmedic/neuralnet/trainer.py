@@ -67,6 +67,7 @@ class Trainer(object):
         ########### Optimizer ###########
         # Optimizers
         self._optimizer = None # Trainer could be coordinating multiple optimizers, over multiple costs?
+        self._num_batches_accum_grads = 1 # Grads of that many batches are accumulated per update of the params.
         
         ######## LR schedule specific ######
         # These are separated from the above, "Trainer" section, for future further modularization...
@@ -112,13 +113,13 @@ class Trainer(object):
         if "xentr" in self._losses_and_weights and self._losses_and_weights["xentr"] is not None:
             log.print3("COST: Using cross entropy with weight: " +str(self._losses_and_weights["xentr"]))
             w_per_cl_vec = self._compute_w_per_class_vector_for_xentr( self._net.num_classes, y_gt )
-            cost += self._losses_and_weights["xentr"] * cfs.x_entr( self._net.finalTargetLayer.p_y_given_x_train, y_gt, w_per_cl_vec )
+            cost += self._losses_and_weights["xentr"] * cfs.x_entr( self._net.finalTargetLayer.p_y_given_x["train"], y_gt, w_per_cl_vec, dataFormat=self._net.getDataFormat() )
         if "iou" in self._losses_and_weights and self._losses_and_weights["iou"] is not None:
             log.print3("COST: Using iou loss with weight: " +str(self._losses_and_weights["iou"]))
-            cost += self._losses_and_weights["iou"] * cfs.iou( self._net.finalTargetLayer.p_y_given_x_train, y_gt )
+            cost += self._losses_and_weights["iou"] * cfs.iou( self._net.finalTargetLayer.p_y_given_x["train"], y_gt, dataFormat=self._net.getDataFormat() )
         if "dsc" in self._losses_and_weights and self._losses_and_weights["dsc"] is not None:
             log.print3("COST: Using dsc loss with weight: " +str(self._losses_and_weights["dsc"]))
-            cost += self._losses_and_weights["dsc"] * cfs.dsc( self._net.finalTargetLayer.p_y_given_x_train, y_gt )
+            cost += self._losses_and_weights["dsc"] * cfs.dsc( self._net.finalTargetLayer.p_y_given_x["train"], y_gt, dataFormat=self._net.getDataFormat() )
             
         cost_L1_reg = self._L1_reg_weight * self._net._get_L1_cost()
         cost_L2_reg = self._L2_reg_weight * self._net._get_L2_cost()        
@@ -140,11 +141,15 @@ class Trainer(object):
                             b2ParamForAdam,
                             epsilonForAdam,
                             rhoParamForRmsProp,
-                            epsilonForRmsProp
+                            epsilonForRmsProp,
+                            num_batches_accum_grads=1 # Params are updated once per that many batches, with the mean of their grads.
                             ) :
         log.print3("...Initializing state of the optimizer...")
         
         self._lr_sched_params = lr_sched_params
+        self._num_batches_accum_grads = num_batches_accum_grads
+        if self._num_batches_accum_grads > 1 :
+            log.print3("Trainer: Gradients will be accumulated over [" + str(self._num_batches_accum_grads) + "] batches per update of the parameters.")
         
         # Learning rate and momentum
         self._init_lr_tfv = tf.Variable(learning_rate_init, dtype="float32", trainable=False, name="init_lr") # This is important for the learning rate schedule to work.
@@ -161,13 +166,15 @@ class Trainer(object):
                                                           self._curr_lr,
                                                           self._curr_mom,
                                                           momentumTypeNONNormalized0orNormalized1,
-                                                          classicMomentum0OrNesterov1 )
+                                                          classicMomentum0OrNesterov1,
+                                                          num_batches_accum_grads )
         elif sgd0orAdam1orRmsProp2 == 1:
             self._optimizer = optimizers_dm.AdamOptimizer( params_to_opt,
                                                            self._curr_lr,
                                                            b1ParamForAdam,
                                                            b2ParamForAdam,
-                                                           epsilonForAdam )
+                                                           epsilonForAdam,
+                                                           num_batches_accum_grads )
         elif sgd0orAdam1orRmsProp2 == 2:
             self._optimizer = optimizers_dm.RmsPropOptimizer( params_to_opt,
                                                               self._curr_lr,
@@ -175,7 +182,8 @@ class Trainer(object):
                                                               momentumTypeNONNormalized0orNormalized1,
                                                               classicMomentum0OrNesterov1,
                                                               rhoParamForRmsProp,
-                                                              epsilonForRmsProp  )
+                                                              epsilonForRmsProp,
+                                                              num_batches_accum_grads )
         
 
         
@@ -189,6 +197,9 @@ class Trainer(object):
         updates = self._optimizer.get_update_ops_given_cost( self.get_total_cost() ) # A list of assign ops. For cnn AND optimizer's params.
         return updates
         
+    def get_num_batches_accum_grads(self):
+        return self._num_batches_accum_grads
+    
     def get_num_epochs_trained_tfv(self):
         return self._num_epochs_trained_tfv
     
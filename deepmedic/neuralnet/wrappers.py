@@ -14,9 +14,7 @@ class PathwayWrapperForSampling(object):
     def __init__(self, pathwayInstance) :
         self._pType = pathwayInstance.pType()
         self._subsFactor = pathwayInstance.subsFactor()
-        self._inputShape = {"train": pathwayInstance.getShapeOfInput("train"),
-                              "val": pathwayInstance.getShapeOfInput("val"),
-                              "test": pathwayInstance.getShapeOfInput("test")}
+        self._inputShape = {mode: pathwayInstance.getShapeOfInput(mode) for mode in pathwayInstance.getModes()}
     def pType(self):
         return self._pType
     def subsFactor(self):
@@ -31,9 +29,7 @@ class CnnWrapperForSampling(object):
         # Cnn
         self.num_classes = cnn3d.num_classes
         self.recFieldCnn = cnn3d.recFieldCnn
-        self.finalTargetLayer_outputShape = {"train": cnn3d.finalTargetLayer.outputShape["train"],
-                                             "val": cnn3d.finalTargetLayer.outputShape["val"],
-                                             "test": cnn3d.finalTargetLayer.outputShape["test"]}
+        self.finalTargetLayer_outputShape = {mode: cnn3d.finalTargetLayer.outputShape[mode] for mode in cnn3d.getModes()}
         # Pathways related
         self._numPathwaysThatRequireInput = cnn3d.getNumPathwaysThatRequireInput()
         self.numSubsPaths = cnn3d.numSubsPaths
@@ -0,0 +1,84 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+
+# Segmentation metrics of whole volumes, all computed from confusion matrices.
+# A confusion matrix is an array [n_lbls_gt, n_classes]. Entry [i, j] is the number of voxels with GT label i...
+# ... that were predicted as class j. n_lbls_gt >= n_classes, in case the GT has labels that the model does not predict.
+# Metrics of class 0 are for the whole foreground: All classes merged except the background (label 0).
+
+NAMES_OF_METRICS = ["dice1", "dice2", "dice3", "sens", "prec", "voldiff"]
+
+
+def calc_conf_matrices_in_and_out_of_roi(pred_seg, gt_lbl, roi_mask, n_classes):
+    # pred_seg, gt_lbl: Integer arrays of same shape. Predicted classes in [0, n_classes), labels >= 0.
+    # Returns: (cm_in_roi, cm_out_of_roi). The second is all zeros if no roi_mask is given.
+    # Index of each voxel's cell in the (flattened) matrix. All counts with a single bincount over the volume.
+    idxs_in_cm = gt_lbl.astype("int64") * n_classes + pred_seg
+    n_cells = max(n_classes, int(gt_lbl.max()) + 1) * n_classes
+    cm_whole = np.bincount(idxs_in_cm.ravel(), minlength=n_cells).reshape(-1, n_classes)
+    if roi_mask is None:
+        return cm_whole, np.zeros_like(cm_whole)
+    cm_in_roi = np.bincount(idxs_in_cm[roi_mask > 0], minlength=n_cells).reshape(-1, n_classes)
+    return cm_in_roi, cm_whole - cm_in_roi
+
+
+def get_tp_predpos_realpos(cm, c):
+    # Number of true positives, predicted positives and real (GT) positives of class c. c=0: whole foreground.
+    if c == 0:
+        return cm[1:, 1:].sum(), cm[:, 1:].sum(), cm[1:, :].sum()
+    return cm[c, c], cm[:, c].sum(), cm[c, :].sum()
+
+
+def calc_dice_from_conf_matrix(cm, c, na_pattern):
+    tp, pred_pos, real_pos = get_tp_predpos_realpos(cm, c)
+    return (2.0 * tp) / (pred_pos + real_pos) if real_pos != 0 else na_pattern
+
+
+def calc_sens_from_conf_matrix(cm, c, na_pattern):
+    tp, _, real_pos = get_tp_predpos_realpos(cm, c)
+    return tp * 1.0 / real_pos if real_pos != 0 else na_pattern
+
+
+def calc_prec_from_conf_matrix(cm, c, na_pattern):
+    tp, pred_pos, _ = get_tp_predpos_realpos(cm, c)
+    return tp * 1.0 / pred_pos if pred_pos != 0 else na_pattern
+
+
+def calc_voldiff_from_conf_matrix(cm, c, na_pattern):
+    # Relative volume difference (predicted - real) / real. Positive if over-segmenting.
+    _, pred_pos, real_pos = get_tp_predpos_realpos(cm, c)
+    return (pred_pos - real_pos) * 1.0 / real_pos if real_pos != 0 else na_pattern
+
+
+def calc_metrics_for_subject(metrics_per_subj_per_c, subj_i, pred_seg, gt_lbl, roi_mask, n_classes, na_pattern):
+    # pred_seg: Segmentation over the whole volume, before masking by the ROI.
+    # roi_mask: None, or the ROI. Predictions and labels outside it are considered background, where needed.
+    # Writes the metrics in metrics_per_subj_per_c[name_of_metric][subj_i][c], in place.
+    cm_in_roi, cm_out_of_roi = calc_conf_matrices_in_and_out_of_roi(pred_seg, gt_lbl, roi_mask, n_classes)
+    # Dice1 = Allpredicted / AllLesions
+    cm_1 = cm_in_roi + cm_out_of_roi
+    # Dice2 = PredictedWithinRoiMask / AllLesions. Predictions outside the ROI become background.
+    cm_2 = cm_in_roi.copy()
+    cm_2[:, 0] += cm_out_of_roi.sum(axis=1)
+    # Dice3 = PredictedWithinRoiMask / LesionsInsideRoiMask. Everything outside the ROI becomes background.
+    cm_3 = cm_in_roi.copy()
+    cm_3[0, 0] += cm_out_of_roi.sum()
+
+    for c in range(n_classes):
+        metrics_per_subj_per_c['dice1'][subj_i][c] = calc_dice_from_conf_matrix(cm_1, c, na_pattern)
+        metrics_per_subj_per_c['dice2'][subj_i][c] = calc_dice_from_conf_matrix(cm_2, c, na_pattern)
+        metrics_per_subj_per_c['dice3'][subj_i][c] = calc_dice_from_conf_matrix(cm_3, c, na_pattern)
+        # Rest are for the segmentation within the ROI (the saved one) VS GT, as Dice2.
+        metrics_per_subj_per_c['sens'][subj_i][c] = calc_sens_from_conf_matrix(cm_2, c, na_pattern)
+        metrics_per_subj_per_c['prec'][subj_i][c] = calc_prec_from_conf_matrix(cm_2, c, na_pattern)
+        metrics_per_subj_per_c['voldiff'][subj_i][c] = calc_voldiff_from_conf_matrix(cm_2, c, na_pattern)
+
+    return metrics_per_subj_per_c
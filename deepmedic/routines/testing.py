@@ -7,17 +7,21 @@
 
 from __future__ import absolute_import, print_function, division
 
+import os
 import time
 import numpy as np
 import math
+from multiprocessing.pool import ThreadPool
 
 from deepmedic.logging.accuracyMonitor import AccuracyMonitorForEpSegm
-from deepmedic.dataManagement.sampling import load_imgs_of_subject, preproc_imgs_of_subj
+from deepmedic.dataManagement.sampling import load_and_preproc_imgs_of_subj
 from deepmedic.dataManagement.sampling import get_slice_coords_of_all_img_tiles
-from deepmedic.dataManagement.sampling import extractSegmentsGivenSliceCoords
+from deepmedic.dataManagement.sampling import extract_tiles_to_bufs
 from deepmedic.dataManagement.io import savePredImgToNiiWithOriginalHdr, saveFmImgToNiiWithOriginalHdr, \
-    save4DImgWithAllFmsToNiiWithOriginalHdr
-from deepmedic.dataManagement.preprocessing import unpad_3d_img
+    save4DImgWithAllFmsToNiiWithOriginalHdr, NiiWriter
+from deepmedic.dataManagement.preprocessing import unpad_3d_img, calc_border_int_of_3d_img
+from deepmedic.dataManagement.augmentSample import get_variants_for_tta, apply_variant_for_tta, invert_variant_for_tta
+from deepmedic.routines.evaluation import NAMES_OF_METRICS, calc_metrics_for_subject
 
 from deepmedic.neuralnet.pathwayTypes import PathwayTypes as pt
 from deepmedic.logging.utils import strListFl4fNA, getMeanPerColOf2dListExclNA
@@ -61,139 +65,81 @@ def stitch_predicted_to_prob_maps(prob_maps_per_class, idx_next_tile_in_pred_vol
     return idx_next_tile_in_pred_vols, prob_maps_per_class
 
 
-def calculate_num_voxels_sub(num_central_voxels, pathway):
-    num_voxels_sub = np.zeros(3)
+def calc_idxs_of_central_voxels_of_fms(n_voxels_predicted, pathway, dims_fms_layer):
+    # Which voxels of the fms of a layer correspond to the voxels predicted by the cnn for a tile, per rcz axis.
+    # n_voxels_predicted: [r,c,z] dims of the output of the cnn for a tile.
+    # dims_fms_layer: [r,c,z] dims of the output of the layer for a tile.
+    # Returns: List with 3 (rcz) entries. Per axis, a slice (crop the central voxels) if the pathway is at normal...
+    #          ... resolution. For a subsampled pathway, an int np array, that also upsamples the central voxels ...
+    #          ... back to the normal resolution by repeating each subsFactor times.
+    idxs_per_axis = []
     for i in range(3):
-        num_voxels_sub[i] = num_central_voxels[i] - 1 if pathway.pType() != pt.SUBS else \
-            int(math.ceil((num_central_voxels[i] * 1.0) / pathway.subsFactor()[i]) - 1)
-
-    return [int(a) for a in num_voxels_sub]
-
-
-def calculate_num_central_voxels_dir(num_central_voxels, pathway):
-    num_voxels_dir = np.zeros(3)
-    # the math.ceil / subsamplingFactor is a trick to make it work for even subsamplingFactor too.
-    # Eg 9/2=4.5 => Get 5. Combined with the trick at repeat,
-    # I get my correct number of central voxels hopefully.
-    for i in range(3):
-        num_voxels_dir[i] = int(math.ceil((num_central_voxels[i] * 1.0) / pathway.subsFactor()[i])) \
-            if pathway.pType() == pt.SUBS else int(num_central_voxels[i])
-
-    return [int(a) for a in num_voxels_dir]
+        # the math.ceil / subsamplingFactor is a trick to make it work for even subsamplingFactor too.
+        # Eg 9/2=4.5 => Get 5. Combined with the crop after the repeat, I get the correct number of central voxels.
+        n_central_voxels = int(math.ceil((n_voxels_predicted[i] * 1.0) / pathway.subsFactor()[i])) \
+            if pathway.pType() == pt.SUBS else int(n_voxels_predicted[i])
+        # Width of the patch left after the convolutions.
+        patch_dim = dims_fms_layer[i] - (n_central_voxels - 1)
+        # the -1 so that if width is even, I'll get the left voxel from the centre as 1st,
+        # which I THINK is how I am getting the patches from the original image.
+        top_left_central_voxel = int((patch_dim - 1) // 2)
+        if pathway.pType() == pt.SUBS:
+            idxs_per_axis.append(top_left_central_voxel + np.arange(n_voxels_predicted[i]) // pathway.subsFactor()[i])
+        else:
+            idxs_per_axis.append(slice(top_left_central_voxel, top_left_central_voxel + n_central_voxels))
+    return idxs_per_axis
 
 
-def stitch_predicted_to_fms(array_fms_to_save, idx_next_tile_in_fm_vols,
-                            fms_per_layer_and_path_for_batch, batch_size, slice_coords, half_rec_field, stride,
-                            n_voxels_predicted, cnn_pathways, idxs_fms_to_save):
-    # array_fms_to_save: The whole feature maps that are going to be the final output of the system.
-    # fms_per_layer_and_path_for_batch: FM activations in CNN for tiles/segments in a batch. Must be stitched.
-    # idx_curr is the index in the multidimensional array that holds all the to-be-visualised-fms.
-    # ... It is the one that corresponds to the next to-be-visualised layer_idx.
+def make_plan_to_stitch_fms(cnn_pathways, idxs_fms_to_save, n_voxels_predicted):
+    # Computed once, from the shapes of the layers in the testing graph, and used for all batches and subjects.
+    # idxs_fms_to_save: As given to calc_num_fms_to_save(), which should have been called first to fix them.
+    # Returns: List with an entry per layer whose fms are saved (same order as fetched by the cnn for testing):
+    #          [idx_low, idx_high]: Where to put its fms in array_fms_to_save,
+    #          idxs_per_axis: See calc_idxs_of_central_voxels_of_fms()
+    plan = []
     idx_curr = 0
-    # layer_idx is the index over all the layers in the returned list.
-    # ... I will work only with the ones specified to visualise.
-    layer_idx = 0
-
     for pathway in cnn_pathways:
         for layer_i in range(len(pathway.getLayers())):
             if idxs_fms_to_save[pathway.pType()] == [] or idxs_fms_to_save[pathway.pType()][layer_i] == []:
                 continue
             fms_to_extract_idxs = idxs_fms_to_save[pathway.pType()][layer_i]
-            fms_layer = fms_per_layer_and_path_for_batch[layer_idx]
-            # We specify a range of fms to visualise from a layer.
-            # curr_idx : fms_to_fill_high_idx defines were to put them in the multidimensional-image-array.
             fms_to_fill_high_idx = idx_curr + fms_to_extract_idxs[1] - fms_to_extract_idxs[0]
+            dims_fms_layer = pathway.getLayer(layer_i).outputShape["test"][2:]
+            plan.append(([idx_curr, fms_to_fill_high_idx],
+                         calc_idxs_of_central_voxels_of_fms(n_voxels_predicted, pathway, dims_fms_layer)))
+            idx_curr = fms_to_fill_high_idx
+    return plan
 
-            fm_to_reconstruct = array_fms_to_save[idx_curr:fms_to_fill_high_idx]
-
-            # ========================================================================================
-            # ====the following calculations could be move OUTSIDE THE FOR LOOPS, by using the kernel-size
-            # parameter (from the cnn instance) instead of the shape of the returned value.
-            # ====fmsReturnedForATestBatchForCertainLayer.shape[2] - (n_voxels_predicted[0]-1)
-            # is essentially the width of the patch left after the convolutions.
-            # ====These calculations are pathway and layer-specific. So they could be done once, prior to
-            # image processing, and results cached in a list to be accessed during the loop.
-
-            (num_voxels_sub_r,
-             num_voxels_sub_c,
-             num_voxels_sub_z) = calculate_num_voxels_sub(n_voxels_predicted, pathway)
-
-            r_patch_dim = fms_layer.shape[2] - num_voxels_sub_r
-            c_patch_dim = fms_layer.shape[3] - num_voxels_sub_c
-            z_patch_dim = fms_layer.shape[4] - num_voxels_sub_z
-
-            # the -1 so that if width is even, I'll get the left voxel from the centre as 1st,
-            # which I THINK is how I am getting the patches from the original image.
-            r_top_left_central_voxel = int((r_patch_dim - 1) // 2)
-            c_top_left_central_voxel = int((c_patch_dim - 1) // 2)
-            z_top_left_central_voxel = int((z_patch_dim - 1) // 2)
-
-            (num_central_voxels_r,
-             num_central_voxels_c,
-             num_central_voxels_z) = calculate_num_central_voxels_dir(n_voxels_predicted, pathway)
-
-            # ============================================================================================
-
-            # Grab the central voxels of the predicted fms from the cnn in this batch.
-            central_voxels_all_fms = fms_layer[:,  # batchsize
-                                               :,  # number of featuremaps
-                                               r_top_left_central_voxel:r_top_left_central_voxel + num_central_voxels_r,
-                                               c_top_left_central_voxel:c_top_left_central_voxel + num_central_voxels_c,
-                                               z_top_left_central_voxel:z_top_left_central_voxel + num_central_voxels_z]
-
-            # If the pathway that is visualised currently is the subsampled,
-            # I need to upsample the central voxels to the normal resolution,
-            # before reconstructing the image-fm.
-
-            # subsampled layer. Remember that this returns smaller dimension outputs,
-            # because it works in the subsampled space.
-            # I need to repeat it, to bring it to the dimensions of the normal-voxel-space.
-            if pathway.pType() == pt.SUBS:
-                expanded_output_r = np.repeat(central_voxels_all_fms, pathway.subsFactor()[0], axis=2)
-                expanded_output_rc = np.repeat(expanded_output_r, pathway.subsFactor()[1], axis=3)
-                expanded_output_rcz = np.repeat(expanded_output_rc, pathway.subsFactor()[2], axis=4)
-                # The below is a trick to get correct number of voxels even when subsampling factor is
-                # even or not exact divisor of the number of central voxels.
-                # ...This trick is coupled with the ceil() when getting the
-                # numberOfCentralVoxelsToGetInDirectionR above.
-                central_voxels_all_fms_batch = expanded_output_rcz[:,
-                                                                   :,
-                                                                   0:n_voxels_predicted[0],
-                                                                   0:n_voxels_predicted[1],
-                                                                   0:n_voxels_predicted[2]
-                                                                   ]
-            else:
-                central_voxels_all_fms_batch = central_voxels_all_fms
-
-            # ----For every image part within this batch, reconstruct the corresponding part of the feature
-            # maps of the layer we are currently visualising in this loop.
-            for tile_batch_idx in range(batch_size):
-                # Now put the label-cube in the new-label-segmentation-image, at the correct position.
-                # The very first label goes not in index 0,0,0 but half-patch further away! At the position
-                # of the central voxel of the top-left patch!
-                slice_coords_tile = slice_coords[idx_next_tile_in_fm_vols + tile_batch_idx]
-                coords_top_left_voxel = [slice_coords_tile[0][0],
-                                         slice_coords_tile[1][0],
-                                         slice_coords_tile[2][0]]
-
-                # I put the central-predicted-voxels of all FMs to the corresponding,
-                # newly created images all at once.
-                fm_to_reconstruct[:,  # last dimension is the number-of-Fms, I create an image for each.
-
-                                  coords_top_left_voxel[0] + half_rec_field[0]:
-                                  coords_top_left_voxel[0] + half_rec_field[0] + stride[0],
-
-                                  coords_top_left_voxel[1] + half_rec_field[1]:
-                                  coords_top_left_voxel[1] + half_rec_field[1] + stride[1],
-
-                                  coords_top_left_voxel[2] + half_rec_field[2]:
-                                  coords_top_left_voxel[2] + half_rec_field[2] + stride[2]
-
-                                  ] = central_voxels_all_fms_batch[tile_batch_idx]
 
-            idx_curr = fms_to_fill_high_idx
+def get_central_voxels_of_fms(fms_layer, idxs_per_axis):
+    # fms_layer: [batchsize, fms, r, c, z]. Returns: [batchsize, fms, central voxels at normal resolution r, c, z]
+    if isinstance(idxs_per_axis[0], slice): # Crop only. A view, no copy.
+        return fms_layer[:, :, idxs_per_axis[0], idxs_per_axis[1], idxs_per_axis[2]]
+    return fms_layer.take(idxs_per_axis[0], axis=2).take(idxs_per_axis[1], axis=3).take(idxs_per_axis[2], axis=4)
 
-            layer_idx += 1
+
+def stitch_predicted_to_fms(array_fms_to_save, idx_next_tile_in_fm_vols,
+                            fms_per_layer_and_path_for_batch, batch_size, slice_coords, half_rec_field, stride,
+                            plan_stitch_fms):
+    # array_fms_to_save: The whole feature maps that are going to be the final output of the system.
+    # fms_per_layer_and_path_for_batch: FM activations in CNN for tiles/segments in a batch. Must be stitched.
+    # plan_stitch_fms: From make_plan_to_stitch_fms(). An entry per layer in fms_per_layer_and_path_for_batch.
+
+    # Now put the fms in the new images, at the correct position of each tile.
+    # The very first voxel goes not in index 0,0,0 but half-patch further away! At the position
+    # of the central voxel of the top-left patch!
+    slice_coords_tiles = np.asarray(slice_coords[idx_next_tile_in_fm_vols: idx_next_tile_in_fm_vols + batch_size])
+    top_left_per_tile = slice_coords_tiles[:, :, 0] + np.asarray(half_rec_field)
+
+    for layer_idx in range(len(plan_stitch_fms)):
+        ([fm_idx_low, fm_idx_high], idxs_per_axis) = plan_stitch_fms[layer_idx]
+        central_voxels_all_fms_batch = get_central_voxels_of_fms(fms_per_layer_and_path_for_batch[layer_idx],
+                                                                 idxs_per_axis)
+        fm_to_reconstruct = array_fms_to_save[fm_idx_low:fm_idx_high]
+        for tile_batch_idx in range(batch_size):
+            (r, c, z) = top_left_per_tile[tile_batch_idx]
+            fm_to_reconstruct[:, r: r + stride[0], c: c + stride[1], z: z + stride[2]] = \
+                central_voxels_all_fms_batch[tile_batch_idx]
 
     # all the image parts before this were reconstructed for all layers and feature maps.
     # Next batch-iteration should start from this
@@ -206,7 +152,8 @@ def print_progress_step(log, n_batches, batch_i, batch_size, n_tiles_for_subj):
     progress_step = max(1, n_batches // 5)
 
     if batch_i == 0 or ((batch_i + 1) % progress_step) == 0 or (batch_i + 1) == n_batches:
-        log.print3("Processed " + str((batch_i + 1) * batch_size) + "/" + str(n_tiles_for_subj) + " segments.")
+        n_tiles_processed = min((batch_i + 1) * batch_size, n_tiles_for_subj) # Last batch may be smaller.
+        log.print3("Processed " + str(n_tiles_processed) + "/" + str(n_tiles_for_subj) + " segments.")
 
 
 def prepare_feeds_dict(feeds, channs_of_tiles_per_path):
@@ -219,10 +166,52 @@ def prepare_feeds_dict(feeds, channs_of_tiles_per_path):
     return feeds_dict
     
 
+def merge_preds_of_variants_for_tta(prob_maps_batch, variants_tta, n_tiles):
+    # prob_maps_batch: [n_variants * n_tiles, classes, r, c, z]. Predictions for the variants of the tiles,...
+    #                  ... the n_tiles of the 1st variant first, then of the 2nd, etc. See get_variants_for_tta()
+    # Returns: [n_tiles, classes, r, c, z]. Average of the predictions, after inverting the transform of each variant.
+    prob_maps_merged = np.array(prob_maps_batch[:n_tiles], dtype="float32") # 1st variant is the identity. Copy.
+    for variant_i in range(1, len(variants_tta)):
+        prob_maps_merged += invert_variant_for_tta(prob_maps_batch[variant_i * n_tiles: (variant_i + 1) * n_tiles],
+                                                   variants_tta[variant_i])
+    prob_maps_merged /= len(variants_tta)
+    return prob_maps_merged
+
+
+def alloc_vol_of_outputs(shape, folder_mmap, name):
+    # Volumes where the predictions/fms of the tiles are stitched. Zeros.
+    # folder_mmap: None, to keep them in RAM. Otherwise they are memory-mapped to a .npy file in this folder, so ...
+    #              ... that the OS can write them out to disk while stitching, and RAM is not bound by their size.
+    if folder_mmap is None:
+        return np.zeros(shape, dtype="float32")
+    if not os.path.exists(folder_mmap):
+        os.makedirs(folder_mmap)
+    filepath = os.path.join(folder_mmap, "pid" + str(os.getpid()) + "_" + name + ".npy")
+    return np.lib.format.open_memmap(filepath, mode="w+", dtype="float32", shape=tuple(shape))
+
+
+def del_vol_of_outputs(vol):
+    # Removes the file of a memory-mapped volume, from alloc_vol_of_outputs(). Mapping stays valid until unreferenced.
+    if isinstance(vol, np.memmap) and vol.filename is not None and os.path.exists(vol.filename):
+        os.remove(vol.filename)
+
+
 def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
                                    channels, roi_mask, batchsize,
-                                   save_fms_flag, idxs_fms_to_save ):
+                                   save_fms_flag, n_fms_to_save, plan_stitch_fms,
+                                   folder_mmap, name_subj,
+                                   variants_tta,
+                                   cnns_ensemble):
     # One of the main routines. Segment whole volume tile-by-tile.
+    # n_fms_to_save, plan_stitch_fms: Number of fms to save and how to stitch them. See make_plan_to_stitch_fms()
+    # folder_mmap: None, or folder where to memory-map the output volumes. See alloc_vol_of_outputs()
+    # name_subj: To name the files of memory-mapped volumes.
+    # variants_tta: Test-time augmentation. List of variants, from get_variants_for_tta(). Only identity: No TTA.
+    #               The variants of each tile are predicted in the same batch and averaged before stitching. ...
+    #               ... Feature maps are stitched only for the 1st variant (identity).
+    # cnns_ensemble: List of more Cnn3d (same architecture, other parameters). Empty if no ensemble. Each batch is...
+    #                ... predicted by cnn3d and all these, in the same run, and the predictions are averaged.
+    #                ... Feature maps are stitched only from cnn3d.
     
     # Receptive field is list [size-x, size-y, size-z]. -1 to exclude the central voxel.
     half_rec_field = [(cnn3d.recFieldCnn[i] - 1) // 2 for i in range(len(cnn3d.recFieldCnn))]
@@ -230,25 +219,20 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
     # I stride exactly the number of voxels that are predicted per forward pass.
     n_voxels_predicted = cnn3d.finalTargetLayer.outputShape["test"][2:]
     stride_of_tiling = n_voxels_predicted # [str-x, str-y, str-z]
-    # Find the total number of feature maps that will be created:
-    # NOTE: save_fms_flag should contain an entry per pathwayType, even if just [].
-    # If not [], the list should contain one entry per layer of the pathway, even if just [].
-    # The layer entries, if not [], they should have to integers, lower and upper FM to visualise.
-    n_fms_to_save = calc_num_fms_to_save(cnn3d.pathways, idxs_fms_to_save) if save_fms_flag else 0
     
     # Arrays that will be returned.
     inp_chan_dims = list(channels.shape[1:]) # Dimensions of (padded) input channels.
     # The main output. Predicted probability-maps for the whole volume, one per class.
     # Will be constructed by stitching together the predictions from each tile.
-    prob_maps_vols = np.zeros([cnn3d.num_classes]+inp_chan_dims, dtype="float32")
+    prob_maps_vols = alloc_vol_of_outputs([cnn3d.num_classes] + inp_chan_dims, folder_mmap, name_subj + "_prob_maps")
     # create the big array that will hold all the fms (for feature extraction).
-    array_fms_to_save = np.zeros([n_fms_to_save] + inp_chan_dims, dtype="float32") if save_fms_flag else None
+    array_fms_to_save = alloc_vol_of_outputs([n_fms_to_save] + inp_chan_dims, folder_mmap, name_subj + "_fms") \
+        if save_fms_flag else None
 
     # Tile the image and get all slices of the tiles that it fully breaks down to.
     slice_coords_all_tiles = get_slice_coords_of_all_img_tiles(log,
                                                                cnn3d.pathways[0].getShapeOfInput("test")[2:],
                                                                stride_of_tiling,
-                                                               batchsize,
                                                                inp_chan_dims,
                                                                roi_mask)
 
@@ -256,33 +240,63 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
     log.print3("Ready to make predictions for all image segments (parts).")
     log.print3("Total number of Segments to process:" + str(n_tiles_for_subj))
     
+    # With TTA, all variants of a tile go in the same batch. So less tiles per batch, for batches of batchsize.
+    n_variants_tta = len(variants_tta)
+    n_tiles_per_batch = max(1, batchsize // n_variants_tta)
+    # Tiles of each batch are extracted in these buffers, one per pathway that takes input. Reused for all batches.
+    # The feed copies them to the graph, so they can be overwritten by the next batch.
+    bufs_of_tiles = [np.empty([n_tiles_per_batch] + list(pathway.getShapeOfInput("test")[1:]), dtype="float32")
+                     for pathway in cnn3d.pathways if pathway.pType() != pt.FC]
+    # With TTA, the variants of the tiles are made in these, from the bufs_of_tiles.
+    bufs_of_tiles_tta = [np.empty([n_tiles_per_batch * n_variants_tta] + list(buf.shape[1:]), dtype="float32")
+                         for buf in bufs_of_tiles] if n_variants_tta > 1 else None
+    # Out of image, tiles are filled with the intensity at the corners of each channel. Same for all tiles.
+    border_int_per_channel = [calc_border_int_of_3d_img(channels[channel_i]) for channel_i in range(len(channels))]
+    
     idx_next_tile_in_pred_vols = 0
     idx_next_tile_in_fm_vols = 0
-    n_batches = n_tiles_for_subj // batchsize
+    # The last batch has the remaining tiles, if less than batchsize. The graph accepts any batch size.
+    n_batches = (n_tiles_for_subj + n_tiles_per_batch - 1) // n_tiles_per_batch
     t_fwd_pass_subj = 0 # time it took for forward pass over all tiles of subject.
     for batch_i in range(n_batches):
 
-        print_progress_step(log, n_batches, batch_i, batchsize, n_tiles_for_subj)
-
-        # Extract data for the segments of this batch.
-        # ( I could modularize extractDataOfASegmentFromImagesUsingSampledSliceCoords()
-        # of training and use it here as well. )
-        slice_coords_of_tiles_batch = slice_coords_all_tiles[batch_i * batchsize: (batch_i + 1) * batchsize]
-        channs_of_tiles_per_path = extractSegmentsGivenSliceCoords(cnn3d,
-                                                                   slice_coords_of_tiles_batch,
-                                                                   channels,
-                                                                   cnn3d.recFieldCnn)
+        print_progress_step(log, n_batches, batch_i, n_tiles_per_batch, n_tiles_for_subj)
+
+        # Extract data for the segments of this batch, in the buffers.
+        slice_coords_of_tiles_batch = slice_coords_all_tiles[batch_i * n_tiles_per_batch:
+                                                             (batch_i + 1) * n_tiles_per_batch]
+        n_tiles_batch = len(slice_coords_of_tiles_batch)
+        extract_tiles_to_bufs(cnn3d,
+                              slice_coords_of_tiles_batch,
+                              channels,
+                              border_int_per_channel,
+                              bufs_of_tiles)
+        channs_of_tiles_per_path = [buf[:n_tiles_batch] for buf in bufs_of_tiles]
+        if n_variants_tta > 1:
+            for path_i in range(len(bufs_of_tiles)):
+                for variant_i in range(n_variants_tta):
+                    bufs_of_tiles_tta[path_i][variant_i * n_tiles_batch: (variant_i + 1) * n_tiles_batch] = \
+                        apply_variant_for_tta(channs_of_tiles_per_path[path_i], variants_tta[variant_i])
+            channs_of_tiles_per_path = [buf[:n_tiles_batch * n_variants_tta] for buf in bufs_of_tiles_tta]
 
         # ============================== Perform forward pass ====================================
         t_fwd_start = time.time()
         ops_to_fetch = cnn3d.get_main_ops('test')
-        list_of_ops = [ops_to_fetch['pred_probs']] + ops_to_fetch['list_of_fms_per_layer']
+        list_of_ops = [ops_to_fetch['pred_probs']] + \
+                      [cnn_member.get_main_ops('test')['pred_probs'] for cnn_member in cnns_ensemble] + \
+                      ops_to_fetch['list_of_fms_per_layer']
         feeds_dict = prepare_feeds_dict(cnn3d.get_main_feeds('test'), channs_of_tiles_per_path)
+        for cnn_member in cnns_ensemble: # Same input for all members.
+            feeds_dict.update(prepare_feeds_dict(cnn_member.get_main_feeds('test'), channs_of_tiles_per_path))
         # Forward pass
         out_val_of_ops = sessionTf.run(fetches=list_of_ops, feed_dict=feeds_dict)
-        prob_maps_batch = out_val_of_ops[0]
-        fms_per_layer_and_path_for_batch = out_val_of_ops[1:] # [] if no FMs specified.
+        n_members = 1 + len(cnns_ensemble)
+        prob_maps_batch = out_val_of_ops[0] if n_members == 1 else np.mean(out_val_of_ops[:n_members], axis=0)
+        fms_per_layer_and_path_for_batch = out_val_of_ops[n_members:] # [] if no FMs specified.
         t_fwd_pass_subj += time.time() - t_fwd_start
+        if n_variants_tta > 1:
+            prob_maps_batch = merge_preds_of_variants_for_tta(prob_maps_batch, variants_tta, n_tiles_batch)
+            fms_per_layer_and_path_for_batch = [fms[:n_tiles_batch] for fms in fms_per_layer_and_path_for_batch]
         
         # ================ Construct probability maps (volumes) by Stitching  ====================
         # Stitch predictions for tiles of this batch, to create the probability maps for whole volume.
@@ -291,7 +305,7 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
          prob_maps_vols) = stitch_predicted_to_prob_maps(prob_maps_vols,
                                                          idx_next_tile_in_pred_vols,
                                                          prob_maps_batch,
-                                                         batchsize,
+                                                         n_tiles_batch,
                                                          slice_coords_all_tiles,
                                                          half_rec_field,
                                                          stride_of_tiling)
@@ -302,13 +316,11 @@ def predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
              array_fms_to_save) = stitch_predicted_to_fms(array_fms_to_save,
                                                           idx_next_tile_in_fm_vols,
                                                           fms_per_layer_and_path_for_batch,
-                                                          batchsize,
+                                                          n_tiles_batch,
                                                           slice_coords_all_tiles,
                                                           half_rec_field,
                                                           stride_of_tiling,
-                                                          n_voxels_predicted,
-                                                          cnn3d.pathways,
-                                                          idxs_fms_to_save)
+                                                          plan_stitch_fms)
              
         # Done with batch
     
@@ -337,7 +349,7 @@ def unpad_list_of_imgs(list_imgs, unpad_input, pad_left_right_per_axis):
     return list_unpadded_imgs
 
 
-def save_pred_seg(pred_seg, save_pred_seg_bool, suffix_seg, seg_names, filepaths, subj_i, log):
+def save_pred_seg(pred_seg, save_pred_seg_bool, suffix_seg, seg_names, filepaths, subj_i, log, writer=None):
     # filepaths: list of all filepaths to each channel image of each subject. To get header.
     # Save the image. Pass the filename paths of the normal image to duplicate the header info.
     if save_pred_seg_bool:
@@ -347,10 +359,11 @@ def save_pred_seg(pred_seg, save_pred_seg_bool, suffix_seg, seg_names, filepaths
                                         subj_i,
                                         suffix_seg,
                                         np.dtype(np.int16),
-                                        log)
+                                        log,
+                                        writer)
 
 
-def save_prob_maps(prob_maps, save_prob_maps_bool, suffix_prob_map, prob_names, filepaths, subj_i, log):
+def save_prob_maps(prob_maps, save_prob_maps_bool, suffix_prob_map, prob_names, filepaths, subj_i, log, writer=None):
     # filepaths: list of all filepaths to each channel img of each subject. To get header.
     # Save the image. Pass the filename paths of the normal image to duplicate the header info.
     for class_i in range(len(prob_maps)):
@@ -363,10 +376,12 @@ def save_prob_maps(prob_maps, save_prob_maps_bool, suffix_prob_map, prob_names,
                                             subj_i,
                                             suffix,
                                             np.dtype(np.float32),
-                                            log)
+                                            log,
+                                            writer)
 
 
-def save_fms_individual(save_flag, multidim_fm_array, cnn_pathways, fm_idxs, fms_names, filepaths, subj_i, log):
+def save_fms_individual(save_flag, multidim_fm_array, cnn_pathways, fm_idxs, fms_names, filepaths, subj_i, log,
+                        writer=None):
     if not save_flag:
         return
     
@@ -388,54 +403,11 @@ def save_fms_individual(save_flag, multidim_fm_array, cnn_pathways, fm_idxs, fms
                                                       pathway_i,
                                                       layer_i,
                                                       fmActualNumber,
-                                                      log)
+                                                      log,
+                                                      writer)
                         idx_curr += 1
 
 
-def calculate_dice(pred_seg, gt_lbl):
-    union_correct = pred_seg * gt_lbl
-    tp_num = np.sum(union_correct)
-    gt_pos_num = np.sum(gt_lbl)
-    dice = (2.0 * tp_num) / (np.sum(pred_seg) + gt_pos_num) if gt_pos_num != 0 else -1
-    return dice
-
-
-def calc_metrics_for_subject(metrics_per_subj_per_c, subj_i, pred_seg, pred_seg_in_roi,
-                             gt_lbl, gt_lbl_in_roi, n_classes, na_pattern):
-    # Calculate DSC per class.
-    for c in range(n_classes):
-        if c == 0:  # do the eval for WHOLE FOREGROUND segmentation (all classes merged except background)
-            # Merge every class except the background (assumed to be label == 0 )
-            pred_seg_bin_c = pred_seg > 0 # Now it's binary
-            pred_seg_bin_c_in_roi = pred_seg_in_roi > 0
-            gt_lbl_bin_c = gt_lbl > 0
-            gt_lbl_bin_c_in_roi = gt_lbl_in_roi > 0
-        else:
-            pred_seg_bin_c = np.rint(pred_seg) == c # randint for valid comparison, in case array is float)
-            pred_seg_bin_c_in_roi = np.rint(pred_seg_in_roi) == c
-            gt_lbl_bin_c = np.rint(gt_lbl) == c
-            gt_lbl_bin_c_in_roi = np.rint(gt_lbl_in_roi) == c
-            
-        # Calculate the 3 Dices.
-        # Dice1 = Allpredicted/allLesions,
-        # Dice2 = PredictedWithinRoiMask / AllLesions ,
-        # Dice3 = PredictedWithinRoiMask / LesionsInsideRoiMask.
-        
-        # Dice1 = Allpredicted/allLesions
-        dice_1 = calculate_dice(pred_seg_bin_c, gt_lbl_bin_c)
-        metrics_per_subj_per_c['dice1'][subj_i][c] = dice_1 if dice_1 != -1 else na_pattern
-
-        # Dice2 = PredictedWithinRoiMask / AllLesions
-        dice_2 = calculate_dice(pred_seg_bin_c_in_roi, gt_lbl_bin_c)
-        metrics_per_subj_per_c['dice2'][subj_i][c] = dice_2 if dice_2 != -1 else na_pattern
-        
-        # Dice3 = PredictedWithinRoiMask / LesionsInsideRoiMask
-        dice_3 = calculate_dice(pred_seg_bin_c_in_roi, gt_lbl_bin_c_in_roi)
-        metrics_per_subj_per_c['dice3'][subj_i][c] = dice_3 if dice_3 != -1 else na_pattern
-        
-    return metrics_per_subj_per_c
-
-
 def report_metrics_for_subject(log, metrics_per_subj_per_c, subj_i, na_pattern, val_test_print):
     log.print3("+++++++++++ Reporting Segmentation Metrics for Subject #" + str(subj_i) + " +++++++++++")
     log.print3("ACCURACY: (" + str(val_test_print) + ")" +
@@ -443,6 +415,11 @@ def report_metrics_for_subject(log, metrics_per_subj_per_c, subj_i, na_pattern,
            " DICE1=" + strListFl4fNA(metrics_per_subj_per_c['dice1'][subj_i], na_pattern) +
            " DICE2=" + strListFl4fNA(metrics_per_subj_per_c['dice2'][subj_i], na_pattern) +
            " DICE3=" + strListFl4fNA(metrics_per_subj_per_c['dice3'][subj_i], na_pattern))
+    log.print3("ACCURACY: (" + str(val_test_print) + ")" +
+           " The Per-Class metrics for subject with index #" + str(subj_i) + " equal:" +
+           " SENS=" + strListFl4fNA(metrics_per_subj_per_c['sens'][subj_i], na_pattern) +
+           " PREC=" + strListFl4fNA(metrics_per_subj_per_c['prec'][subj_i], na_pattern) +
+           " VOLDIFF=" + strListFl4fNA(metrics_per_subj_per_c['voldiff'][subj_i], na_pattern))
     print_dice_explanations(log)
     
     
@@ -454,6 +431,8 @@ def print_dice_explanations(log):
         "\n\t DICE2 is the segmentation within the ROI vs GT."
         "\n\t DICE3 is segmentation within the ROI vs the GT within the ROI.")
     log.print3("EXPLANATION: If an ROI mask has been provided, you should be consulting DICE2 or DICE3.")
+    log.print3("EXPLANATION: SENS/PREC/VOLDIFF are the sensitivity, precision and relative volume difference..."
+        "\n\t ...(predicted-GT)/GT, of the segmentation within the ROI vs GT, as DICE2.")
     
     
 def calc_stats_of_metrics(metrics_per_subj_per_c, na_pattern):
@@ -479,12 +458,89 @@ def report_mean_metrics(log, mean_metrics, na_pattern, val_test_print):
                " DICE1=" + strListFl4fNA(mean_metrics['dice1'], na_pattern) +
                " DICE2=" + strListFl4fNA(mean_metrics['dice2'], na_pattern) +
                " DICE3=" + strListFl4fNA(mean_metrics['dice3'], na_pattern))
+    log.print3("ACCURACY: (" + str(val_test_print) + ")" +
+               " The Per-Class average metrics over all subjects are:" +
+               " SENS=" + strListFl4fNA(mean_metrics['sens'], na_pattern) +
+               " PREC=" + strListFl4fNA(mean_metrics['prec'], na_pattern) +
+               " VOLDIFF=" + strListFl4fNA(mean_metrics['voldiff'], na_pattern))
     
     print_dice_explanations(log)
     
     return mean_metrics
 
 
+# Bytes of the probability maps (all classes) post-processed at once. See postproc_save_and_eval_subj()
+SIZE_OF_SLABS_POSTPROC = 64 * 1024 * 1024
+
+
+def postproc_save_and_eval_subj(log, subj_i, cnn_pathways, n_classes,
+                                prob_maps_vols, array_fms_to_save, gt_lbl_img, roi_mask,
+                                pad_input, pad_left_right_per_axis,
+                                savePredictedSegmAndProbsDict, suffixForSegmAndProbsDict,
+                                namesForSavingSegmAndProbs, paths_per_chan_per_subj,
+                                paths_to_lbls_per_subj,
+                                save_fms_flag, idxs_fms_to_save, namesForSavingFms,
+                                metrics_per_subj_per_c, na_pattern, val_test_print,
+                                writer):
+    # Called by inference_on_whole_volumes() in a background thread, while the next subject is segmented.
+    # writer: A NiiWriter. Outputs are queued to it and written in parallel. Waits for them before returning.
+    # Writes the metrics of the subject in metrics_per_subj_per_c, in place.
+    # prob_maps_vols and array_fms_to_save are changed in place (masked by the ROI). They may be memory-mapped.
+    # Unpadding is done by slicing (views), and the rest slab by slab along the 1st axis, so that no extra ...
+    # ... copies of all the class or feature-map volumes are made. Only of the segmentation and labels.
+    # ========================== Post-Processing =========================
+    # Unpad all images.        
+    gt_lbl_u            = unpad_img(gt_lbl_img, pad_input, pad_left_right_per_axis)
+    roi_mask_u          = unpad_img(roi_mask, pad_input, pad_left_right_per_axis)
+    prob_maps_vols_u    = unpad_list_of_imgs(prob_maps_vols, pad_input, pad_left_right_per_axis)
+    array_fms_to_save_u = unpad_list_of_imgs(array_fms_to_save, pad_input, pad_left_right_per_axis)
+    
+    # The segmentation. Then post-process outside the ROI, e.g. by deleting any predictions outside it.
+    dims_u = prob_maps_vols_u[0].shape
+    pred_seg_u = np.empty(dims_u, dtype="int16")
+    n_planes_per_slab = max(1, SIZE_OF_SLABS_POSTPROC // (n_classes * dims_u[1] * dims_u[2] * 4))
+    for plane_low in range(0, dims_u[0], n_planes_per_slab):
+        slab = slice(plane_low, plane_low + n_planes_per_slab)
+        prob_maps_slab = np.stack([prob_map[slab] for prob_map in prob_maps_vols_u], axis=0)
+        pred_seg_u[slab] = np.argmax(prob_maps_slab, axis=0)
+        if roi_mask_u is not None:
+            for c in range(n_classes):
+                prob_maps_vols_u[c][slab] *= roi_mask_u[slab]
+    prob_maps_vols_u_in_roi = prob_maps_vols_u # Just to follow naming convention for clarity.
+    pred_seg_u_in_roi = pred_seg_u if roi_mask_u is None else pred_seg_u * roi_mask_u
+    
+    # ======================= Save Output Volumes ========================
+    # Save predicted segmentations
+    save_pred_seg(pred_seg_u_in_roi,
+                  savePredictedSegmAndProbsDict["segm"], suffixForSegmAndProbsDict["segm"],
+                  namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log, writer)
+
+    # Save probability maps
+    save_prob_maps(prob_maps_vols_u_in_roi,
+                   savePredictedSegmAndProbsDict["prob"], suffixForSegmAndProbsDict["prob"],
+                   namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log, writer)
+
+    # Save feature maps
+    save_fms_individual(save_fms_flag, array_fms_to_save_u, cnn_pathways, idxs_fms_to_save,
+                        namesForSavingFms, paths_per_chan_per_subj, subj_i, log, writer)
+    
+    # ================= Evaluate DSC for this subject ========================
+    if paths_to_lbls_per_subj is not None:  # GT was provided.
+        # All metrics from the confusion matrices within and outside the ROI. See evaluation.py
+        calc_metrics_for_subject(metrics_per_subj_per_c, subj_i,
+                                 pred_seg_u, gt_lbl_u, roi_mask_u,
+                                 n_classes, na_pattern)
+        report_metrics_for_subject(log, metrics_per_subj_per_c, subj_i, na_pattern, val_test_print)
+
+    # Outputs are written while the metrics are calculated. Wait, so that the volumes are not freed before.
+    writer.wait()
+    writer.forget_hdr(paths_per_chan_per_subj[subj_i][0])
+    
+    # If memory-mapped, their files are not needed anymore.
+    del_vol_of_outputs(prob_maps_vols)
+    del_vol_of_outputs(array_fms_to_save)
+
+
 # Main routine for testing.
 def inference_on_whole_volumes(sessionTf,
                                cnn3d,
@@ -503,14 +559,25 @@ def inference_on_whole_volumes(sessionTf,
                                # Pre-Processing
                                pad_input,
                                norm_prms,
+                               folder_cache,
                                # Saving feature maps
                                save_fms_flag,
                                idxs_fms_to_save,
-                               namesForSavingFms):
+                               namesForSavingFms,
+                               folder_mmap_outputs,
+                               tta_prms,
+                               nii_writer_prms,
+                               cnns_ensemble):
     # save_fms_flag: should contain an entry per pathwayType, even if just []...
     #       ... If not [], the list should contain one entry per layer of the pathway, even if just [].
     #       ... The layer entries, if not [], they should have to integers, lower and upper FM to visualise.
     #       ... Excluding the highest index.
+    # folder_cache: None, or folder where pre-processed subjects are cached. See dataManagement/cache.py
+    # folder_mmap_outputs: None, or folder where to memory-map the predicted volumes while stitching and saving...
+    #       ... them, so that RAM does not grow with the number of classes and fms saved. See alloc_vol_of_outputs()
+    # tta_prms: None, or parameters of test-time augmentation. See augmentSample.get_variants_for_tta()
+    # nii_writer_prms: None, or dictionary with kwargs for NiiWriter (n_threads, compress, compress_lvl). See io.py
+    # cnns_ensemble: List of more Cnn3d, whose predictions are averaged with those of cnn3d. [] for no ensemble.
 
     val_test_print = "Validation" if val_or_test == "val" else "Testing"
     
@@ -525,94 +592,94 @@ def inference_on_whole_volumes(sessionTf,
     n_classes = cnn3d.num_classes
     n_subjects = len(paths_per_chan_per_subj)
     dims_hres_segment = cnn3d.pathways[0].getShapeOfInput("test")[2:]
+    # Find the total number of feature maps that will be created, and where the fms of each layer go:
+    # NOTE: save_fms_flag should contain an entry per pathwayType, even if just [].
+    # If not [], the list should contain one entry per layer of the pathway, even if just [].
+    # The layer entries, if not [], they should have to integers, lower and upper FM to visualise.
+    # Shapes of the layers are the same for all tiles, so this is done once, for all subjects.
+    n_fms_to_save = calc_num_fms_to_save(cnn3d.pathways, idxs_fms_to_save) if save_fms_flag else 0
+    plan_stitch_fms = make_plan_to_stitch_fms(cnn3d.pathways, idxs_fms_to_save,
+                                              cnn3d.finalTargetLayer.outputShape["test"][2:]) if save_fms_flag else None
+    # Test-time augmentation. Predictions are averaged over these variants of each tile.
+    variants_tta = get_variants_for_tta(tta_prms)
+    if len(variants_tta) > 1:
+        log.print3("Test-time augmentation: Predictions will be averaged over [" + str(len(variants_tta)) + "]" +
+                   " variants of each segment (flips, rotations): " + str(variants_tta))
     
     # One dice score for whole foreground (0) AND one for each actual class
     # Dice1 - AllpredictedLes/AllLesions
     # Dice2 - predictedInsideRoiMask/AllLesions
     # Dice3 - predictedInsideRoiMask/ LesionsInsideRoiMask (for comparisons)
+    # Also sensitivity, precision and volume difference. See evaluation.py
     # Each is a list of dimensions: n_subjects X n_classes
     # initialization of the lists (values will be replaced)
-    metrics_per_subj_per_c = {"dice1": [[-1] * n_classes for _ in range(n_subjects)],
-                              "dice2": [[-1] * n_classes for _ in range(n_subjects)],
-                              "dice3": [[-1] * n_classes for _ in range(n_subjects)]}
-    
-    for subj_i in range(n_subjects):
-        log.print3("")
-        log.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        log.print3("~~~~~~~~\t Segmenting subject with index #" + str(subj_i) + " \t~~~~~~~~")
-        
-        (channels,  # nparray [channels,dim0,dim1,dim2]
-         gt_lbl_img,
-         roi_mask,
-         _) = load_imgs_of_subject(log, "",
-                                   subj_i,
-                                   paths_per_chan_per_subj,
-                                   paths_to_lbls_per_subj,
-                                   None, # weightmaps, not for test
-                                   paths_to_masks_per_subj)
-        (channels,
-        gt_lbl_img,
-        roi_mask,
-        _,
-        pad_left_right_per_axis) = preproc_imgs_of_subj(log, "",
-                                                        channels, gt_lbl_img, roi_mask, None,
-                                                        run_input_checks, n_classes, # checks
-                                                        pad_input, cnn3d.recFieldCnn, dims_hres_segment, # pad
-                                                        norm_prms)
+    metrics_per_subj_per_c = {name_metric: [[-1] * n_classes for _ in range(n_subjects)]
+                              for name_metric in NAMES_OF_METRICS}
     
-        # ============== Augmentation ==================
-        # TODO: Add augmentation here. And aggregate results after prediction of the whole volumes
-        
-        # ============== Predict whole volume ==================
-        # array_fms_to_save will be None if not saving them.
-        (prob_maps_vols,
-         array_fms_to_save) = predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
-                                                             channels, roi_mask, batchsize,
-                                                             save_fms_flag, idxs_fms_to_save )
-        
-        # ========================== Post-Processing =========================
-        pred_seg = np.argmax(prob_maps_vols, axis=0)  # The segmentation.
-
-        # Unpad all images.        
-        pred_seg_u          = unpad_img(pred_seg, pad_input, pad_left_right_per_axis)
-        gt_lbl_u            = unpad_img(gt_lbl_img, pad_input, pad_left_right_per_axis)
-        roi_mask_u          = unpad_img(roi_mask, pad_input, pad_left_right_per_axis)
-        prob_maps_vols_u    = unpad_list_of_imgs(prob_maps_vols, pad_input, pad_left_right_per_axis)
-        array_fms_to_save_u = unpad_list_of_imgs(array_fms_to_save, pad_input, pad_left_right_per_axis)
-        
-        # Poster-process outside the ROI, e.g. by deleting any predictions outside it.
-        pred_seg_u_in_roi = pred_seg_u if roi_mask_u is None else pred_seg_u * roi_mask_u
-        gt_lbl_u_in_roi = gt_lbl_u if (gt_lbl_u is None or roi_mask_u is None) else gt_lbl_u * roi_mask_u
-        for c in range(n_classes):
-            prob_map = prob_maps_vols_u[c]
-            prob_maps_vols_u[c] = prob_map if roi_mask_u is None else prob_map * roi_mask_u
-        prob_maps_vols_u_in_roi = prob_maps_vols_u # Just to follow naming convention for clarity.
-        
-        # ======================= Save Output Volumes ========================
-        # Save predicted segmentations
-        save_pred_seg(pred_seg_u_in_roi,
-                      savePredictedSegmAndProbsDict["segm"], suffixForSegmAndProbsDict["segm"],
-                      namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log)
-
-        # Save probability maps
-        save_prob_maps(prob_maps_vols_u_in_roi,
-                       savePredictedSegmAndProbsDict["prob"], suffixForSegmAndProbsDict["prob"],
-                       namesForSavingSegmAndProbs, paths_per_chan_per_subj, subj_i, log)
-
-        # Save feature maps
-        save_fms_individual(save_fms_flag, array_fms_to_save_u, cnn3d.pathways, idxs_fms_to_save,
-                            namesForSavingFms, paths_per_chan_per_subj, subj_i, log)
-        
+    # Pipeline: While a subject is segmented by the cnn, the next one is loaded and pre-processed and the...
+    # ... predictions of the previous one are post-processed, saved and evaluated, in background threads.
+    # Loading, normalization, unpadding and (gzip) writing of NIfTIs mostly release the GIL (numpy, zlib, IO).
+    # Max one subject is being loaded and one being saved at any time, to bound RAM.
+    pool_io = ThreadPool(processes=2)
+    # Writes the outputs of the subject that is saved, in more background threads. Caches headers of originals.
+    writer = NiiWriter(log, **(nii_writer_prms if nii_writer_prms is not None else {}))
+    def args_for_loading(subj_i):
+        return (log, "",
+                subj_i,
+                paths_per_chan_per_subj,
+                paths_to_lbls_per_subj,
+                None, # weightmaps, not for test
+                paths_to_masks_per_subj,
+                run_input_checks, n_classes, # checks
+                pad_input, cnn3d.recFieldCnn, dims_hres_segment, # pad
+                norm_prms,
+                folder_cache)
+    job_load = pool_io.apply_async(load_and_preproc_imgs_of_subj, args_for_loading(0)) if n_subjects > 0 else None
+    job_postproc = None
+    try:
+        for subj_i in range(n_subjects):
+            log.print3("")
+            log.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+            log.print3("~~~~~~~~\t Segmenting subject with index #" + str(subj_i) + " \t~~~~~~~~")
+            
+            (channels,  # nparray [channels,dim0,dim1,dim2]
+             gt_lbl_img,
+             roi_mask,
+             _,
+             pad_left_right_per_axis,
+             _, _) = job_load.get()  # Re-raises exceptions of the job.
+            if subj_i + 1 < n_subjects:
+                job_load = pool_io.apply_async(load_and_preproc_imgs_of_subj, args_for_loading(subj_i + 1))
         
-        # ================= Evaluate DSC for this subject ========================
-        if paths_to_lbls_per_subj is not None:  # GT was provided.
-            metrics_per_subj_per_c = calc_metrics_for_subject(metrics_per_subj_per_c, subj_i,
-                                                              pred_seg_u, pred_seg_u_in_roi,
-                                                              gt_lbl_u, gt_lbl_u_in_roi,
-                                                              n_classes, NA_PATTERN)
-            report_metrics_for_subject(log, metrics_per_subj_per_c, subj_i, NA_PATTERN, val_test_print)
+            # ============== Predict whole volume ==================
+            # array_fms_to_save will be None if not saving them. Test-time augmentation is done per batch (variants_tta).
+            (prob_maps_vols,
+             array_fms_to_save) = predict_whole_volume_by_tiling(log, sessionTf, cnn3d,
+                                                                 channels, roi_mask, batchsize,
+                                                                 save_fms_flag, n_fms_to_save, plan_stitch_fms,
+                                                                 folder_mmap_outputs, "subj" + str(subj_i),
+                                                                 variants_tta, cnns_ensemble )
             
-        # Done with subject.
+            # ============== Post-process, save and evaluate, in background ==================
+            if job_postproc is not None:
+                job_postproc.get()  # Previous subject must be done before queueing this one.
+            job_postproc = pool_io.apply_async(postproc_save_and_eval_subj,
+                                               (log, subj_i, cnn3d.pathways, n_classes,
+                                                prob_maps_vols, array_fms_to_save, gt_lbl_img, roi_mask,
+                                                pad_input, pad_left_right_per_axis,
+                                                savePredictedSegmAndProbsDict, suffixForSegmAndProbsDict,
+                                                namesForSavingSegmAndProbs, paths_per_chan_per_subj,
+                                                paths_to_lbls_per_subj,
+                                                save_fms_flag, idxs_fms_to_save, namesForSavingFms,
+                                                metrics_per_subj_per_c, NA_PATTERN, val_test_print,
+                                                writer))
+            # Done with subject.
+        if job_postproc is not None:
+            job_postproc.get()
+    finally:
+        pool_io.terminate()
+        pool_io.join()
+        writer.close()
         
     # ==================== Report average Dice Coefficient over all subjects ==================
     mean_metrics = None # To return something even if ground truth has not been given (in testing)
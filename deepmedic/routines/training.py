@@ -10,103 +10,96 @@ from __future__ import absolute_import, print_function, division
 import os
 import sys
 import time
-from multiprocessing.pool import ThreadPool
 import traceback
 
 import numpy as np
 
 from deepmedic.logging.accuracyMonitor import AccuracyMonitorForEpSegm
 from deepmedic.neuralnet.wrappers import CnnWrapperForSampling
-from deepmedic.dataManagement.sampling import get_samples_for_subepoch
+from deepmedic.dataManagement.sampling import PoolForSampling
+from deepmedic.dataManagement.prefetching import PrefetchQueueOfBatches
 from deepmedic.routines.testing import inference_on_whole_volumes
 
 from deepmedic.logging.utils import datetime_now_str
 
 
+def get_feeds_dict_of_batch(feeds, cnn3d, channs_of_batch_per_path, lbls_of_batch):
+    # Samples may be stored in reduced precision (see sampling.get_shapes_of_bufs_of_samples()).
+    # Cast to the types of the cnn's inputs here, per batch. No copy if already of the type.
+    feeds_dict = {feeds['x']: np.asarray(channs_of_batch_per_path[0], dtype="float32")}
+    for subs_path_i in range(cnn3d.numSubsPaths):
+        feeds_dict.update({feeds['x_sub_' + str(subs_path_i)]: np.asarray(channs_of_batch_per_path[subs_path_i + 1],
+                                                                          dtype="float32")})
+    feeds_dict.update({feeds['y_gt']: np.asarray(lbls_of_batch, dtype="int32")})
+    return feeds_dict
+
+
 def process_in_batches(log,
                        sessionTf,
                        train_or_val,
-                       n_batches,
-                       batchsize,
+                       batch_queue,
                        cnn3d,
-                       acc_monitor_ep,
-                       channs_samples_per_path,
-                       lbls_samples_per_path):
+                       acc_monitor_ep):
     # Processes batches of subepoch. Performs training or validation. Collects performance metrics.
+    # batch_queue: PrefetchQueueOfBatches, from which the batches of the subepoch are taken.
 
     costs_of_batches = []
-    # Each row of array below holds number of:
-    #     Real Positives, Real Neg, True Predicted Pos, True Predicted Neg in subepoch, in this order.
-    arr_RpRnTpTn_per_class_in_subep = np.zeros([cnn3d.num_classes, 4], dtype="int32")
+    # Confusion matrix over the subepoch. Entry [i, j] holds the number of voxels with label i, predicted as class j.
+    conf_matrix_in_subep = np.zeros([cnn3d.num_classes, cnn3d.num_classes], dtype="int64")
 
+    # First batch also tells how many batches the subepoch has.
+    (n_batches, channs_of_batch_per_path, lbls_of_batch) = batch_queue.get_batch(train_or_val)
     print_progress_step = max(1, n_batches // 5)
 
     for batch_i in range(n_batches):
+        if batch_i > 0:
+            (_, channs_of_batch_per_path, lbls_of_batch) = batch_queue.get_batch(train_or_val)
+        str_queue = " (Prefetched batches in queue: " + str(batch_queue.get_n_batches_in_queue()) + ")"
 
         if train_or_val == "train":
             if batch_i == 0 or ((batch_i + 1) % print_progress_step) == 0 or (batch_i + 1) == n_batches:
                 log.print3("[TRAINING] Trained on " + str(batch_i + 1) + "/" + str(n_batches) +\
-                           " batches for this subepoch...")
+                           " batches for this subepoch..." + str_queue)
 
             ops_to_fetch = cnn3d.get_main_ops('train')
-            list_of_ops = [ops_to_fetch['cost']] + ops_to_fetch['list_rp_rn_tp_tn'] +\
-                            [ops_to_fetch['updates_grouped_op']]
-
-            min_idx_batch = batch_i * batchsize
-            max_idx_batch = (batch_i + 1) * batchsize
+            list_of_ops = [ops_to_fetch['cost'], ops_to_fetch['conf_matrix'], ops_to_fetch['updates_grouped_op']]
 
             feeds = cnn3d.get_main_feeds('train')
-            feeds_dict = {feeds['x']: channs_samples_per_path[0][min_idx_batch: max_idx_batch]}
-            for subs_path_i in range(cnn3d.numSubsPaths):
-                x_batch_sub_path = channs_samples_per_path[subs_path_i + 1][min_idx_batch: max_idx_batch]
-                feeds_dict.update({feeds['x_sub_' + str(subs_path_i)]: x_batch_sub_path})
-            feeds_dict.update({feeds['y_gt']: lbls_samples_per_path[min_idx_batch: max_idx_batch]})
+            feeds_dict = get_feeds_dict_of_batch(feeds, cnn3d, channs_of_batch_per_path, lbls_of_batch)
             # Training step. Returns a list containing the results of fetched ops.
+            # Also updates the rolling averages of BN for inference (in updates_grouped_op).
+            # If gradients are accumulated over multiple batches, params are only updated on every last batch of those.
             results_of_run = sessionTf.run(fetches=list_of_ops, feed_dict=feeds_dict)
 
-            cnn3d.updateMatricesOfBnMovingAvForInference(sessionTf)  # I should put this inside the model.
-
             cost_this_batch = results_of_run[0]
-            list_RpRnPpPn_per_class = results_of_run[1:-1]  # [-1] is from updates_grouped_op, returns nothing
+            conf_matrix_of_batch = results_of_run[1]  # [-1] is from updates_grouped_op, returns nothing
 
         else:  # validation
             if batch_i == 0 or ((batch_i + 1) % print_progress_step) == 0 or (batch_i + 1) == n_batches:
                 log.print3("[VALIDATION] Validated on " +
-                           str(batch_i + 1) + "/" + str(n_batches) + " batches for this subepoch...")
+                           str(batch_i + 1) + "/" + str(n_batches) + " batches for this subepoch..." + str_queue)
 
             ops_to_fetch = cnn3d.get_main_ops('val')
-            list_of_ops = ops_to_fetch['list_rp_rn_tp_tn']
-
-            min_idx_batch = batch_i * batchsize
-            max_idx_batch = (batch_i + 1) * batchsize
+            list_of_ops = [ops_to_fetch['conf_matrix']]
 
             feeds = cnn3d.get_main_feeds('val')
-            feeds_dict = {feeds['x']: channs_samples_per_path[0][min_idx_batch: max_idx_batch]}
-            for subs_path_i in range(cnn3d.numSubsPaths):
-                x_batch_sub_path = channs_samples_per_path[subs_path_i + 1][min_idx_batch: max_idx_batch]
-                feeds_dict.update({feeds['x_sub_' + str(subs_path_i)]: x_batch_sub_path})
-            feeds_dict.update({feeds['y_gt']: lbls_samples_per_path[min_idx_batch: max_idx_batch]})
+            feeds_dict = get_feeds_dict_of_batch(feeds, cnn3d, channs_of_batch_per_path, lbls_of_batch)
             # Validation step. Returns a list containing the results of fetched ops.
             results_of_run = sessionTf.run(fetches=list_of_ops, feed_dict=feeds_dict)
 
             cost_this_batch = 999  # placeholder in case of validation.
-            list_RpRnPpPn_per_class = results_of_run
-
-        # list_RpRnPpPn_per_class holds Real Pos, Real Neg, True Pred Pos, True Pred Neg ...
-        # ... for all classes, in this order, flattened. First RpRnTpTn are for 'WHOLE' class.
-        arr_RpRnTpTn_per_class = np.asarray(list_RpRnPpPn_per_class, dtype="int32")
-        arr_RpRnTpTn_per_class = arr_RpRnTpTn_per_class.reshape(arr_RpRnTpTn_per_class_in_subep.shape, order='C')
+            conf_matrix_of_batch = results_of_run[0]
 
         # To later calculate the mean error and cost over the subepoch
         costs_of_batches.append(cost_this_batch)  # only really used in training.
-        arr_RpRnTpTn_per_class_in_subep += arr_RpRnTpTn_per_class
+        conf_matrix_in_subep += conf_matrix_of_batch
 
     # ======== Calculate and Report accuracy over subepoch
     # In case of validation, mean_cost_subep is just a placeholder.
     # Cause this does not get calculated and reported in this case.
     mean_cost_subep = acc_monitor_ep.NA_PATTERN if (train_or_val == "val") else np.mean(costs_of_batches)
     # This function does NOT flip the class-0 background to foreground!
-    acc_monitor_ep.update_metrics_after_subep(mean_cost_subep, arr_RpRnTpTn_per_class_in_subep)
+    acc_monitor_ep.update_metrics_after_subep_from_conf_matrix(mean_cost_subep, conf_matrix_in_subep)
     acc_monitor_ep.log_acc_subep_to_txt()
     acc_monitor_ep.log_acc_subep_to_tensorboard()
     # Done
@@ -146,6 +139,7 @@ def do_training(sessionTf,
                 n_samples_per_subep_train,
                 n_samples_per_subep_val,
                 num_parallel_proc_sampling,  # -1: seq. 0: thread for sampling. >0: multiprocess sampling
+                timeout_secs_sampling_stalled,  # Multiprocess sampling fails if no job finishes for that long. None: Never.
 
                 # -------Sampling Type---------
                 sampling_type_inst_tr,
@@ -173,18 +167,29 @@ def do_training(sessionTf,
 
                 # -------- Pre-processing ------
                 pad_input,
-                norm_prms
+                norm_prms,
+                folder_cache_preproc,  # None, or folder to cache pre-processed subjects for sampling.
+                precision_samples  # 32 or 16. Precision in which sampled segments and labels are stored.
                 ):
     id_str = "[MAIN|PID:" + str(os.getpid()) + "]"
     start_time_train = time.time()
 
+    # Accumulated grads carry over to the next subepoch. Only the remainder of the very last subepoch is not applied.
+    n_batches_accum_grads = trainer.get_num_batches_accum_grads()
+    if n_batches_accum_grads > 1:
+        log.print3(id_str + " Params are updated every " + str(n_batches_accum_grads) + " batches. Effective batch size: " +
+                   str(batchsize_train * n_batches_accum_grads) + " training samples.")
+        if (n_samples_per_subep_train // batchsize_train) % n_batches_accum_grads != 0:
+            log.print3(id_str + " WARN: Training batches per subepoch (" + str(n_samples_per_subep_train // batchsize_train) +
+                       ") are not a multiple of the batches that gradients are accumulated over (" +
+                       str(n_batches_accum_grads) + "). Updates will not be aligned with subepochs.")
+
     # I cannot pass cnn3d to the sampling function, because the pp module used to reload theano. 
     # This created problems in the GPU when cnmem is used. Not sure this is needed with Tensorflow. Probably.
     cnn3dWrapper = CnnWrapperForSampling(cnn3d)
 
     args_for_sampling_tr = (log,
                             "train",
-                            num_parallel_proc_sampling,
                             run_input_checks,
                             cnn3dWrapper,
                             max_n_cases_per_subep_train,
@@ -197,11 +202,12 @@ def do_training(sessionTf,
                             pad_input,
                             norm_prms,
                             augm_img_prms,
-                            augm_sample_prms
+                            augm_sample_prms,
+                            folder_cache_preproc,
+                            precision_samples
                             )
     args_for_sampling_val = (log,
                              "val",
-                             num_parallel_proc_sampling,
                              run_input_checks,
                              cnn3dWrapper,
                              max_n_cases_per_subep_train,
@@ -214,18 +220,40 @@ def do_training(sessionTf,
                              pad_input,
                              norm_prms,
                              None,  # no augmentation in val.
-                             None  # no augmentation in val.
+                             None,  # no augmentation in val.
+                             folder_cache_preproc,
+                             precision_samples
                              )
 
-    sampling_job_submitted_train = False
-    sampling_job_submitted_val = False
-    # For parallel extraction of samples for next train/val while processing previous iteration.
-    mp_pool = None
-    if num_parallel_proc_sampling > -1:  # Use multiprocessing.
-        mp_pool = ThreadPool(processes=1)  # Or multiprocessing.Pool(...), same API.
+    # Pool of processes that sample from subjects in parallel. Lives for the whole session. None: Sequential sampling.
+    mp_pool_sampling = None
+    if num_parallel_proc_sampling > 0:
+        args_for_sampling_per_mode = {'train': args_for_sampling_tr}
+        if val_on_samples:
+            args_for_sampling_per_mode['val'] = args_for_sampling_val
+        mp_pool_sampling = PoolForSampling(log, num_parallel_proc_sampling, args_for_sampling_per_mode,
+                                           timeout_secs_sampling_stalled)
+    args_for_sampling_tr = (mp_pool_sampling,) + args_for_sampling_tr
+    args_for_sampling_val = (mp_pool_sampling,) + args_for_sampling_val
+
+    # Batches are sampled and prefetched continuously by a thread, parallel to training. Unless sequential (-1).
+    # Queue holds max the batches of one subepoch (train + val). Peak RAM for samples is about 2 subepochs, plus the...
+    # ... shared buffers of the pool of sampling processes if used. See PrefetchQueueOfBatches.
+    batch_queue = None
 
     try:
         n_eps_trained_model = trainer.get_num_epochs_trained_tfv().eval(session=sessionTf)
+        batch_queue = PrefetchQueueOfBatches(log,
+                                             max(0, n_epochs - n_eps_trained_model) * n_subepochs,
+                                             max(1, n_samples_per_subep_train // batchsize_train +
+                                                 (n_samples_per_subep_val // batchsize_val_samples if val_on_samples
+                                                  else 0)),
+                                             num_parallel_proc_sampling > -1,
+                                             val_on_samples,
+                                             args_for_sampling_tr,
+                                             args_for_sampling_val,
+                                             batchsize_train,
+                                             batchsize_val_samples)
         while n_eps_trained_model < n_epochs:
             epoch = n_eps_trained_model
 
@@ -260,99 +288,37 @@ def do_training(sessionTf,
                 log.print3("***********************************************************************************")
                 log.print3("*\t\t\t Starting new Subepoch: #" + str(subep) + "/" + str(n_subepochs) + " \t\t\t*")
                 log.print3("***********************************************************************************")
+                log.print3(id_str + " Prefetched batches in queue: [" + str(batch_queue.get_n_batches_in_queue()) +
+                           "/" + str(batch_queue.get_max_n_batches_in_queue()) + "]")
 
-                # -------------------- GET DATA FOR THIS SUBEPOCH's VALIDATION -----------------------
+                # ------------------------------------DO VALIDATION--------------------------------
                 if val_on_samples:
-                    if mp_pool is None:  # Sequential processing.
-                        log.print3(id_str + " NO MULTIPROC: Sampling for subepoch #" + str(subep) +\
-                                   " [VALIDATION] will be done by main thread.")
-                        (channs_samples_per_path_val,
-                         lbls_samples_per_path_val) = get_samples_for_subepoch(*args_for_sampling_val)
-                    elif sampling_job_submitted_val:  # done parallel with training of previous epoch.
-                        (channs_samples_per_path_val,
-                         lbls_samples_per_path_val) = sampling_job_val.get()
-                        sampling_job_submitted_val = False
-                    else:  # Not previously submitted in case of first epoch or after a full-volumes validation.
-                        assert subep == 0
-                        log.print3(id_str + " MULTIPROC: Before Validation in subepoch #" + str(subep) +\
-                                   ", submitting sampling job for next [VALIDATION].")
-                        sampling_job_val = mp_pool.apply_async(get_samples_for_subepoch, args_for_sampling_val)
-                        (channs_samples_per_path_val,
-                         lbls_samples_per_path_val) = sampling_job_val.get()
-                        sampling_job_submitted_val = False
-
-                    # ----------- SUBMIT PARALLEL JOB TO GET TRAINING DATA FOR NEXT TRAINING -----------------
-                    if mp_pool is not None:
-                        log.print3(id_str + " MULTIPROC: Before Validation in subepoch #" + str(subep) +\
-                                   ", submitting sampling job for next [TRAINING].")
-                        sampling_job_tr = mp_pool.apply_async(get_samples_for_subepoch, args_for_sampling_tr)
-                        sampling_job_submitted_train = True
-
-                    # ------------------------------------DO VALIDATION--------------------------------
                     log.print3("V-V-V-V- Validating for subepoch before starting training iterations -V-V-V-V")
                     start_time_val_subep = time.time()
-                    # Calc num of batches from extracted samples, in case not extracted as much as requested.
-                    n_batches_val = len(channs_samples_per_path_val[0]) // batchsize_val_samples
                     process_in_batches(log,
                                        sessionTf,
                                        "val",
-                                       n_batches_val,
-                                       batchsize_val_samples,
+                                       batch_queue,
                                        cnn3d,
-                                       acc_monitor_ep_val,
-                                       channs_samples_per_path_val,
-                                       lbls_samples_per_path_val)
+                                       acc_monitor_ep_val)
                     log.print3("TIMING: Validation on batches of subepoch #" + str(subep) +\
-                               " lasted: {0:.1f}".format(time.time() - start_time_val_subep) + " secs.")
-
-                # ----------------------- GET DATA FOR THIS SUBEPOCH's TRAINING ------------------------------
-                if mp_pool is None:  # Sequential processing.
-                    log.print3(id_str + " NO MULTIPROC: Sampling for subepoch #" + str(subep) +\
-                               " [TRAINING] will be done by main thread.")
-                    (channs_samples_per_path_tr,
-                     lbls_samples_per_path_tr) = get_samples_for_subepoch(*args_for_sampling_tr)
-                elif sampling_job_submitted_train:  # done parallel with train/val of previous epoch.
-                    (channs_samples_per_path_tr,
-                     lbls_samples_per_path_tr) = sampling_job_tr.get()
-                    sampling_job_submitted_train = False
-                else:  # Not previously submitted in case of first epoch or after a full-volumes validation.
-                    assert subep == 0
-                    log.print3(id_str + " MULTIPROC: Before Training in subepoch #" + str(subep) +\
-                               ", submitting sampling job for next [TRAINING].")
-                    sampling_job_tr = mp_pool.apply_async(get_samples_for_subepoch, args_for_sampling_tr)
-                    (channs_samples_per_path_tr,
-                     lbls_samples_per_path_tr) = sampling_job_tr.get()
-                    sampling_job_submitted_train = False
-
-                # ----- SUBMIT PARALLEL JOB TO GET VAL / TRAIN (if no val) DATA FOR NEXT SUBEPOCH -----
-                if mp_pool is not None and not (val_on_whole_vols_after_this_ep and (subep == n_subepochs - 1)):
-                    if val_on_samples:
-                        log.print3(id_str + " MULTIPROC: Before Training in subepoch #" + str(subep) +\
-                                   ", submitting sampling job for next [VALIDATION].")
-                        sampling_job_val = mp_pool.apply_async(get_samples_for_subepoch, args_for_sampling_val)
-                        sampling_job_submitted_val = True
-                    else:
-                        log.print3(id_str + " MULTIPROC: Before Training in subepoch #" + str(subep) +\
-                                   ", submitting sampling job for next [TRAINING].")
-                        sampling_job_tr = mp_pool.apply_async(get_samples_for_subepoch, args_for_sampling_tr)
-                        sampling_job_submitted_train = True
+                               " lasted: {0:.1f}".format(time.time() - start_time_val_subep) + " secs." +\
+                               " Waited for batches (starved): {0:.1f}".format(batch_queue.get_and_reset_time_waited()) +\
+                               " secs.")
 
                 # ------------------------------ START TRAINING IN BATCHES -----------------------------
                 log.print3("-T-T-T-T- Training for this subepoch... May take a few minutes... -T-T-T-T-")
                 start_time_train_subep = time.time()
-                # Calc num of batches from extracted samples, in case not extracted as much as requested.
-                n_batches_train = len(channs_samples_per_path_tr[0]) // batchsize_train
                 process_in_batches(log,
                                    sessionTf,
                                    "train",
-                                   n_batches_train,
-                                   batchsize_train,
+                                   batch_queue,
                                    cnn3d,
-                                   acc_monitor_ep_tr,
-                                   channs_samples_per_path_tr,
-                                   lbls_samples_per_path_tr)
+                                   acc_monitor_ep_tr)
                 log.print3("TIMING: Training on batches of this subepoch #" + str(subep) +\
-                           " lasted: {0:.1f}".format(time.time() - start_time_train_subep) + " secs.")
+                           " lasted: {0:.1f}".format(time.time() - start_time_train_subep) + " secs." +\
+                           " Waited for batches (starved): {0:.1f}".format(batch_queue.get_and_reset_time_waited()) +\
+                           " secs.")
 
             log.print3("")
             log.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
@@ -396,10 +362,15 @@ def do_training(sessionTf,
                                                                          # Pre-Processing
                                                                          pad_input,
                                                                          norm_prms,
+                                                                         folder_cache_preproc,
                                                                          # Saving feature maps
                                                                          save_fms_flag,
                                                                          idxs_fms_to_save,
-                                                                         namesForSavingFms)
+                                                                         namesForSavingFms,
+                                                                         None, # Predictions kept in RAM.
+                                                                         None, # No test-time augmentation.
+                                                                         None, # Default writing of outputs.
+                                                                         []) # No ensemble.
                 
                 acc_monitor_ep_val.report_metrics_whole_vols(mean_metrics_val_whole_vols)
 
@@ -411,16 +382,21 @@ def do_training(sessionTf,
     except (Exception, KeyboardInterrupt) as e:
         log.print3("\n\n ERROR: Caught exception in do_training(): " + str(e) + "\n")
         log.print3(traceback.format_exc())
-        if mp_pool is not None:
-            log.print3("Terminating worker pool.")
-            mp_pool.terminate()
-            mp_pool.join()  # Will wait. A KeybInt will kill this (py3)
+        if batch_queue is not None:
+            log.print3("Stopping prefetching of batches.")
+            batch_queue.stop()
+        if mp_pool_sampling is not None:
+            log.print3("Terminating pool of sampling processes.")
+            mp_pool_sampling.terminate()
+            mp_pool_sampling.join()
         return 1
     else:
-        if mp_pool is not None:
-            log.print3("Closing worker pool.")
-            mp_pool.close()
-            mp_pool.join()
+        batch_queue.stop()
+        if mp_pool_sampling is not None:
+            # Needed in case any processes are hanging. mp_pool.close() does not solve this.
+            log.print3("Terminating pool of sampling processes.")
+            mp_pool_sampling.terminate()
+            mp_pool_sampling.join()
 
     # Save the final trained model.
     filename_to_save_with = fileToSaveTrainedCnnModelTo + ".final." + datetime_now_str()